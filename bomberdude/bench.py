@@ -0,0 +1,849 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import random
+from socket import AF_INET6, inet_pton
+import statistics
+import tempfile
+from threading import Lock
+import time
+from typing import List, Optional
+
+from common.beacon import Beacon
+from common.blast import table
+from common.batch import Batcher
+from common.bundle import BundleStore, bundle_key, split_keys
+from common.bundlelog import BundleLog
+from common.core_utils import get_node_distance
+from common.dedupe import RecentSet
+from common.neighbors import NeighborTable
+from common.routing import Router, SprayAndWait, routers
+from common.spatial import SpatialIndex
+from common.types import BEACON_INTERVAL, GATEWAY_BEACON_INTERVAL, KALIVE_INTERVAL, MCAST_HOPS
+from common.payload import ACK, ACTIONS, KALIVE, Frame, Payload
+from common.replay import ReplayEngine, ReplayWriter, codecs
+from server.interest import Interest
+from common.state import BOMB, BOX, FLOOR, PLAYER_TILE, Change, GameState, Grid, bytes_from_changes, change_from_bytes, template
+
+
+def board(size: int, seed: int, density: float) -> GameState:
+    """
+    Creates a game state with a freshly generated square board.
+
+    :param size: The width and height of the board.
+    :param seed: The seed of the map generator.
+    :param density: The chance of a free cell holding a box.
+    :return: The game state.
+    """
+    gs = GameState(Lock(), {}, {}, size=(size, size))
+    gs.reset()
+    gs.generate_map(seed, density)
+    return gs
+
+
+def walks(size: int, players: int, ticks: int, rng: random.Random,
+          grid: Optional[Grid] = None) -> List[List[Change]]:
+    """
+    Precomputes the moves of each player, a random walk over the floor of a board.
+
+    :param grid: The board to walk on, the empty board if None.
+    :return: The changes sent on each tick.
+    """
+    empty = template(size, size) if grid is None else grid
+    spawns = GameState(Lock(), {}, {}, size=(size, size)).spawns
+    positions = [spawns[id] for id in range(1, players + 1)]
+
+    out = []
+    for _ in range(ticks):
+        changes = []
+        for id, (x, y) in enumerate(positions, 1):
+            steps = [(x + dx, y + dy) for dx, dy in ((1, 0), (-1, 0), (0, 1), (0, -1))
+                     if empty[x + dx, y + dy] == FLOOR]
+            nx, ny = rng.choice(steps)
+            changes.append(Change((x, y, id + 9), (nx, ny, id + 9)))
+            positions[id - 1] = (nx, ny)
+        out.append(changes)
+
+    return out
+
+
+def report(label: str, samples: List[float]):
+    """
+    Prints the mean and tail of the samples, in microseconds.
+    """
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print('%-24s n=%-6d mean=%10.1fus  p50=%10.1fus  p99=%10.1fus' % (
+        label, len(samples), statistics.fmean(samples) * 1e6,
+        samples[len(samples) // 2] * 1e6, p99 * 1e6))
+
+
+def bench_tick(args):
+    """
+    Cost of a lobby tick: decoding the incoming changes, applying them and encoding the outgoing ones.
+    """
+    for size in args.sizes:
+        for players in args.players:
+            gs = board(size, args.seed, args.density)
+            ticks = walks(size, players, args.ticks, random.Random(args.seed))
+            incoming = [bytes_from_changes(changes) for changes in ticks]
+
+            samples = []
+            for data in incoming:
+                start = time.perf_counter()
+                changes = change_from_bytes(data)
+                for change in changes:
+                    gs._apply_change(change)
+                bytes_from_changes(changes)
+                samples.append(time.perf_counter() - start)
+
+            report('tick %dx%d p=%d' % (size, size, players), samples)
+
+
+def bench_validate(args):
+    """
+    Cost of a lobby tick through apply_state, in player mode (unchecked) and in
+    server mode (validated, fuses lit and advanced).
+    """
+    for size in args.sizes:
+        for players in args.players:
+            # walk around the boxes, so every move is a valid one
+            floor = board(size, args.seed, args.density).get_state().copy()
+            ticks = walks(size, players, args.ticks, random.Random(args.seed), floor)
+            incoming = [bytes_from_changes(changes) for changes in ticks]
+
+            for validated in (False, True):
+                gs = board(size, args.seed, args.density)
+                gs.mode = int(validated)
+                rejected = 0
+
+                samples = []
+                for data in incoming:
+                    start = time.perf_counter()
+                    changes = gs.apply_state(data)
+                    samples.append(time.perf_counter() - start)
+                    if validated:
+                        rejected += len(data) // 6 - len(changes)
+
+                report('%s %dx%d p=%d' % ('validated' if validated else 'unchecked',
+                                          size, size, players), samples)
+                if rejected:
+                    print('%d changes rejected' % rejected)
+
+
+def bench_interest(args):
+    """
+    Traffic per player with and without interest filtering, and the cost of routing a tick.
+    """
+    for size in args.sizes:
+        for players in args.players:
+            gs = board(size, args.seed, args.density)
+            ticks = walks(size, players, args.ticks, random.Random(args.seed))
+            ids = list(range(1, players + 1))
+
+            full = sum(len(bytes_from_changes(changes)) for changes in ticks) * players
+
+            interest = Interest(args.radius)
+            interest.sync(gs.players)
+            sent = 0
+            samples = []
+            for changes in ticks:
+                start = time.perf_counter()
+                routed = interest.route(changes, ids)
+                for lst in routed.values():
+                    sent += len(bytes_from_changes(lst))
+                samples.append(time.perf_counter() - start)
+
+            report('route %dx%d p=%d' % (size, size, players), samples)
+            print('%-24s %8.1f B/player/tick unfiltered, %8.1f filtered' % (
+                '', full / players / len(ticks), sent / players / len(ticks)))
+
+
+def bench_relay(args):
+    """
+    Cost of relaying a datagram through a gateway: a full decode and re-encode versus a header peek.
+    Sizes are the number of changes per datagram.
+    """
+    rng = random.Random(args.seed)
+
+    for changes in args.sizes:
+        data = bytes(rng.randrange(256) for _ in range(6 * changes))
+        datagram = Payload(ACTIONS, data, 'lbby', 'plyr', 1, bytes(16), bytes(16), 9999).to_bytes()
+
+        for label, relay in (('decode', lambda d: Payload.from_bytes(d).to_bytes()),
+                             ('peek', lambda d: Frame(d).to_bytes())):
+            samples = []
+            for _ in range(args.ticks):
+                start = time.perf_counter()
+                relay(datagram)
+                samples.append(time.perf_counter() - start)
+
+            report('%s %dB' % (label, len(datagram)), samples)
+
+
+def bench_gateways(args):
+    """
+    Uplink of a mobile node in range of several gateways, one of which fails halfway:
+    all traffic through the best gateway versus spread over the k cheapest, with the
+    gateways' beacons every second or every GATEWAY_BEACON_INTERVAL.
+    Sizes are the number of gateways, gateway i takes (i + 1) * 5ms to take custody.
+    A tick is 10ms, the node queues a payload for the server every tick.
+    """
+    server = ('fd00::1', 9999)
+    fail = args.ticks // 2 / 100
+
+    for count in args.sizes:
+        gateways = [('fd00::%x' % (0x10 + i), 9999) for i in range(count)]
+        rtt = {g: (i + 1) * 0.005 for i, g in enumerate(gateways)}
+
+        for interval, spread in ((1.0, 1), (1.0, args.spread), (GATEWAY_BEACON_INTERVAL, 1),
+                                 (GATEWAY_BEACON_INTERVAL, args.spread)):
+            router = Router(('fd00::2', 9999), NeighborTable(BEACON_INTERVAL), NeighborTable(interval),
+                            BundleStore(lifetime=30.0), server, spread=spread)
+            signals, created, custody = [], {}, {}
+            share = {g: 0 for g in gateways}
+            relayed = {g: 0 for g in gateways}
+
+            for tick in range(args.ticks):
+                now = tick / 100
+                alive = [g for g in gateways if g != gateways[0] or now < fail]
+
+                if tick % round(interval * 100) == 0:
+                    for g in alive:
+                        load, relayed[g] = relayed[g] / interval, 0
+                        router.gateways.beacon(g, (0.0, 0.0), 0, interval, now, load)
+                        router.neighbors.beacon(g, (0.0, 0.0), 0, interval, now, load)
+
+                data = Payload(ACTIONS, b'', 'lbby', 'plyr', tick, bytes(16), bytes(16), 9999).to_bytes()
+                created[router.bundles.add(server, data, now)] = now
+
+                contacts = router.contacts(now)
+                for bundle in router.bundles.due(server, now, mark=False):
+                    for hop in router.targets(bundle, contacts):
+                        router.bundles.mark(bundle.key, now)
+                        if hop in alive:
+                            signals.append((now + rtt[hop], hop, bundle.key))
+
+                # the custody signals due by now
+                signals.sort()
+                while signals and signals[0][0] <= now:
+                    _, hop, key = signals.pop(0)
+                    if hop in alive and router.taken(hop, key, now):
+                        router.bundles.release([key])
+                        custody.setdefault(key, now)
+                        share[hop] += 1
+                        relayed[hop] += 1
+
+            latency = [custody[k] - created[k] for k in custody]
+            failover = max((custody.get(k, args.ticks / 100) - created[k] for k in created
+                            if fail <= created[k] < fail + 0.5), default=0.0)
+            print('gateways=%d beacons=%.2fs spread=%d  mean=%5.1fms  failover=%6.0fms  share=%s' % (
+                count, interval, spread, 1000 * statistics.fmean(latency), 1000 * failover,
+                ' '.join('%.0f%%' % (100 * share[g] / max(len(custody), 1)) for g in gateways)))
+
+
+def bench_uplink(args):
+    """
+    Datagrams a lobby receives from a gateway: a datagram per payload and KALIVE relayed
+    versus payloads batched per outgoing round and KALIVEs summed up once per interval.
+    Sizes are the number of mobile nodes behind the gateway, a tick is an outgoing round
+    of 33ms, each node sends an action every few ticks and a KALIVE every BEACON_INTERVAL.
+    """
+    rng = random.Random(args.seed)
+    lobby = ('fd00::1', 5000)
+    rounds = int(1 / 0.033)
+
+    for nodes in args.sizes:
+        batcher = Batcher(bytes(16))
+        counts = {'relay': [0, 0], 'batch': [0, 0]}
+        samples = []
+
+        for tick in range(args.ticks):
+            sent = []
+            for node in range(nodes):
+                if rng.random() < 1 / args.every:
+                    sent.append(Payload(ACTIONS, bytes(6 * rng.randint(1, 4)), 'lbby', 'p%03d' % node,
+                                        tick, bytes(16), bytes(16), lobby[1]).to_bytes())
+                if (tick + node) % int(BEACON_INTERVAL * rounds) == 0:
+                    kalive = Payload(KALIVE, b'', 'lbby', 'p%03d' % node, tick, bytes(16), bytes(16),
+                                     lobby[1]).to_bytes()
+                    counts['relay'][0] += 1
+                    counts['relay'][1] += len(kalive)
+                    batcher.kalive(lobby, kalive)
+
+            counts['relay'][0] += len(sent)
+            counts['relay'][1] += sum(len(d) for d in sent)
+
+            start = time.perf_counter()
+            for data in sent:
+                batcher.add(lobby, data)
+            out = batcher.flush() + (batcher.summaries() if tick % (KALIVE_INTERVAL * rounds) == 0 else [])
+            samples.append(time.perf_counter() - start)
+
+            counts['batch'][0] += len(out)
+            counts['batch'][1] += sum(len(d) for _, d in out)
+
+        seconds = args.ticks / rounds
+        for label in ('relay', 'batch'):
+            print('%-5s nodes=%-4d datagrams/s=%8.1f  bytes/s=%9.0f' % (
+                label, nodes, counts[label][0] / seconds, counts[label][1] / seconds))
+        report('flush nodes=%d' % nodes, samples)
+
+
+def bench_dedupe(args):
+    """
+    Receive path of a lobby when every payload arrives over several paths: decoding and
+    acknowledging every copy versus dropping the copies seen recently before decoding.
+    Sizes are the number of copies of each payload, a sample is a datagram.
+    """
+    rng = random.Random(args.seed)
+
+    for copies in args.sizes:
+        stream = []
+        for seq in range(args.ticks):
+            data = Payload(ACTIONS, bytes(rng.randrange(256) for _ in range(24)), 'lbby',
+                           'plyr', seq, bytes(16), bytes(16), 9999).to_bytes()
+            stream += [data] * copies
+        # copies arrive interleaved with the following payloads
+        rng.shuffle(stream)
+
+        recent = RecentSet()
+        for label in ('decode', 'dedupe'):
+            samples, handled = [], 0
+            for data in stream:
+                start = time.perf_counter()
+                if label == 'decode' or not recent.seen(data):
+                    # each action handled is acknowledged
+                    payload = Payload.from_bytes(data)
+                    Payload(ACK, b'', 'lbby', payload.player_uuid, payload.seq_num,
+                            bytes(16), payload.source, 9999).to_bytes()
+                    handled += 1
+                samples.append(time.perf_counter() - start)
+
+            report('%s copies=%d handled=%d' % (label, copies, handled), samples)
+
+
+def bench_beacon(args):
+    """
+    Beacon bodies, the former ASCII "x,y,load" next to the packed struct: size of the body,
+    and time to encode and to parse one. Sizes are the extent of the canvas.
+    """
+    rng = random.Random(args.seed)
+
+    for extent in args.sizes:
+        beacons = [Beacon((rng.uniform(0, extent * 100), rng.uniform(0, extent * 100)),
+                          (rng.uniform(-10, 10), rng.uniform(-10, 10)), seq, rng.uniform(0, 50))
+                   for seq in range(args.ticks)]
+
+        samples, parse, size = [], [], 0
+        for beacon in beacons:
+            start = time.perf_counter()
+            data = bytes(str(beacon.position[0]) + ',' + str(beacon.position[1]) +
+                         ',' + '%.1f' % beacon.load, 'utf-8')
+            samples.append(time.perf_counter() - start)
+            size += len(data)
+
+            start = time.perf_counter()
+            _x, _y, _load = data.decode('utf-8').split(',')
+            (float(_x), float(_y)), float(_load)
+            parse.append(time.perf_counter() - start)
+
+        report('ascii encode extent=%d' % extent, samples)
+        report('ascii parse bytes=%d' % (size // len(beacons)), parse)
+
+        samples, parse, size = [], [], 0
+        for beacon in beacons:
+            start = time.perf_counter()
+            data = beacon.to_bytes()
+            samples.append(time.perf_counter() - start)
+            size += len(data)
+
+            start = time.perf_counter()
+            Beacon.from_bytes(data)
+            parse.append(time.perf_counter() - start)
+
+        report('struct encode extent=%d' % extent, samples)
+        report('struct parse bytes=%d' % (size // len(beacons)), parse)
+
+
+def bench_bundle(args):
+    """
+    Delivery over an intermittent, lossy link: sending each payload once as it's queued
+    versus holding it as a bundle until the next hop takes custody of it.
+    Sizes are the mean length, in ticks of 100ms, of the contacts and of the gaps between them.
+    """
+    for mean in args.sizes:
+        rng = random.Random(args.seed)
+        contact, up = [], True
+        while len(contact) < args.ticks:
+            contact += [up] * max(1, int(rng.expovariate(1 / mean)))
+            up = not up
+        contact = contact[:args.ticks]
+
+        store, relay = BundleStore(lifetime=args.lifetime), BundleStore(lifetime=args.lifetime)
+        delivered = {'once': 0, 'bundle': set()}
+        sent = {'once': 0, 'bundle': 0}
+
+        for tick in range(args.ticks):
+            now = tick / 10
+            data = Payload(ACTIONS, b'', 'lbby', 'plyr', tick, bytes(16), bytes(16), 9999).to_bytes()
+
+            sent['once'] += 1
+            delivered['once'] += contact[tick] and rng.random() >= args.loss
+
+            store.add(('::1', 9999), data, now)
+            if contact[tick]:
+                for bundle in store.due(('::1', 9999), now):
+                    sent['bundle'] += 1
+                    if rng.random() >= args.loss:
+                        relay.custody(('::2', 9999), bundle.data, now)
+                        delivered['bundle'].add(bundle.key)
+
+                for _, keys in relay.drain_signals():
+                    sent['bundle'] += 1
+                    if rng.random() >= args.loss:
+                        store.release(split_keys(keys))
+            store.expire(now)
+
+        print('contacts of %3d ticks, up %.0f%%' % (mean, 100 * sum(contact) / args.ticks))
+        for label in ('once', 'bundle'):
+            count = delivered[label] if label == 'once' else len(delivered[label])
+            print('  %-7s delivered=%5.1f%%  datagrams per delivery=%.2f' % (
+                label, 100 * count / args.ticks, sent[label] / max(count, 1)))
+
+
+def bench_bundlelog(args):
+    """
+    Durable bundle store: cost of taking bundles into custody, and time to recover
+    them after a restart. Sizes are the number of bundles taken, half are released.
+    """
+    for count in args.sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            store = BundleStore(lifetime=3600, capacity=count,
+                                log=BundleLog(directory, args.segment << 10))
+            data = [Payload(ACTIONS, bytes(args.payload), 'lbby', 'plyr', i,
+                            bytes(16), bytes(16), 9999).to_bytes() for i in range(count)]
+
+            samples = []
+            for d in data:
+                start = time.perf_counter()
+                store.add(('::1', 9999), d)
+                samples.append(time.perf_counter() - start)
+            report('add n=%d' % count, samples)
+
+            store.release(list(store.keys)[::2])
+            size = store.log.size
+            store.log.close()
+
+            samples = []
+            for _ in range(max(args.ticks // 100, 1)):
+                start = time.perf_counter()
+                recovered = BundleStore(lifetime=3600, log=BundleLog(directory, args.segment << 10))
+                samples.append(time.perf_counter() - start)
+                recovered.log.close()
+
+            report('recover n=%d live=%d log=%.1fMB' % (count, len(recovered), size / 2**20), samples)
+
+
+def bench_spatial(args):
+    """
+    Cost of picking a relay: a scan over every known node versus the spatial index.
+    Sizes are the number of nodes, spread over a square scenario of side --extent.
+    """
+    for nodes in args.sizes:
+        rng = random.Random(args.seed)
+        positions = {('fd00::%x' % i, 9999): (rng.uniform(0, args.extent), rng.uniform(0, args.extent))
+                     for i in range(nodes)}
+        index = SpatialIndex(args.cell)
+        for addr, pos in positions.items():
+            index.update(addr, pos)
+
+        queries = [(rng.uniform(0, args.extent), rng.uniform(0, args.extent))
+                   for _ in range(args.ticks)]
+
+        for label, nearest in (
+                ('scan', lambda q: min(positions, key=lambda a: get_node_distance(q, positions[a]))),
+                ('index', lambda q: index.nearest(q)[0][1])):
+            samples = []
+            for q in queries:
+                start = time.perf_counter()
+                nearest(q)
+                samples.append(time.perf_counter() - start)
+
+            report('%s n=%d' % (label, nodes), samples)
+
+
+def bench_neighbors(args):
+    """
+    Relay selection under churn: nodes kept forever versus dropped once they go quiet.
+    Sizes are the number of nodes in range at any time, each tick one of them leaves
+    for good and a new one takes its place. A tick is a second of beacons from every
+    node followed by a relay pick.
+    """
+    for nodes in args.sizes:
+        rng = random.Random(args.seed)
+        forever = SpatialIndex(args.cell)
+        table = NeighborTable(1.0, cell=args.cell)
+        live = list(range(nodes))
+        last = nodes
+
+        def place():
+            return (rng.uniform(0, args.extent), rng.uniform(0, args.extent))
+
+        samples = {'forever': [], 'table': []}
+        stale = {'forever': 0, 'table': 0}
+
+        for tick in range(args.ticks):
+            now = float(tick)
+            live[rng.randrange(nodes)] = last
+            last += 1
+            beacons = {('fd00::%x' % id, 9999): place() for id in live}
+            q = place()
+
+            # a second of beacons, then a relay pick
+            start = time.perf_counter()
+            for addr, pos in beacons.items():
+                forever.update(addr, pos)
+            picked = forever.nearest(q)[0][1]
+            samples['forever'].append(time.perf_counter() - start)
+            stale['forever'] += picked not in beacons
+
+            start = time.perf_counter()
+            for addr, pos in beacons.items():
+                table.beacon(addr, pos, 0, now=now)
+            picked = table.nearest(q, now=now)[0][1].address
+            samples['table'].append(time.perf_counter() - start)
+            stale['table'] += picked not in beacons
+
+        for label in ('forever', 'table'):
+            kept = len(forever) if label == 'forever' else len(table)
+            report('%s n=%d kept=%d stale=%.0f%%' % (label, nodes, kept,
+                                                    100 * stale[label] / args.ticks), samples[label])
+
+
+def bench_routing(args):
+    """
+    DTN routing strategies over mobile nodes on a random waypoint walk, relaying the
+    payloads they send to the server through a gateway in the middle of the area.
+    Sizes are the number of mobile nodes, a tick is a second. Beacons reach the nodes
+    MCAST_HOPS away, the bundles are only ever handed to the nodes in contact.
+    """
+    server, gateway = ('fd00::1', 9999), ('fd00::2', 9999)
+    center = (args.extent / 2, args.extent / 2)
+
+    for nodes in args.sizes:
+        print('%d mobile nodes' % nodes)
+
+        for name in args.routers:
+            rng = random.Random(args.seed)
+            addrs = [('fd00::%x' % (0x100 + i), 9999) for i in range(nodes)]
+            pos = {a: (rng.uniform(0, args.extent), rng.uniform(0, args.extent)) for a in addrs}
+            goal = dict(pos)
+            pos[gateway] = center
+            kwargs = {'copies': args.copies} if routers[name] is SprayAndWait else {}
+            nets = {a: routers[name](a, NeighborTable(1.0), NeighborTable(1.0),
+                                     BundleStore(lifetime=args.lifetime), server, **kwargs)
+                    for a in addrs}
+            created, delivered = {}, {}
+            sent = {'data': 0, 'control': 0}
+
+            def receive(hop, prev_hop, data, now):
+                """
+                A bundle handed over, mirrors the mobile input of the client.
+                """
+                key = bundle_key(data)
+                sent['data'] += 1
+
+                if hop == gateway:
+                    delivered.setdefault(key, now)
+                    taken = True
+                else:
+                    router = nets[hop]
+                    taken = (not router.single and router.bundles.seen(data)) or \
+                        router.bundles.add(server, data, now) is not None
+                    if taken:
+                        router.bundles.custody(prev_hop, data, now)
+                        router.received(prev_hop, key)
+                        router.bundles.drain_signals()
+
+                if taken:
+                    sent['control'] += 1
+                    if nets[prev_hop].taken(hop, key, now):
+                        nets[prev_hop].bundles.release([key])
+
+            for tick in range(args.ticks):
+                now = float(tick)
+
+                for a in addrs:
+                    (x, y), (gx, gy) = pos[a], goal[a]
+                    d = get_node_distance(pos[a], goal[a])
+                    if d <= args.speed:
+                        pos[a] = goal[a]
+                        goal[a] = (rng.uniform(0, args.extent), rng.uniform(0, args.extent))
+                    else:
+                        pos[a] = (x + (gx - x) * args.speed / d, y + (gy - y) * args.speed / d)
+
+                # beacons, flooded MCAST_HOPS hops away
+                links = {a: [b for b in pos if b != a and get_node_distance(pos[a], pos[b]) <= args.range]
+                         for a in pos}
+                for a in addrs:
+                    hops, frontier = {a: -1}, [a]
+                    for hop in range(MCAST_HOPS):
+                        frontier = [b for f in frontier for b in links[f] if b not in hops]
+                        hops.update((b, hop) for b in frontier)
+                    router = nets[a]
+                    for b, hop in hops.items():
+                        if b == gateway:
+                            router.gateways.beacon(b, pos[b], hop, now=now)
+                        if b != a:
+                            router.neighbors.beacon(b, pos[b], hop, now=now)
+
+                    closest = router.gateways.nearest(pos[a], now=now)
+                    router.position = pos[a]
+                    if closest and closest[0][1].hops > 0:
+                        relay = router.neighbors.toward(pos[a], gateway, now)
+                        router.preferred = gateway if relay is None else relay[1].address
+                    else:
+                        router.preferred = gateway if closest else None
+
+                for a in addrs:
+                    router = nets[a]
+                    if tick % args.interval == 0:
+                        data = Payload(ACTIONS, b'', 'lbby', 'plyr', tick, inet_pton(AF_INET6, a[0]),
+                                       inet_pton(AF_INET6, server[0]), 9999).to_bytes()
+                        key = router.bundles.add(server, data, now)
+                        if key is not None:
+                            router.created(key)
+                            created[key] = now
+
+                    contacts = router.contacts(now)
+                    for bundle in router.bundles.due(server, now, mark=False):
+                        hops = router.targets(bundle, contacts)
+                        for hop in hops:
+                            # a node out of contact is reached across the nodes in between
+                            sent['data'] += router.neighbors[hop].hops if hop in router.neighbors else 0
+                            receive(hop, a, bundle.data, now)
+                        if hops:
+                            router.bundles.mark(bundle.key, now)
+
+                    for hop, data in router.control(contacts, now):
+                        sent['control'] += 1
+                        nets[hop].on_control(a, data)
+
+                    router.bundles.expire(now)
+
+            latency = [delivered[k] - created[k] for k in delivered]
+            print('  %-10s delivered=%5.1f%%  latency=%6.1fs  data per delivery=%6.2f  control=%d' % (
+                name, 100 * len(delivered) / max(len(created), 1),
+                statistics.mean(latency) if latency else 0.0,
+                sent['data'] / max(len(delivered), 1), sent['control']))
+
+
+def bench_explosion(args):
+    """
+    Cost of a tick of an authoritative lobby with bombs going off: lighting the bombs
+    dropped, then detonating those that are due, chains included, and popping the
+    boxes and killing the players caught in the blasts.
+    """
+    for size in args.sizes:
+        for players in args.players:
+            gs = board(size, args.seed, args.density)
+            gs.range = args.range - 1
+            rng = random.Random(args.seed)
+            floor = template(size, size).positions(FLOOR)
+            # built once per board size, keep it out of the samples
+            table(size, size, gs.range)
+
+            samples, effects = [], 0
+            for _ in range(args.ticks):
+                # every player drops a bomb each tick
+                bombs = [Change((1, 1, id + PLAYER_TILE), (*rng.choice(floor), BOMB))
+                         for id in range(1, players + 1)]
+
+                start = time.perf_counter()
+                gs.light(bombs)
+                effects += len(gs.advance())
+                samples.append(time.perf_counter() - start)
+
+            report('explosion %dx%d p=%d effects=%d' % (size, size, players, effects), samples)
+
+
+def bench_replay(args):
+    """
+    Replay speed: a recorded game is re-executed on a headless game state.
+    Recordings are synthesized from random walks unless a file is given.
+    """
+    if args.file is not None:
+        replay(args.file, args.file)
+        return
+
+    for size in args.sizes:
+        for players in args.players:
+            gs = board(size, args.seed, args.density)
+            ticks = walks(size, players, args.ticks, random.Random(args.seed))
+            fd, path = tempfile.mkstemp(suffix='.bdr')
+            os.close(fd)
+
+            try:
+                writer = ReplayWriter(path, codecs[args.codec])
+                writer.snapshot(0, gs)
+                for tick, changes in enumerate(ticks, 1):
+                    for change in changes:
+                        gs._apply_change(change)
+                    writer.changes(tick, changes, gs)
+                writer.close()
+
+                replay(path, '%s %dx%d p=%d' % (args.codec, size, size, players))
+            finally:
+                os.remove(path)
+
+
+def replay(path: str, label: str):
+    """
+    Replays a file, printing the replay speed and whether the digests matched the recorded ones.
+    """
+    engine = ReplayEngine(path)
+    start = time.perf_counter()
+    engine.run()
+    elapsed = time.perf_counter() - start
+
+    print('replay %-24s ticks=%-6d changes=%-7d %10.0f ticks/s  %8d bytes  mismatches=%d' % (
+        label, engine.ticks, engine.changes, engine.ticks / elapsed,
+        os.path.getsize(path), len(engine.mismatches)))
+
+
+def bench_path(args):
+    """
+    Cost of the AI picking its next path.
+    """
+    # the AI pulls in pygame, only import it when needed
+    from client.algorithm import Algorithm
+    from client.enemy import Enemy
+
+    algorithms = {
+        'dfs': [Algorithm.DFS],
+        'dijkstra': [Algorithm.DIJKSTRA],
+        'both': [Algorithm.DFS, Algorithm.DIJKSTRA],
+    }[args.algorithm]
+
+    for size in args.sizes:
+        for players in args.players:
+            gs = board(size, args.seed, args.density)
+            grid = gs.get_state().columns()
+
+            for alg in algorithms:
+                enemies = [Enemy(*gs.spawns[id], alg, None, id)
+                           for id in range(1, players + 1)]
+
+                samples = []
+                for _ in range(args.ticks):
+                    start = time.perf_counter()
+                    for en in enemies:
+                        en.movement_path = []
+                        if alg is Algorithm.DFS:
+                            en.dfs(en.create_grid(grid, [], [], enemies))
+                        else:
+                            en.dijkstra(en.create_grid_dijkstra(
+                                grid, [], [], enemies))
+                    samples.append(time.perf_counter() - start)
+
+                report('%s %dx%d p=%d' % (alg.name.lower(), size, size, players), samples)
+
+
+if __name__ == '__main__':
+    """
+    Benchmark the game logic as the board and the number of players grow.
+    """
+    # shared by every benchmark, given after the benchmark's name
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('-s', '--sizes', type=int, nargs='+', default=[13, 25, 51, 101],
+                        help='Board sizes to run, all must be odd.')
+    common.add_argument('-p', '--players', type=int, nargs='+', default=[1, 2, 4],
+                        choices=range(1, 5), help='Player counts to run.')
+    common.add_argument('-t', '--ticks', type=int, default=1000)
+    common.add_argument('--seed', type=int, default=0)
+    common.add_argument('--density', type=float, default=0.7)
+
+    parser = argparse.ArgumentParser(description='Bomberdude benchmarks.')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    sub.add_parser('tick', parents=[common],
+                   help='Decode, apply and encode a tick of changes.')
+    sub.add_parser('validate', parents=[common],
+                   help='A tick of changes, with and without validation.')
+    interest = sub.add_parser('interest', parents=[common],
+                              help='Outbound traffic with area-of-interest filtering.')
+    interest.add_argument('-r', '--radius', type=int, default=6)
+    sub.add_parser('relay', parents=[common],
+                   help='Gateway relay of a datagram, decoded or peeked.')
+    gateways = sub.add_parser('gateways', parents=[common],
+                              help='Uplink over several gateways, spread and failover.')
+    gateways.add_argument('-k', '--spread', type=int, default=2,
+                          help='Number of gateways the uplink is spread over.')
+    uplink = sub.add_parser('uplink', parents=[common],
+                            help='Gateway uplink to a lobby, relayed or batched.')
+    uplink.add_argument('--every', type=float, default=3.0,
+                        help='Mean ticks between the actions of a node.')
+    sub.add_parser('dedupe', parents=[common],
+                   help='Lobby receive path, with and without duplicate suppression.')
+    sub.add_parser('beacon', parents=[common],
+                   help='Beacon bodies, ASCII or packed.')
+    bundle = sub.add_parser('bundle', parents=[common],
+                            help='Delivery over an intermittent link, sent once or held as bundles.')
+    bundle.add_argument('--loss', type=float, default=0.1)
+    bundle.add_argument('--lifetime', type=float, default=30.0)
+    bundlelog = sub.add_parser('bundlelog', parents=[common],
+                               help='Durable bundle store, custody and recovery.')
+    bundlelog.add_argument('--payload', type=int, default=512,
+                           help='Size of the payloads, in bytes.')
+    bundlelog.add_argument('--segment', type=int, default=4096,
+                           help='Size of the segments, in KiB.')
+    spatial = sub.add_parser('spatial', parents=[common],
+                             help='Relay selection over many nodes, scan or spatial index.')
+    spatial.add_argument('-e', '--extent', type=float, default=3000.0)
+    spatial.add_argument('-c', '--cell', type=float, default=100.0)
+    neighbors = sub.add_parser('neighbors', parents=[common],
+                               help='Relay selection under churn, with and without expiry.')
+    neighbors.add_argument('-e', '--extent', type=float, default=3000.0)
+    neighbors.add_argument('-c', '--cell', type=float, default=100.0)
+    routing = sub.add_parser('routing', parents=[common],
+                             help='Delivery to the server, by DTN routing strategy.')
+    routing.add_argument('-r', '--routers', nargs='+', choices=list(routers), default=list(routers))
+    routing.add_argument('-e', '--extent', type=float, default=1000.0)
+    routing.add_argument('--range', type=float, default=150.0)
+    routing.add_argument('--speed', type=float, default=10.0,
+                         help='Speed of the nodes, per tick.')
+    routing.add_argument('--interval', type=int, default=5,
+                         help='Ticks between the payloads of a node.')
+    routing.add_argument('--lifetime', type=float, default=300.0)
+    routing.add_argument('--copies', type=int, default=8)
+    explosion = sub.add_parser('explosion', parents=[common],
+                               help='Authoritative bomb ticks: fuses, blasts and their effects.')
+    explosion.add_argument('-r', '--range', type=int, default=3)
+    path = sub.add_parser('path', parents=[common], help='AI path planning.')
+    path.add_argument('-a', '--algorithm', choices=['dfs', 'dijkstra', 'both'], default='both')
+    replays = sub.add_parser('replay', parents=[common], help='Headless replay of a recorded game.')
+    replays.add_argument('-c', '--codec', choices=list(codecs), default='zlib')
+    replays.add_argument('-f', '--file', type=str, default=None,
+                         help='Replay file recorded by a lobby, synthesized if not given.')
+
+    args = parser.parse_args()
+
+    {
+        'tick': bench_tick,
+        'validate': bench_validate,
+        'interest': bench_interest,
+        'relay': bench_relay,
+        'gateways': bench_gateways,
+        'uplink': bench_uplink,
+        'dedupe': bench_dedupe,
+        'beacon': bench_beacon,
+        'bundle': bench_bundle,
+        'bundlelog': bench_bundlelog,
+        'spatial': bench_spatial,
+        'neighbors': bench_neighbors,
+        'routing': bench_routing,
+        'explosion': bench_explosion,
+        'path': bench_path,
+        'replay': bench_replay,
+    }[args.bench](args)
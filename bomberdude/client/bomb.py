@@ -1,3 +1,6 @@
+from common.blast import table
+
+
 class Bomb:
     frame = 0
 
@@ -20,38 +23,7 @@ class Bomb:
             self.frame = 1
 
     def get_range(self, map):
-
-        self.sectors.append([self.posX, self.posY])
-
-        for x in range(1, self.range):
-            if map[self.posX + x][self.posY] == 1:
-                break
-            elif map[self.posX+x][self.posY] == 0 or map[self.posX-x][self.posY] == 3:
-                self.sectors.append([self.posX+x, self.posY])
-            elif map[self.posX+x][self.posY] == 2:
-                self.sectors.append([self.posX+x, self.posY])
-                break
-        for x in range(1, self.range):
-            if map[self.posX - x][self.posY] == 1:
-                break
-            elif map[self.posX-x][self.posY] == 0 or map[self.posX-x][self.posY] == 3:
-                self.sectors.append([self.posX-x, self.posY])
-            elif map[self.posX-x][self.posY] == 2:
-                self.sectors.append([self.posX-x, self.posY])
-                break
-        for x in range(1, self.range):
-            if map[self.posX][self.posY + x] == 1:
-                break
-            elif map[self.posX][self.posY+x] == 0 or map[self.posX][self.posY+x] == 3:
-                self.sectors.append([self.posX, self.posY+x])
-            elif map[self.posX][self.posY+x] == 2:
-                self.sectors.append([self.posX, self.posY+x])
-                break
-        for x in range(1, self.range):
-            if map[self.posX][self.posY - x] == 1:
-                break
-            elif map[self.posX][self.posY-x] == 0 or map[self.posX][self.posY-x] == 3:
-                self.sectors.append([self.posX, self.posY-x])
-            elif map[self.posX][self.posY - x] == 2:
-                self.sectors.append([self.posX, self.posY - x])
-                break
+        # the range counts the bomb's own cell
+        rays = table(len(map), len(map[0]), self.range - 1)
+        self.sectors = [list(c) for c in rays.blast(
+            self.posX, self.posY, lambda x, y: map[x][y])]
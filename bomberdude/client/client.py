@@ -38,7 +38,8 @@ class Client:
                                  node_path=node_path, byte_address=node_ipv6)
         else:
             self.cli = NetClient((self.args.address, DEFAULT_PORT),
-                                 node_path=node_path, byte_address=node_ipv6, gateway_addr=(args.gateway, DEFAULT_PORT),is_mobile=True)
+                                 node_path=node_path, byte_address=node_ipv6, gateway_addr=(args.gateway, DEFAULT_PORT),is_mobile=True,
+                                 routing=args.routing)
 
     def change_player(self, value, c):
         #global player_alg
@@ -1,6 +1,5 @@
 from ipaddress import ip_address
 from socket import AF_INET6, inet_pton
-from matplotlib.pyplot import grid
 import pygame
 import random
 from .bomb import Bomb
@@ -344,7 +343,7 @@ class Enemy:
                 return
 
             for i in range(len(self.dire)):
-                if current.x + self.dire[i][0] < len(grid) and current.y + self.dire[i][1] < len(grid):
+                if current.x + self.dire[i][0] < len(grid) and current.y + self.dire[i][1] < len(grid[0]):
                     if grid[current.x + self.dire[i][0]][current.y + self.dire[i][1]].reach \
                             and grid[current.x + self.dire[i][0]][current.y + self.dire[i][1]] not in visited:
                         if grid[current.x + self.dire[i][0]][current.y + self.dire[i][1]] in open_list:
@@ -375,7 +374,7 @@ class Enemy:
 
 
     def create_grid(self, map, bombs, explosions, enemys):
-        grid = [[0] * len(map) for r in range(len(map))]
+        grid = [[0] * len(map[0]) for r in range(len(map))]
 
         # 0 - safe
         # 1 - unsafe
@@ -410,14 +409,14 @@ class Enemy:
         return grid
 
     def create_grid_dijkstra(self, map, bombs, explosions, enemys):
-        grid = [[None] * len(map) for r in range(len(map))]
+        grid = [[None] * len(map[0]) for r in range(len(map))]
 
         # 0 - safe
         # 1 - destroyable
         # 2 - unreachable
         # 3 - unsafe
         for i in range(len(map)):
-            for j in range(len(map)):
+            for j in range(len(map[i])):
                 if map[i][j] == 0:
                     grid[i][j] = Node(i, j, True, 1, 0)
                 elif map[i][j] == 2:
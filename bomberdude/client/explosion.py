@@ -1,8 +1,9 @@
 from ipaddress import ip_address
 from socket import AF_INET6, inet_pton
 from typing import Tuple
+from common.blast import table
 from common.payload import ACTIONS, Payload
-from common.state import Change, bytes_from_changes 
+from common.state import BOX, FLOOR, Change, bytes_from_changes 
 from common.types import DEFAULT_PORT
 
 class Explosion:
@@ -21,8 +22,9 @@ class Explosion:
     
     def send_pop_box(self,box_sectors):
         list_changes = []
-        for box in box_sectors:
-            list_changes.append(Change((int(box[1]),int(box[2]),int(box[0])),(int(box[1]),int(box[2]),int(box[0]))))
+        # boxes are popped by position, their ids don't fit a tile on large maps
+        for x, y in box_sectors:
+            list_changes.append(Change((x, y, BOX), (x, y, FLOOR)))
         
         destination = inet_pton(AF_INET6, ip_address(self.cli.lobby_addr[0]).exploded )
         
@@ -40,33 +42,36 @@ class Explosion:
     def explode(self, map, bombs, b):
 
         self.bomber = b.bomber
-        self.sectors.extend(b.sectors)
         bombs.remove(b)
-        self.bomb_chain(bombs, map)
 
-    def bomb_chain(self, bombs, map):
+        at = {(x.posX, x.posY): x for x in bombs}
 
-        for s in self.sectors:
-            for x in bombs:
-                if x.posX == s[0] and x.posY == s[1]:
+        def detonate(x, y):
+            chained = at.pop((x, y), None)
+            if chained is None:
+                return False
+            bombs.remove(chained)
+            map[x][y] = 0
+            chained.bomber.bomb_limit += 1
+            return True
 
-                    map[x.posX][x.posY] = 0
-                    x.bomber.bomb_limit += 1
-                    self.explode(map, bombs, x)
+        # chained bombs are resolved by the worklist, not by recursion
+        rays = table(len(map), len(map[0]), self.range - 1)
+        self.sectors.extend([list(c) for c in rays.chain(
+            [(b.posX, b.posY)], lambda x, y: map[x][y], detonate)])
 
-    def clear_sectors(self, map,boxes):
+    def clear_sectors(self, map):
         box_sector = []
         
         for i in self.sectors:
-            if map[i[0]][i[1]] == 2:
-                t = [i[0],i[1]]
-                key = list(boxes.keys())[list(boxes.values()).index(t)]
+            if map[i[0]][i[1]] == BOX:
+                # the game state only drops the box once the server echoes the pop,
+                # so it keeps hashing the same changes as the server
+                key = self.cli.gamestate.box_ids.get((i[0], i[1]))
                 
                 print('remove block: ',key)
-                if key in self.cli.gamestate.boxes:
-                    self.cli.gamestate.boxes.pop(key)
-                    box_sector.append((key,i[0],i[1]))
-                    #self.send_pop_box(key,i[0],i[1])
+                if key is not None:
+                    box_sector.append((i[0],i[1]))
             map[i[0]][i[1]] = 0
         self.send_pop_box(box_sector)
             
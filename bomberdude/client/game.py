@@ -5,13 +5,12 @@ import pygame
 import sys
 import random
 import time
-from common.state import state
 from .player import Player
 from .explosion import Explosion
 from .enemy import Enemy
 from .algorithm import Algorithm
 from common.payload import ACTIONS, KALIVE, REJOIN, STATE, Payload, ACCEPT, LEAVE, JOIN, REDIRECT, REJECT
-from common.state import Change
+from common.state import BOX, Change, template
 from common.types import DEFAULT_PORT, TIMEOUT
 from threading import Thread
 
@@ -19,7 +18,7 @@ TILE_WIDTH = 40
 TILE_HEIGHT = 40
 
 WINDOW_WIDTH = 13 * TILE_WIDTH
-WINDOW_HEIGHT = 13 * TILE_HEIGHT
+WINDOW_HEIGHT = 13 * TILE_HEIGHT  # resized to the board once the game starts
 
 BACKGROUND = (107, 142, 35)
 
@@ -35,22 +34,8 @@ ene_blocks = []
 bombs = []
 explosions = []
 
-#grid = state
-
-grid = [[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-        [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-        [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]]
-       
+# columns of the board, grid[x][y], set up once the server sends the map
+grid = []
 
 grass_img = None
 block_img = None
@@ -93,8 +78,14 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
     global show_path
     show_path = path
 
+    global WINDOW_WIDTH
+    global WINDOW_HEIGHT
+    width, height = cli.gamestate.size
+    WINDOW_WIDTH = width * TILE_WIDTH
+    WINDOW_HEIGHT = height * TILE_HEIGHT
+
     global s
-    s = pygame.display.set_mode((13 * TILE_WIDTH, 13 * TILE_HEIGHT))
+    s = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
     pygame.display.set_caption('Bomberdude')
 
     global clock
@@ -135,16 +126,17 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
     global en0
 
     player_alg = Algorithm.DFS
+    spawns = cli.gamestate.spawns
     
     if cli.player_id == 1:
-        player = Player(1,1)
+        player = Player(*spawns[1])
         if player_alg is Algorithm.PLAYER:
             player.load_animations('', scale)
             ene_blocks.append(player)
             
             
         elif player_alg is not Algorithm.NONE:
-            en0 = Enemy(1, 1, player_alg,cli,1)
+            en0 = Enemy(*spawns[1], player_alg,cli,1)
             en0.load_animations('', scale)
             enemy_list.append(en0)
             ene_blocks.append(en0)
@@ -152,29 +144,29 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
         else:
             player.life = False
             
-        en1 = Enemy(11, 1, Algorithm.REMOTE,cli,2)
+        en1 = Enemy(*spawns[2], Algorithm.REMOTE,cli,2)
         en1.load_animations('2', scale)
         enemy_list.append(en1)
         ene_blocks.append(en1)
 
-        en2 = Enemy(1, 11, Algorithm.REMOTE,cli,3)
+        en2 = Enemy(*spawns[3], Algorithm.REMOTE,cli,3)
         en2.load_animations('1', scale)
         enemy_list.append(en2)
         ene_blocks.append(en2)
 
-        en3 = Enemy(11, 11, Algorithm.REMOTE,cli,4)
+        en3 = Enemy(*spawns[4], Algorithm.REMOTE,cli,4)
         en3.load_animations('3', scale)
         enemy_list.append(en3)
         ene_blocks.append(en3)
             
     elif cli.player_id == 2:
-        player = Player(11,1)
+        player = Player(*spawns[2])
         if player_alg is Algorithm.PLAYER:
             player.load_animations('2', scale)
             ene_blocks.append(player)
             
         elif player_alg is not Algorithm.NONE:
-            en0 = Enemy(11, 1, player_alg,cli,2)
+            en0 = Enemy(*spawns[2], player_alg,cli,2)
             en0.load_animations('2', scale)
             enemy_list.append(en0)
             ene_blocks.append(en0)
@@ -182,29 +174,29 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
         else:
             player.life = False
             
-        en1 = Enemy(1, 1, Algorithm.REMOTE,cli,1)
+        en1 = Enemy(*spawns[1], Algorithm.REMOTE,cli,1)
         en1.load_animations('', scale)
         enemy_list.append(en1)
         ene_blocks.append(en1)
 
-        en2 = Enemy(1, 11, Algorithm.REMOTE,cli,3)
+        en2 = Enemy(*spawns[3], Algorithm.REMOTE,cli,3)
         en2.load_animations('1', scale)
         enemy_list.append(en2)
         ene_blocks.append(en2)
 
-        en3 = Enemy(11, 11, Algorithm.REMOTE,cli,4)
+        en3 = Enemy(*spawns[4], Algorithm.REMOTE,cli,4)
         en3.load_animations('3', scale)
         enemy_list.append(en3)
         ene_blocks.append(en3)
 
     elif cli.player_id == 3:
-        player = Player(1,11)
+        player = Player(*spawns[3])
         if player_alg is Algorithm.PLAYER:
             player.load_animations('1', scale)
             ene_blocks.append(player)
             
         elif player_alg is not Algorithm.NONE:
-            en0 = Enemy(1, 11, player_alg,cli,3)
+            en0 = Enemy(*spawns[3], player_alg,cli,3)
             en0.load_animations('1', scale)
             enemy_list.append(en0)
             ene_blocks.append(en0)
@@ -212,29 +204,29 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
         else:
             player.life = False
             
-        en1 = Enemy(11, 1, Algorithm.REMOTE,cli,2)
+        en1 = Enemy(*spawns[2], Algorithm.REMOTE,cli,2)
         en1.load_animations('2', scale)
         enemy_list.append(en1)
         ene_blocks.append(en1)
 
-        en2 = Enemy(1, 1, Algorithm.REMOTE,cli,1)
+        en2 = Enemy(*spawns[1], Algorithm.REMOTE,cli,1)
         en2.load_animations('', scale)
         enemy_list.append(en2)
         ene_blocks.append(en2)
 
-        en3 = Enemy(11, 11, Algorithm.REMOTE,cli,4)
+        en3 = Enemy(*spawns[4], Algorithm.REMOTE,cli,4)
         en3.load_animations('3', scale)
         enemy_list.append(en3)
         ene_blocks.append(en3)
 
     elif cli.player_id == 4:
-        player = Player(11,11)
+        player = Player(*spawns[4])
         if player_alg is Algorithm.PLAYER:
             player.load_animations('3', scale)
             ene_blocks.append(player)
             
         elif player_alg is not Algorithm.NONE:
-            en0 = Enemy(11, 11, player_alg,cli,4)
+            en0 = Enemy(*spawns[4], player_alg,cli,4)
             en0.load_animations('3', scale)
             enemy_list.append(en0)
             ene_blocks.append(en0)
@@ -242,17 +234,17 @@ def game_init(path, player_alg, en1_alg, en2_alg, en3_alg, scale,cli,args):
         else:
             player.life = False
             
-        en1 = Enemy(11, 1, Algorithm.REMOTE,cli,2)
+        en1 = Enemy(*spawns[2], Algorithm.REMOTE,cli,2)
         en1.load_animations('2', scale)
         enemy_list.append(en1)
         ene_blocks.append(en1)
 
-        en2 = Enemy(1, 11, Algorithm.REMOTE,cli,3)
+        en2 = Enemy(*spawns[3], Algorithm.REMOTE,cli,3)
         en2.load_animations('1', scale)
         enemy_list.append(en2)
         ene_blocks.append(en2)
 
-        en3 = Enemy(1, 1, Algorithm.REMOTE,cli,1)
+        en3 = Enemy(*spawns[1], Algorithm.REMOTE,cli,1)
         en3.load_animations('', scale)
         enemy_list.append(en3)
         ene_blocks.append(en3)
@@ -335,12 +327,14 @@ def draw():
 def generate_map(cli):
     if not cli.gamestate.boxes:
         time.sleep(0.1)
-    
+
+    global grid
+    grid = template(*cli.gamestate.size).columns()
     boxes.update(cli.gamestate.boxes)
     
     
     for box in cli.gamestate.boxes.items():
-        grid[box[1][0]][box[1][1]] = 2
+        grid[box[1][0]][box[1][1]] = BOX
     return
 
 def sendAction(cli,action,x,y):
@@ -460,7 +454,7 @@ def update_bombs(cli,dt):
             grid[b.posX][b.posY] = 0
             exp_temp = Explosion(b.posX, b.posY, b.range,cli)
             exp_temp.explode(grid, bombs, b)
-            exp_temp.clear_sectors(grid,boxes)
+            exp_temp.clear_sectors(grid)
             sync_boxes(cli)
             explosions.append(exp_temp)
             
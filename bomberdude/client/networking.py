@@ -2,18 +2,22 @@ from __future__ import annotations
 from common.state import Change, GameState, change_from_bytes, parse_payload
 from functools import cached_property
 from ipaddress import ip_address
-from common.core_utils import get_node_distance, get_node_xy
-from common.payload import ACK, KALIVE, REJOIN, Payload, ACCEPT, LEAVE, JOIN, REJECT
+from common.core_utils import get_node_xy
+from common.payload import ACK, CUSTODY, KALIVE, REJOIN, ROUTING, Payload, ACCEPT, LEAVE, JOIN, REJECT
+from common.beacon import Beacon
+from common.bundle import BundleStore, bundle_key, split_keys
 from common.cache import Cache
+from common.neighbors import Neighbor, NeighborTable, enable_hops, recv_beacon
+from common.routing import Router, routers
 from dataclasses import dataclass, field
 import logging
 import time
 import struct
-from typing import Tuple, List
+from typing import Optional, Tuple, List
 from threading import Thread, Lock
 from socket import IPPROTO_UDP, IPV6_JOIN_GROUP, getaddrinfo, socket, AF_INET6, SOCK_DGRAM, SOL_SOCKET, SO_REUSEADDR, timeout, IPPROTO_IPV6, IPV6_MULTICAST_HOPS, inet_pton
 import json
-from common.types import DEFAULT_PORT, MCAST_GROUP, MCAST_PORT, TIMEOUT, Address, MobileMap, MobileMetrics, Position
+from common.types import BEACON_INTERVAL, DEFAULT_PORT, GATEWAY_BEACON_INTERVAL, KALIVE_INTERVAL, MCAST_GROUP, MCAST_HOPS, MCAST_PORT, TIMEOUT, Address, Position
 
 InboundQueue = List[Change]
 """A list of changes to be applied to the game state."""
@@ -60,6 +64,8 @@ class NetClient(Thread):
     """Cache used to store the last sent payloads."""
     cache_timeout: int = field(default=10)
     """The timeout, in seconds, for cache entries to be removed."""
+    bundles: BundleStore = field(init=False)
+    """Payloads held until a node in contact takes custody of them. Used by mobile nodes only."""
     running: bool = field(init=False, default=False)
     """Whether the client is running."""
     player_id: int = field(init=False, default=0)
@@ -69,30 +75,40 @@ class NetClient(Thread):
     started: bool = field(init=False, default=False)
     """Whether a game is currently in progress."""
     last_kalive: float = field(init=False, default=0.0)
-    """The time of the last KALIVE message."""
+    """The time of the last packet received from the lobby."""
+    last_sent: float = field(init=False, default=0.0)
+    """The time of the last packet sent to the lobby."""
     lobby_addr: Address = field(init=False)
     """The lobby's address."""
     seq_num: int = field(init=False, default=0)
     """Sequence number for the client"""
+    beacon_seq: int = field(init=False, default=0)
+    """The number of the next beacon, numbered apart from the payloads so lost beacons can be counted."""
 
     # This only exists in mobile clients
-    mobile_map: MobileMap = field(init=False, default_factory=dict)
-    """Information related to other mobile nodes"""
+    mobile_map: NeighborTable = field(
+        init=False, default_factory=lambda: NeighborTable(BEACON_INTERVAL))
+    """The nodes in range, gateways included, dropped once they stop sending KALIVEs."""
     preferred_mobile: Address = field(init=False)
     """The preferred mobile node to send data to."""
     gateway_addr: Address = field(default=('', 0))
     """The gateway's address. This property is used by mobile nodes only."""
-    gateway_map: MobileMap = field(init=False, default_factory=dict)
-    """Information about all the gateways in the network."""
+    gateway_map: NeighborTable = field(
+        init=False, default_factory=lambda: NeighborTable(GATEWAY_BEACON_INTERVAL))
+    """The gateways heard from, dropped once they stop sending GKALIVEs."""
     is_mobile: bool = field(default=False)
     """Whether this client is a mobile node."""
+    routing: str = field(default='geographic')
+    """The DTN routing strategy of the mobile node, one of routers."""
+    router: Router = field(init=False)
+    """Picks the nodes in contact bundles are sent to. Used by mobile nodes only."""
 
     @cached_property
     def msender(self) -> socket:
         """
         The socket through which the gateway node sends messages to the DTN.
         """
-        ttl = struct.pack('@I', 3)
+        ttl = struct.pack('@I', MCAST_HOPS)
         sock = socket(AF_INET6, SOCK_DGRAM)
         sock.setsockopt(IPPROTO_IPV6, IPV6_MULTICAST_HOPS, ttl)
         return sock
@@ -107,6 +123,7 @@ class NetClient(Thread):
         sock.bind(('', MCAST_PORT))
         group = inet_pton(AF_INET6, MCAST_GROUP) + struct.pack('@I', 0)
         sock.setsockopt(IPPROTO_IPV6, IPV6_JOIN_GROUP, group)
+        enable_hops(sock)
         return sock
 
     def __hash__(self) -> int:
@@ -116,6 +133,10 @@ class NetClient(Thread):
         super(NetClient, self).__init__()
         self.gamestate = GameState(self.state_lock, {}, {})
         self.client_cache = Cache(self.cache_timeout, self.log_level)
+        self.bundles = BundleStore(self.cache_timeout)
+        self.router = routers[self.routing](
+            (ip_address(self.byte_address).compressed, DEFAULT_PORT), self.mobile_map,
+            self.gateway_map, self.bundles, (ip_address(self.auth_ip[0]).compressed, DEFAULT_PORT))
 
         logging.basicConfig(
             level=self.log_level, format='%(levelname)s: %(message)s')
@@ -157,17 +178,18 @@ class NetClient(Thread):
         return position
         
     @property
-    def closest_gateway(self) -> Tuple[Address, MobileMetrics]:
+    def closest_gateway(self) -> Optional[Tuple[float, Neighbor]]:
         """
         Returns the closest gateway to the client from the gateway map.
         """
-        # recalculate and update each gateway's distance to the client
-        for (addr, metrics) in self.gateway_map.items():
-            self.gateway_map[addr] = self.gateway_update(metrics)
+        return self._closest_gateway(self.location)
 
-        closest = min(self.gateway_map.items(), key=lambda x: x[1][0])
-
-        return (closest[0], closest[1])
+    def _closest_gateway(self, location: Position) -> Optional[Tuple[float, Neighbor]]:
+        """
+        Returns the closest live gateway to a location and its distance, None if none is.
+        """
+        closest = self.gateway_map.nearest(location)
+        return closest[0] if closest else None
 
     @cached_property
     def lobby_byte_address(self) -> bytes:
@@ -177,14 +199,6 @@ class NetClient(Thread):
         # use inet_pton
         return inet_pton(AF_INET6, self.lobby_addr[0])
 
-    def gateway_update(self, metrics: MobileMetrics) -> MobileMetrics:
-        """
-        Updates the gateway's distance to the client.
-        """
-        (_, pos, time, hops) = metrics
-        dist = get_node_distance(self.location, pos)
-        return (dist, pos, time, hops)
-
     def join_server(self, lobby_id: str):
         """
         Joins the server, upon joining the ThreadedSocket will start listening.
@@ -306,6 +320,7 @@ class NetClient(Thread):
         :param data: The payload to be sent.
         """
         sent = self.out_sock.sendto(data, self.lobby_addr)
+        self.last_sent = time.time()
         logging.debug('Sent %d bytes to server', sent)
 
     def _handle_state(self):
@@ -326,13 +341,14 @@ class NetClient(Thread):
             while self.in_game:
                 _incoming_changes = []
 
+                # changes are applied under the lock so ACKs report a consistent version and digest
                 with self.state_lock:
                     _incoming_changes = self.queue_inbound
                     self.queue_inbound = []
-                for change in _incoming_changes:
-                    self.gamestate._apply_change(change)
-                    # print('change',change)
-                    # print(self.gamestate.get_player_positions())
+                    for change in _incoming_changes:
+                        self.gamestate._apply_change(change)
+                        # print('change',change)
+                        # print(self.gamestate.get_player_positions())
 
                 time.sleep(0.03)
 
@@ -342,40 +358,48 @@ class NetClient(Thread):
 
 
         This message is used to broadcast the kalive to the server in a mobile context.
+        Beacons are always multicast so neighbours can track this node, but they are
+        only marked for the lobby (and relayed to it by gateways) once the uplink is idle.
         """
         byte_address = inet_pton(AF_INET6, MCAST_GROUP)
+        last_location, last_time = self.location, time.time()
 
         while self.dtn_running:
             # check whether last kalive from server was more than 5 seconds ago
             #if time.time() - self.last_kalive > 5:
             #    logging.warning('Server not responding...')
 
-            location = self.location
+            location, now = self.location, time.time()
+            elapsed = max(now - last_time, 1e-3)
+            velocity = ((location[0] - last_location[0]) / elapsed,
+                        (location[1] - last_location[1]) / elapsed)
+            last_location, last_time = location, now
 
-            data = bytes(str(location[0]) +
-                         ',' + str(location[1]), 'utf-8')
+            data = Beacon(location, velocity, self.beacon_seq).to_bytes()
+            self.beacon_seq += 1
 
-            if self.running:
+            if self.running and time.time() - self.last_sent > KALIVE_INTERVAL:
                 payload = Payload(KALIVE, data, self.lobby_uuid, self.player_uuid, self.seq_num,
                                 self.byte_address, byte_address, self.lobby_addr[1])
             else:
                 payload = Payload(KALIVE, data, '', '', self.seq_num,
                                     self.byte_address, byte_address, MCAST_PORT)
 
+            # every beacon is numbered, relays tell its copies apart from the next one
+            self.seq_num += 1
+
             self.msender.sendto(payload.to_bytes(), self.mcast_addr)
             #print("Sending Kalive to ",self.mcast_addr)
-            time.sleep(0.5)
+            time.sleep(BEACON_INTERVAL)
 
     def _broadcast_kalive_wired(self):
         """
         Method shouldn't be called directly from outside the class.
 
-        This method is used to broadcast the kalive to the server.
+        This method is used to send a kalive to the server whenever the uplink is idle.
         """
 
-        location = self.location
-        data = bytes(str(location[0]) +
-                     ',' + str(location[1]), 'utf-8')
+        data = Beacon(self.location).to_bytes()
 
         # non mobile clients
         while self.running:
@@ -383,12 +407,14 @@ class NetClient(Thread):
             if time.time() - self.last_kalive > TIMEOUT:
                 logging.warning('Server not responding...')
 
-            payload = Payload(KALIVE, data, self.lobby_uuid,
-                              self.player_uuid, self.seq_num, self.byte_address, self.lobby_byte_address,self.lobby_addr[1])
+            # any payload sent to the lobby doubles as a kalive
+            if time.time() - self.last_sent > KALIVE_INTERVAL:
+                payload = Payload(KALIVE, data, self.lobby_uuid,
+                                  self.player_uuid, self.seq_num, self.byte_address, self.lobby_byte_address,self.lobby_addr[1])
 
-            self.seq_num += 1
-            self.unicast(payload.to_bytes())
-            time.sleep(1)
+                self.seq_num += 1
+                self.unicast(payload.to_bytes())
+            time.sleep(KALIVE_INTERVAL)
 
     def _handle_metrics_update(self):
         """
@@ -399,42 +425,39 @@ class NetClient(Thread):
         while self.running:
             time.sleep(1)
             # Every 5 seconds update the preffered mobile node and set it's address as the default.
-            self.preferred_mobile = self._get_preferred_node()
+            self.preferred_mobile = self._get_preferred_node() or self.preferred_mobile
+            self.router.position = self.location
+            self.router.preferred = self.preferred_mobile
             logging.info('Preferred mobile node is {}'.format(
                 self.preferred_mobile[0]))
 
-    def _get_preferred_node(self) -> Address:
+    def _get_preferred_node(self) -> Optional[Address]:
         """
         Returns a node.
 
-        :return: The node with the lowest distance to the gateway node aswell as a low number of hops.
+        :return: The node that gets our data closest to the closest gateway over a good link,
+            or None if no gateway is in range.
         """
+        # the location is read from disk, only once
+        location = self.location
+
         # get the closest gateway to our node
-        (gateway_addr, (dist, _, _, hops)) = self.closest_gateway
+        closest = self._closest_gateway(location)
 
-        # get the gateway node
-        # (dist, _, _, hops) = self.mobile_map[self.gateway_addr]
+        if closest is None:
+            return None
+
+        _, gateway = closest
 
         # Important: if we're connected directly to the gateway,
         #               we want to use it as a preferred node.
-        if hops == 3:
-            return gateway_addr
-
-        distances = [self.mobile_map[addr][0] for addr in self.mobile_map]
+        if gateway.hops == 0 or gateway.address not in self.mobile_map:
+            return gateway.address
 
-        # get the shortest distance
-        min_dist = min(distances)
+        # the node closest to the gateway, if it's closer to it than we are
+        relay = self.mobile_map.toward(location, gateway.address)
 
-        candidates = [
-            addr for addr in self.mobile_map if self.mobile_map[addr][0] == min_dist]
-
-        best_candidate = min(candidates, key=lambda x: self.mobile_map[x][0])
-            
-        # if the min_dist is no less than 20% larger than the gateway node and has less hops, return the gateway node
-        if min_dist * 1.1 > dist and self.mobile_map[best_candidate][3] >= hops:
-            return best_candidate
-
-        return gateway_addr
+        return gateway.address if relay is None else relay[1].address
 
     def _handle_output_mobile(self):
         """
@@ -445,17 +468,58 @@ class NetClient(Thread):
         while self.running:
             payloads = self.client_cache.get_entries_not_sent()
 
-            # get prefered destination node
-            out_addr = (self.preferred_mobile[0],DEFAULT_PORT)
-        
-            
+            # queued payloads are held as bundles until a node in contact takes custody of them
             for (addr, payload) in payloads:
-                logging.info('Sending payload to {} through {} {}.'.format(addr, out_addr, payload.type))
-                payload.port = self.lobby_addr[1]
-                self.out_sock.sendto(payload.to_bytes(), out_addr)
-                
+                payload.lobby_port = self.lobby_addr[1]
+                key = self.bundles.add((payload.short_destination, DEFAULT_PORT), payload.to_bytes())
+                if key is None:
+                    logging.warning('Bundle store full, dropped %s', payload.type_str)
+                else:
+                    self.router.created(key)
+
+            now = time.time()
+            contacts = self.router.contacts(now)
+
+            # the router picks the nodes in contact each bundle goes to, if any
+            for destination in self.bundles.destinations():
+                for bundle in self.bundles.due(destination, now, mark=False):
+                    hops = self.router.targets(bundle, contacts)
+                    if not hops:
+                        continue
+
+                    for hop in hops:
+                        logging.debug('Sending bundle to %s through %s.', destination, hop)
+                        self.out_sock.sendto(bundle.data, (hop[0], DEFAULT_PORT))
+
+                    self.bundles.mark(bundle.key, now)
+                    self.last_sent = now
+
+            self._signal_routing(contacts, now)
+            self._signal_custody()
             time.sleep(0.03)
 
+    def _signal_routing(self, contacts: List[Neighbor], now: float):
+        """
+        Method shouldn't be called directly from outside the class.
+
+        Sends the control data of the router to the nodes in contact.
+        """
+        for hop, data in self.router.control(contacts, now):
+            payload = Payload(ROUTING, data, '', '', 0, self.byte_address,
+                              inet_pton(AF_INET6, hop[0]), DEFAULT_PORT)
+            self.out_sock.sendto(payload.to_bytes(), hop)
+
+    def _signal_custody(self):
+        """
+        Method shouldn't be called directly from outside the class.
+
+        Tells the previous hops which of their bundles this node took custody of.
+        """
+        for hop, keys in self.bundles.drain_signals():
+            payload = Payload(CUSTODY, keys, '', '', 0, self.byte_address,
+                              inet_pton(AF_INET6, hop[0]), DEFAULT_PORT)
+            self.out_sock.sendto(payload.to_bytes(), hop)
+
     def _handle_output_wired(self):
         """
         Method shouldn't be called directly from outside the class.
@@ -481,9 +545,10 @@ class NetClient(Thread):
 
         while self.dtn_running:
             try:
-                data, addr = self.dtn_sock.recvfrom(1500)
+                data, addr, hops = recv_beacon(self.dtn_sock)
 
-                address = (addr[0], addr[1])
+                # nodes are reached on the default port, whatever port they beacon from
+                address = (addr[0], DEFAULT_PORT)
                 payload = Payload.from_bytes(data)
 
                 #print(payload.type)
@@ -494,27 +559,19 @@ class NetClient(Thread):
                     continue
 
                 if payload.is_gkalive:
-                    _x, _y = payload.data.decode('utf-8').split(',')
-                    position = (float(_x), float(_y))
-                    hops = 3 - payload.ttl
-                    timestamp = time.time()
-                    distance = get_node_distance(position, self.location)
-
-                    self.gateway_map[address] = (
-                        distance, position, timestamp, hops)
+                    beacon = Beacon.from_bytes(payload.data)
 
-                    self.mobile_map[address] = (
-                        distance, position, timestamp, hops)
+                    self.gateway_map.beacon(address, beacon.position, hops, load=beacon.load,
+                                            seq=beacon.seq)
+                    self.mobile_map.beacon(
+                        address, beacon.position, hops, GATEWAY_BEACON_INTERVAL, load=beacon.load,
+                        seq=beacon.seq)
 
                 if payload.is_kalive:
-                    _x, _y = payload.data.decode('utf-8').split(',')
-                    position = (float(_x), float(_y))
-                    hops = 3 - payload.ttl
-                    timestamp = time.time()
-                    distance = get_node_distance(position, self.location)
+                    beacon = Beacon.from_bytes(payload.data)
 
-                    self.mobile_map[address] = (
-                        distance, position, timestamp, hops)
+                    self.mobile_map.beacon(address, beacon.position, hops, velocity=beacon.velocity,
+                                           seq=beacon.seq)
 
             except timeout:
                 continue
@@ -530,7 +587,7 @@ class NetClient(Thread):
         """
         while self.running:
             try:
-                data, _ = self.in_sock.recvfrom(1500)
+                data, addr = self.in_sock.recvfrom(1500)
 
                 if len(data) < 50:
                     continue
@@ -543,12 +600,41 @@ class NetClient(Thread):
                     self.client_cache.add_entry(
                         (payload.short_destination, DEFAULT_PORT), payload)
 
+                if self.is_mobile:
+                    prev_hop = (addr[0], DEFAULT_PORT)
+
+                    if payload.is_custody:
+                        # copies handed to relays are kept until the router is done with them
+                        self.bundles.release([key for key in split_keys(payload.data)
+                                              if self.router.taken(prev_hop, key)])
+                        continue
+
+                    if payload.is_routing:
+                        self.router.on_control(prev_hop, payload.data)
+                        continue
+
+                    if payload.destination != self.byte_address:
+                        # a bundle relayed through this node, held until the router finds it a next hop,
+                        # with many copies around, those of bundles handed over already are only signalled again
+                        if (not self.router.single and self.bundles.seen(data)) or \
+                                self.bundles.add((payload.short_destination, DEFAULT_PORT), data) is not None:
+                            self.bundles.custody(prev_hop, data)
+                            self.router.received(prev_hop, bundle_key(data))
+                        continue
+
+                    # copies sent again missed our custody signal, they're only signalled again
+                    if not self.bundles.custody(prev_hop, data):
+                        continue
+
                 if payload.lobby_uuid == self.lobby_uuid and payload.player_uuid == self.player_uuid:
+                    # any payload from the lobby is proof of life
+                    self.last_kalive = time.time()
+
                     # Parse the payload and check whether it's an event or not
                     # if it's a game event, add it to the queue_inbound
                     # if it's not, pass it to the queue_message
                     if payload.is_kalive:
-                        self.last_kalive = time.time()
+                        pass
 
                     elif payload.is_actions:
                         changes = change_from_bytes(payload.data)
@@ -556,22 +642,38 @@ class NetClient(Thread):
                         if changes is not None:
                             self.queue_inbound.extend(changes)
 
-                        # Ack the payload
-                        ack_payload = Payload(ACK, b'', self.lobby_uuid, self.player_uuid,
+                        # Ack the payload, reporting the state the client is at
+                        with self.state_lock:
+                            stamp = self.gamestate.stamp()
+                        ack_payload = Payload(ACK, stamp, self.lobby_uuid, self.player_uuid,
                                               payload.seq_num, self.byte_address, self.lobby_byte_address, self.lobby_addr[1])
 
                         self.client_cache.add_entry(
                             (payload.short_source, DEFAULT_PORT), ack_payload)
 
-                    elif payload.is_state and self.started == False:
-                        # update the client's state and set the started flag to true
+                    elif payload.is_snapshot:
+                        # the server found our state diverged from its own, each part replaces some rows,
+                        # the changes queued before the snapshot are dropped once, on its first part
+                        with self.state_lock:
+                            if self.gamestate.load_snapshot(payload.data):
+                                self.queue_inbound = []
+                        logging.info('Loaded snapshot at version %d',
+                                     self.gamestate.version)
+
+                    elif payload.is_state:
                         state = json.loads(payload.data.decode('utf-8'))
-                        if state['uuid'] == self.player_uuid:
-                            self.started = True
+
+                        # the game start is sent repeatedly, only handle it once
+                        if self.player_uuid in state['players'] and state['time'] != self.start_time:
+                            # update the client's state and set the started flag to true
+                            # the board must be set up before the player id is,
+                            # the game starts drawing as soon as it has an id
+                            with self.state_lock:
+                                self.gamestate.resize(state['size'])
+                                self.gamestate.generate_map(state['seed'], state['density'])
                             self.start_time = state['time']
-                            self.player_id = state['id']
-                            # print('dealing with boxes',state['boxes'])
-                            self.gamestate.boxes = state['boxes']
+                            self.player_id = state['players'][self.player_uuid]
+                            self.started = True
 
             except timeout:
                 continue
@@ -606,6 +708,7 @@ class NetClient(Thread):
             while self.running:
                 time.sleep(self.cache_timeout)
                 self.client_cache.purge_timeout()
+                self.bundles.expire()
         else:
             while self.running:
                 time.sleep(1)
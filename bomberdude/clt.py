@@ -3,6 +3,7 @@
 import argparse
 from client.networking import NetClient
 from client.client import Client
+from common.routing import routers
 from common.core_utils import get_node_ipv6, get_node_path
 from logging import INFO, DEBUG, ERROR, WARNING
 
@@ -15,7 +16,10 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address', type=str, required=True)
     parser.add_argument('-i', '--id', type=str, required=True)
     parser.add_argument('-l', '--level', type=str, default='info',)
-    parser.add_argument('-g', '--gateway', type=str)
+    parser.add_argument('-g', '--gateway', type=str,
+                        help='Gateway of a mobile node to start with, the others are found from their beacons.')
+    parser.add_argument('-r', '--routing', type=str, default='geographic', choices=list(routers),
+                        help='DTN routing strategy of the mobile node.')
 
     args = parser.parse_args()
 
@@ -0,0 +1,173 @@
+"""
+Uplink batching of the gateways.
+
+A gateway used to relay every payload of its mobile nodes to the server as a
+datagram of its own, so the server received a stream of small datagrams per
+mobile node. The payloads bound to the same lobby are now packed together into
+BATCH datagrams, filled up to the MTU, and the KALIVEs of the mobile nodes are
+folded into a single ALIVE per lobby and interval, listing the players heard
+from. The server then receives a few datagrams per gateway, whatever the number
+of mobile nodes behind it.
+
+The body of a BATCH is the payloads it carries, each prefixed with its length:
+
+    batch: header | length (H) | payload | length (H) | payload | ...
+
+A payload that would fill a BATCH on its own, or the only one bound to a lobby,
+is sent as is.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from socket import AF_INET6, inet_pton
+import struct
+from threading import Lock
+import time
+from typing import Dict, Iterator, List, Set, Tuple
+
+from .payload import ALIVE, BATCH, HDR_LOBBY, HDR_PLAYER, OFFSET, pattern
+from .types import MAX_DATAGRAM, Address
+
+_length = struct.Struct('!H')
+"""The length of a payload in a BATCH."""
+
+PLAYER_SIZE = 4
+"""The size of a player uuid in a header, and in an ALIVE."""
+
+
+def unbatch(data: bytes | bytearray) -> Iterator[memoryview]:
+    """
+    Splits the body of a BATCH into the payloads it carries.
+
+    :param data: The serialized BATCH.
+    :return: The payloads, a truncated one ends the batch.
+    """
+    view = memoryview(data)
+    offset = OFFSET
+
+    while offset + _length.size <= len(view):
+        size, = _length.unpack_from(view, offset)
+        offset += _length.size
+
+        if offset + size > len(view):
+            return
+
+        yield view[offset:offset + size]
+        offset += size
+
+
+def split_players(data: bytes) -> List[str]:
+    """
+    Splits the data of an ALIVE into the player uuids it carries.
+    """
+    return [data[i:i + PLAYER_SIZE].decode() for i in range(0, len(data) - PLAYER_SIZE + 1, PLAYER_SIZE)]
+
+
+@dataclass
+class Batcher:
+    """
+    The payloads and KALIVEs bound to each lobby, yet to be sent.
+
+    Attributes:
+        source: The address of the gateway, source of the BATCHes and ALIVEs.
+        size: The max size of a datagram.
+    """
+    source: bytes
+    """The address of the gateway, source of the BATCHes and ALIVEs."""
+    size: int = field(default=MAX_DATAGRAM)
+    """The max size of a datagram."""
+    pending: Dict[Address, List[bytes]] = field(init=False, default_factory=dict)
+    """The payloads bound to each lobby."""
+    alive: Dict[Tuple[Address, bytes], Set[bytes]] = field(init=False, default_factory=dict)
+    """The players of each lobby heard from, by lobby address and uuid."""
+    seq_num: int = field(init=False, default_factory=lambda: int(time.time() * 1000) & 0x7fffffff)
+    """Numbers the datagrams of the gateway, so they aren't taken as copies of each other.
+    Starts from the clock, so a restarted gateway doesn't reuse recent numbers."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the queues, KALIVEs and payloads come in on different threads."""
+
+    def add(self, lobby: Address, data: bytes | bytearray):
+        """
+        Queues a payload bound to a lobby.
+        """
+        with self.lock:
+            self.pending.setdefault(lobby, []).append(bytes(data))
+
+    def kalive(self, lobby: Address, data: bytes | bytearray):
+        """
+        Notes a KALIVE bound to a lobby, only its player is sent on.
+        """
+        key = (lobby, bytes(data[HDR_LOBBY:HDR_LOBBY + 4]))
+
+        with self.lock:
+            self.alive.setdefault(key, set()).add(bytes(data[HDR_PLAYER:HDR_PLAYER + PLAYER_SIZE]))
+
+    def _header(self, type: int, lobby_uuid: bytes, length: int, destination: bytes,
+                port: int) -> bytes:
+        self.seq_num = (self.seq_num + 1) & 0x7fffffff
+        return struct.pack(pattern, type, length, lobby_uuid, b'', self.seq_num, 1,
+                           self.source, destination, port)
+
+    def summaries(self) -> List[Tuple[Address, bytes]]:
+        """
+        Takes the ALIVEs to send, one per lobby listing the players heard from since the last call.
+
+        :return: The (lobby, ALIVE) to send.
+        """
+        with self.lock:
+            alive, self.alive = self.alive, {}
+
+        out = []
+        per_datagram = (self.size - OFFSET) // PLAYER_SIZE
+
+        for (lobby, lobby_uuid), players in alive.items():
+            players = sorted(players)
+            destination = inet_pton(AF_INET6, lobby[0])
+
+            for i in range(0, len(players), per_datagram):
+                body = b''.join(players[i:i + per_datagram])
+                out.append((lobby, self._header(ALIVE, lobby_uuid, len(body), destination,
+                                                lobby[1]) + body))
+
+        return out
+
+    def _pack(self, lobby: Address, batch: List[bytes]) -> Tuple[Address, bytes]:
+        if len(batch) == 1:
+            return lobby, batch[0]
+
+        body = b''.join(_length.pack(len(data)) + data for data in batch)
+        return lobby, self._header(BATCH, batch[0][HDR_LOBBY:HDR_LOBBY + 4], len(body),
+                                   inet_pton(AF_INET6, lobby[0]), lobby[1]) + body
+
+    def flush(self) -> List[Tuple[Address, bytes]]:
+        """
+        Takes the payloads queued, packed into as few datagrams as fit them.
+
+        :return: The (lobby, datagram) to send.
+        """
+        with self.lock:
+            pending, self.pending = self.pending, {}
+
+        out = []
+        room = self.size - OFFSET
+
+        for lobby, payloads in pending.items():
+            batch: List[bytes] = []
+            used = 0
+
+            # payloads keep their order, a batch is closed before one that doesn't fit it
+            for data in payloads:
+                if batch and used + _length.size + len(data) > room:
+                    out.append(self._pack(lobby, batch))
+                    batch, used = [], 0
+
+                if _length.size + len(data) > room:
+                    out.append((lobby, data))
+                    continue
+
+                batch.append(data)
+                used += _length.size + len(data)
+
+            if batch:
+                out.append(self._pack(lobby, batch))
+
+        return out
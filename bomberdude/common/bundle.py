@@ -0,0 +1,347 @@
+"""
+Store-and-forward bundle layer of the DTN.
+
+Payloads used to be sent to a single preferred node as soon as they were queued,
+and lost if it was out of reach. A node now keeps each payload, a bundle, in a
+queue per destination until a node that takes it closer is in contact, and until
+that node takes custody of it: the next hop answers with a CUSTODY carrying the
+keys of the bundles it accepted, and only then is the bundle dropped. Bundles not
+taken into custody are forwarded again, at most once per retry period and only
+while a contact lasts, and dropped once their lifetime is over.
+
+A bundle is identified by its type, player, sequence number and source, read
+straight from its header so relays don't decode it. Senders number each payload
+on its own, a payload reusing the key of one held is taken for a copy of it.
+
+Bundles are kept in memory, or in a BundleLog on disk so they survive a restart.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field, replace
+from threading import Lock
+import time
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+
+from .payload import HDR_PLAYER, HDR_SEQ, HDR_SOURCE, HDR_TYPE, OFFSET
+from .types import Address, Time
+
+if TYPE_CHECKING:
+    from .bundlelog import BundleLog
+
+BundleKey = bytes
+"""The type, player uuid, sequence number and source of a bundle."""
+
+KEY_SIZE = 25
+"""The size of a bundle key, 1 + 4 + 4 + 16 bytes."""
+
+SIGNAL_KEYS = 50
+"""The max number of keys in a CUSTODY, so it fits a datagram."""
+
+
+def bundle_key(data: bytes | bytearray) -> BundleKey:
+    """
+    Reads the key of a serialized payload from its header.
+
+    :param data: The serialized payload.
+    :return: The key of the bundle.
+    """
+    if len(data) < OFFSET:
+        raise ValueError(f'Truncated header, {len(data)} bytes')
+
+    return bytes(data[HDR_TYPE:HDR_TYPE + 1]) + bytes(data[HDR_PLAYER:HDR_SEQ + 4]) + \
+        bytes(data[HDR_SOURCE:HDR_SOURCE + 16])
+
+
+def split_keys(data: bytes) -> List[BundleKey]:
+    """
+    Splits the data of a CUSTODY payload into the keys it carries.
+    """
+    return [data[i:i + KEY_SIZE] for i in range(0, len(data) - KEY_SIZE + 1, KEY_SIZE)]
+
+
+@dataclass
+class Bundle:
+    """
+    A payload held until the next hop takes custody of it.
+
+    Attributes:
+        key: The key of the bundle.
+        destination: The final destination of the bundle.
+        data: The serialized payload, forwarded as is.
+        expires: The time the bundle is dropped at, delivered or not.
+    """
+    key: BundleKey
+    """The key of the bundle."""
+    destination: Address
+    """The final destination of the bundle."""
+    data: bytes
+    """The serialized payload, forwarded as is. Empty while it's held in a log."""
+    expires: Time
+    """The time the bundle is dropped at, delivered or not."""
+    sent: Time = field(default=0.0)
+    """The time the bundle was last forwarded, 0 if it never was."""
+    attempts: int = field(default=0)
+    """The number of times the bundle was forwarded."""
+
+
+@dataclass
+class BundleStore:
+    """
+    The bundles a node has custody of, queued per destination.
+
+    Attributes:
+        lifetime: The time, in seconds, a bundle is kept for.
+        retry: The time, in seconds, before a bundle not taken into custody is forwarded again.
+        capacity: The max number of bundles held, custody is refused past it.
+        log: The log the bundles are held in, None to hold them in memory.
+    """
+    lifetime: float = field(default=30.0)
+    """The time, in seconds, a bundle is kept for."""
+    retry: float = field(default=1.0)
+    """The time, in seconds, before a bundle not taken into custody is forwarded again."""
+    capacity: int = field(default=4096)
+    """The max number of bundles held, custody is refused past it."""
+    log: Optional[BundleLog] = field(default=None)
+    """The log the bundles are held in, None to hold them in memory."""
+    queues: Dict[Address, Dict[BundleKey, Bundle]] = field(init=False, default_factory=dict)
+    """The bundles of each destination, oldest first."""
+    keys: Dict[BundleKey, Address] = field(init=False, default_factory=dict)
+    """The destination of each bundle held."""
+    accepted: Dict[BundleKey, Time] = field(init=False, default_factory=dict)
+    """The bundles taken into custody recently, so copies sent again are spotted."""
+    signals: Dict[Address, List[BundleKey]] = field(init=False, default_factory=dict)
+    """The keys of the bundles taken into custody, yet to be signalled to each previous hop."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the store, bundles come in and go out on different threads."""
+
+    def __post_init__(self):
+        if self.log is None:
+            return
+
+        # the bundles held before a restart
+        for key, entry in self.log.recover():
+            self.queues.setdefault(entry.destination, {})[key] = Bundle(
+                key, entry.destination, b'', entry.expires)
+            self.keys[key] = entry.destination
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def _load(self, bundle: Bundle) -> Bundle:
+        """
+        A copy of a bundle with its payload, read back from the log if it's held in one.
+        """
+        if self.log is None:
+            return bundle
+
+        return replace(bundle, data=self.log.read(bundle.key))
+
+    def __contains__(self, key: BundleKey) -> bool:
+        return key in self.keys
+
+    def add(self, destination: Address, data: bytes | bytearray,
+            now: Optional[Time] = None) -> Optional[BundleKey]:
+        """
+        Queues a bundle for a destination.
+
+        :param destination: The final destination of the bundle.
+        :param data: The serialized payload.
+        :param now: The current time, now if None.
+        :return: The key of the bundle, or None if the store is full.
+        """
+        now = time.time() if now is None else now
+        key = bundle_key(data)
+
+        with self.lock:
+            if key in self.keys:
+                return key
+
+            if len(self.keys) >= self.capacity:
+                return None
+
+            expires = now + self.lifetime
+            if self.log is not None:
+                self.log.add(key, destination, expires, data)
+                data = b''
+
+            self.queues.setdefault(destination, {})[key] = Bundle(
+                key, destination, bytes(data), expires)
+            self.keys[key] = destination
+            # copies that make their way back are spotted once this one is handed over
+            self.accepted.setdefault(key, expires)
+
+        return key
+
+    def seen(self, data: bytes | bytearray) -> bool:
+        """
+        Checks whether a bundle was held or taken into custody recently.
+        """
+        return bundle_key(data) in self.accepted
+
+    def get(self, key: BundleKey) -> Optional[Bundle]:
+        """
+        A bundle held, without its payload if it's held in a log. None if it's not held.
+        """
+        with self.lock:
+            destination = self.keys.get(key)
+            return None if destination is None else self.queues[destination][key]
+
+    def destination(self, key: BundleKey) -> Optional[Address]:
+        """
+        The destination of a bundle held, None if it's not held.
+        """
+        return self.keys.get(key)
+
+    def custody(self, prev_hop: Address, data: bytes | bytearray,
+                now: Optional[Time] = None) -> bool:
+        """
+        Takes custody of a bundle received from a previous hop, to be signalled back to it.
+
+        :param prev_hop: The node the bundle was received from.
+        :param data: The serialized payload.
+        :param now: The current time, now if None.
+        :return: False if the bundle is a copy of one taken into custody before,
+            the previous hop missed the signal and it's signalled again.
+        """
+        now = time.time() if now is None else now
+        key = bundle_key(data)
+
+        with self.lock:
+            self.signals.setdefault(prev_hop, []).append(key)
+            fresh = key not in self.accepted
+            # copies don't extend the time the key is remembered for, or a key
+            # reused by the sender would never be taken as fresh again
+            if fresh:
+                self.accepted[key] = now + self.lifetime
+
+        return fresh
+
+    def release(self, keys: List[BundleKey]) -> int:
+        """
+        Drops the bundles the next hop took custody of.
+
+        :param keys: The keys in the CUSTODY payload.
+        :return: The number of bundles dropped.
+        """
+        released = 0
+
+        with self.lock:
+            for key in keys:
+                destination = self.keys.pop(key, None)
+                if destination is None:
+                    continue
+
+                queue = self.queues[destination]
+                del queue[key]
+                if not queue:
+                    del self.queues[destination]
+                if self.log is not None:
+                    self.log.release(key)
+                released += 1
+
+        return released
+
+    def destinations(self) -> List[Address]:
+        """
+        The destinations with bundles queued.
+        """
+        with self.lock:
+            return list(self.queues)
+
+    def due(self, destination: Address, now: Optional[Time] = None,
+            mark: bool = True) -> List[Bundle]:
+        """
+        Takes the bundles of a destination to forward over a contact: those never
+        forwarded and those not taken into custody within the retry period.
+
+        :param destination: The destination.
+        :param now: The current time, now if None.
+        :param mark: Whether the bundles are marked as forwarded, otherwise
+            mark is called for those actually forwarded.
+        :return: The bundles, oldest first.
+        """
+        now = time.time() if now is None else now
+        out = []
+
+        with self.lock:
+            for bundle in self.queues.get(destination, {}).values():
+                if bundle.attempts == 0 or now - bundle.sent >= self.retry:
+                    if mark:
+                        bundle.sent = now
+                        bundle.attempts += 1
+                    out.append(self._load(bundle))
+
+        return out
+
+    def mark(self, key: BundleKey, now: Optional[Time] = None):
+        """
+        Marks a bundle as forwarded, so it's not forwarded again within the retry period.
+        """
+        now = time.time() if now is None else now
+
+        with self.lock:
+            destination = self.keys.get(key)
+            if destination is None:
+                return
+
+            bundle = self.queues[destination][key]
+            bundle.sent = now
+            bundle.attempts += 1
+
+    def rewind(self, destination: Address):
+        """
+        Makes the bundles of a destination due again, e.g. once the node they were
+        forwarded to is gone and won't take custody of them.
+        """
+        with self.lock:
+            for bundle in self.queues.get(destination, {}).values():
+                bundle.sent = float('-inf')
+
+    def drain_signals(self) -> List[Tuple[Address, bytes]]:
+        """
+        Takes the custody signals to send, the keys for each previous hop packed together.
+
+        :return: The (previous hop, CUSTODY data) to send.
+        """
+        with self.lock:
+            signals, self.signals = self.signals, {}
+
+        return [(hop, b''.join(keys[i:i + SIGNAL_KEYS]))
+                for hop, keys in signals.items() for i in range(0, len(keys), SIGNAL_KEYS)]
+
+    def expire(self, now: Optional[Time] = None) -> int:
+        """
+        Drops the bundles whose lifetime is over.
+
+        :param now: The current time, now if None.
+        :return: The number of bundles dropped.
+        """
+        now = time.time() if now is None else now
+        expired = 0
+
+        with self.lock:
+            for destination in list(self.queues):
+                queue = self.queues[destination]
+
+                # bundles share a lifetime, so the oldest are at the front
+                for key in list(queue):
+                    if queue[key].expires > now:
+                        break
+                    del queue[key]
+                    del self.keys[key]
+                    if self.log is not None:
+                        self.log.forget(key)
+                    expired += 1
+
+                if not queue:
+                    del self.queues[destination]
+
+            self.accepted = {k: t for k, t in self.accepted.items() if t > now}
+
+        return expired
+
+    def bundles(self) -> List[Bundle]:
+        """
+        Every bundle held, e.g. for a last attempt before leaving.
+        """
+        with self.lock:
+            return [self._load(b) for queue in self.queues.values() for b in queue.values()]
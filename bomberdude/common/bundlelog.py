@@ -0,0 +1,318 @@
+"""
+Durable log of the bundles held by a node.
+
+The bundle store keeps its bundles in memory, so a restart of a gateway lost
+everything it had custody of. With a log, every bundle taken is appended to a
+segment file, mapped in memory, and every bundle released appends a tombstone.
+Only the location of each live bundle is kept in memory, its payload is read
+back from the segment when it's forwarded. A restart replays the segments in
+order to rebuild the locations.
+
+Segments are preallocated and appended to until full, then a new one is started.
+Each record is framed with a CRC so a record torn by a crash ends the replay of
+its segment instead of corrupting the store:
+
+    record: crc32 (I) | length (I) | kind (B) | expires (d) | port (H) | address (16s) | body
+
+The body is the payload of a bundle, or the key of the bundle a tombstone
+releases. Once the segments hold more than twice the live bundles, the oldest
+segment is compacted: its live bundles are appended anew and the file removed.
+Compacting oldest first means its tombstones can always be dropped, the bundles
+they release are in the same segment or in one already removed. The size of the
+log, and so the time to replay it, stays bound by the amount of live data.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import mmap
+import os
+import struct
+from socket import AF_INET6, inet_ntop, inet_pton
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+import zlib
+
+from .bundle import BundleKey, bundle_key
+from .payload import OFFSET
+from .types import Address, Time
+
+# Record kinds, 0 is the zeroed tail of a preallocated segment
+ADD = 0x01
+"""A bundle taken into custody."""
+RELEASE = 0x02
+"""A tombstone, the bundle was handed over."""
+
+_frame = struct.Struct('!IIBdH16s')
+
+SUFFIX = '.seg'
+
+Ref = Tuple[int, int, int]
+"""The segment, offset and size of a record."""
+
+
+@dataclass
+class Entry:
+    """
+    A live bundle in the log.
+
+    Attributes:
+        destination: The final destination of the bundle.
+        expires: The time the bundle is dropped at.
+        ref: Where the bundle's record is.
+    """
+    destination: Address
+    """The final destination of the bundle."""
+    expires: Time
+    """The time the bundle is dropped at."""
+    ref: Ref
+    """Where the bundle's record is."""
+
+
+@dataclass
+class Segment:
+    """
+    A preallocated file, mapped in memory.
+
+    Attributes:
+        id: The number of the segment, segments are replayed in order.
+        path: The path of the file.
+        size: The size of the file.
+    """
+    id: int
+    """The number of the segment, segments are replayed in order."""
+    path: str
+    """The path of the file."""
+    size: int
+    """The size of the file."""
+    fd: int = field(init=False)
+    """The file descriptor."""
+    map: mmap.mmap = field(init=False)
+    """The file, mapped in memory."""
+    end: int = field(init=False, default=0)
+    """The offset records are appended at."""
+    live: int = field(init=False, default=0)
+    """The bytes taken by live bundles."""
+
+    def __post_init__(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size < self.size:
+            os.ftruncate(self.fd, self.size)
+        self.size = os.fstat(self.fd).st_size
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def _pack(kind: int, destination: Address, expires: Time, body: bytes) -> bytes:
+    """
+    Frames a record, the CRC covers everything after it.
+    """
+    frame = _frame.pack(0, len(body), kind, expires, destination[1],
+                        inet_pton(AF_INET6, destination[0])) + body
+    return struct.pack('!I', zlib.crc32(frame[4:])) + frame[4:]
+
+
+@dataclass
+class BundleLog:
+    """
+    Append-only segments holding the bundles of a store.
+
+    Attributes:
+        directory: The directory of the segments, created if needed.
+        segment_size: The size of each segment.
+        sync: Whether every record is flushed to disk, not only to the page cache.
+            The page cache survives the process, only a crash of the host loses it.
+    """
+    directory: str
+    """The directory of the segments, created if needed."""
+    segment_size: int = field(default=4 << 20)
+    """The size of each segment."""
+    sync: bool = field(default=False)
+    """Whether every record is flushed to disk, not only to the page cache."""
+    segments: Dict[int, Segment] = field(init=False, default_factory=dict)
+    """The segments, oldest first."""
+    entries: Dict[BundleKey, Entry] = field(init=False, default_factory=dict)
+    """The live bundles."""
+    size: int = field(init=False, default=0)
+    """The bytes appended to the segments still on disk."""
+    live: int = field(init=False, default=0)
+    """The bytes taken by live bundles."""
+
+    def __post_init__(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: BundleKey) -> bool:
+        return key in self.entries
+
+    @property
+    def active(self) -> Segment:
+        """
+        The segment records are appended to.
+        """
+        return self.segments[next(reversed(self.segments))]
+
+    def _open(self, id: int) -> Segment:
+        segment = Segment(id, os.path.join(self.directory, '%08d%s' % (id, SUFFIX)),
+                          self.segment_size)
+        self.segments[id] = segment
+        return segment
+
+    def _scan(self, segment: Segment) -> Iterator[Tuple[int, int, Address, Time, int]]:
+        """
+        Reads the records of a segment, up to the first empty or torn one.
+
+        :return: The (kind, offset, destination, expires, size) of each record.
+        """
+        offset = 0
+
+        with memoryview(segment.map) as view:
+            while offset + _frame.size <= segment.size:
+                crc, length, kind, expires, port, address = _frame.unpack_from(view, offset)
+                end = offset + _frame.size + length
+
+                if kind == 0 or end > segment.size or \
+                        zlib.crc32(view[offset + 4:end]) != crc:
+                    break
+
+                yield kind, offset, (inet_ntop(AF_INET6, address), port), expires, end - offset
+                offset = end
+
+        segment.end = offset
+
+    def recover(self, now: Optional[Time] = None) -> List[Tuple[BundleKey, Entry]]:
+        """
+        Replays the segments on disk, rebuilding the location of the live bundles.
+        Must be called once, before anything is appended.
+
+        :param now: The current time, now if None. Expired bundles are dropped.
+        :return: The (key, entry) of the live bundles, in the order they expire in.
+        """
+        now = time.time() if now is None else now
+        ids = sorted(int(name[:-len(SUFFIX)]) for name in os.listdir(self.directory)
+                     if name.endswith(SUFFIX))
+
+        for id in ids:
+            segment = self._open(id)
+
+            for kind, offset, destination, expires, size in self._scan(segment):
+                self.size += size
+                # the key of a bundle is in its header, a tombstone's body is the key
+                start = offset + _frame.size
+                body = segment.map[start:start + min(size - _frame.size, OFFSET)]
+
+                if kind == ADD and expires > now:
+                    self.entries[bundle_key(body)] = Entry(
+                        destination, expires, (id, offset, size))
+                elif kind == RELEASE:
+                    self.entries.pop(body, None)
+
+        for entry in self.entries.values():
+            self.segments[entry.ref[0]].live += entry.ref[2]
+            self.live += entry.ref[2]
+
+        if not self.segments:
+            self._open(0)
+
+        self._compact()
+
+        # compaction moves bundles around, they're handed back in the order they expire in
+        return sorted(self.entries.items(), key=lambda item: item[1].expires)
+
+    def _append(self, record: bytes) -> Ref:
+        if len(record) > self.segment_size:
+            raise ValueError(f'Record of {len(record)} bytes exceeds the segment size')
+
+        segment = self.active
+        if segment.end + len(record) > segment.size:
+            segment.map.flush()
+            segment = self._open(segment.id + 1)
+
+        offset = segment.end
+        segment.map[offset:offset + len(record)] = record
+        segment.end += len(record)
+        self.size += len(record)
+
+        if self.sync:
+            segment.map.flush()
+
+        return segment.id, offset, len(record)
+
+    def _drop(self, key: BundleKey) -> Optional[Entry]:
+        entry = self.entries.pop(key, None)
+
+        if entry is not None:
+            self.segments[entry.ref[0]].live -= entry.ref[2]
+            self.live -= entry.ref[2]
+
+        return entry
+
+    def add(self, key: BundleKey, destination: Address, expires: Time, data: bytes | bytearray):
+        """
+        Appends a bundle taken into custody.
+        """
+        ref = self._append(_pack(ADD, destination, expires, bytes(data)))
+        self.entries[key] = Entry(destination, expires, ref)
+        self.segments[ref[0]].live += ref[2]
+        self.live += ref[2]
+        self._compact()
+
+    def release(self, key: BundleKey):
+        """
+        Appends a tombstone for a bundle handed over.
+        """
+        entry = self._drop(key)
+
+        if entry is not None:
+            self._append(_pack(RELEASE, entry.destination, entry.expires, key))
+            self._compact()
+
+    def forget(self, key: BundleKey):
+        """
+        Drops an expired bundle. No tombstone is needed, replays skip expired bundles.
+        """
+        self._drop(key)
+
+    def read(self, key: BundleKey) -> bytes:
+        """
+        Reads the payload of a live bundle back from its segment.
+        """
+        id, offset, size = self.entries[key].ref
+        return self.segments[id].map[offset + _frame.size:offset + size]
+
+    def _compact(self):
+        """
+        Rewrites the oldest segments while the log holds over twice the live bundles.
+        """
+        while len(self.segments) > 1 and self.size > 2 * self.live + self.segment_size:
+            oldest = self.segments.pop(next(iter(self.segments)))
+
+            for key, entry in list(self.entries.items()):
+                id, offset, size = entry.ref
+                if id != oldest.id:
+                    continue
+
+                record = oldest.map[offset:offset + size]
+                self.live -= size
+                entry.ref = self._append(record)
+                self.segments[entry.ref[0]].live += size
+                self.live += size
+
+            self.size -= oldest.end
+            oldest.remove()
+
+    def close(self):
+        """
+        Flushes and closes the segments.
+        """
+        for segment in self.segments.values():
+            segment.map.flush()
+            segment.close()
+        self.segments = {}
@@ -0,0 +1,100 @@
+"""
+Duplicate suppression on the receive paths.
+
+With multicast beacons, several gateways and multi-copy routing, the same
+payload reaches a gateway or a lobby several times, and each copy used to be
+decoded, handled and forwarded again. A payload is identified by the same fields as
+a bundle, its type, player, sequence number and source, unpacked straight from
+the header in a single call, so copies are dropped before they're decoded. This
+relies on no sender reusing a sequence number for a different payload, lobbies
+number every payload sent to a player, KALIVEs included.
+
+The keys seen are kept in a few sets, each covering a slice of the window. The
+oldest set is dropped as time goes by, so a lookup checks a fixed number of sets
+and memory is bound by the traffic of a single window. A set that fills up ends
+its slice early, which shortens the window instead of growing past the capacity.
+"""
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+import struct
+from threading import Lock
+import time
+from typing import Deque, Optional, Set, Tuple
+
+from .payload import HDR_PLAYER, HDR_SOURCE, HDR_TYPE, OFFSET
+from .types import Time
+
+_key = struct.Struct('!B8x4sl1x16s')
+"""The type, player, sequence number and source in a header, the other fields skipped."""
+
+assert _key.size == HDR_SOURCE + 16 and HDR_PLAYER == HDR_TYPE + 9
+
+Key = Tuple[int, bytes, int, bytes]
+"""The fields identifying a payload."""
+
+
+@dataclass
+class RecentSet:
+    """
+    The keys of the payloads received recently.
+
+    Attributes:
+        window: The time, in seconds, a key is remembered for, at least.
+        buckets: The number of slices of the window.
+        capacity: The max number of keys remembered.
+    """
+    window: float = field(default=10.0)
+    """The time, in seconds, a key is remembered for, at least."""
+    buckets: int = field(default=4)
+    """The number of slices of the window."""
+    capacity: int = field(default=1 << 16)
+    """The max number of keys remembered."""
+    generations: Deque[Set[Key]] = field(init=False)
+    """The keys of each slice, newest last."""
+    rotated: Time = field(init=False, default=0.0)
+    """The time the newest slice was started at."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the sets, the receive paths run on different threads."""
+
+    def __post_init__(self):
+        self.generations = deque([set()], maxlen=self.buckets + 1)
+
+    def __len__(self) -> int:
+        return sum(len(g) for g in self.generations)
+
+    def _rotate(self, now: Time):
+        steps = int((now - self.rotated) * self.buckets / self.window)
+
+        # a slice per span elapsed, the deque drops the oldest
+        for _ in range(min(max(steps, 1), self.buckets + 1)):
+            self.generations.append(set())
+        self.rotated = now
+
+    def seen(self, data: bytes | bytearray, now: Optional[Time] = None) -> bool:
+        """
+        Checks whether a copy of a payload was received recently, remembering it if not.
+
+        :param data: The serialized payload.
+        :param now: The current time, now if None.
+        :return: True if the payload is a duplicate and should be dropped.
+        """
+        # left to the decoder to reject
+        if len(data) < OFFSET:
+            return False
+
+        now = time.time() if now is None else now
+        key = _key.unpack_from(data)
+
+        with self.lock:
+            if now - self.rotated >= self.window / self.buckets or \
+                    len(self.generations[-1]) >= self.capacity // self.buckets:
+                self._rotate(now)
+
+            for generation in self.generations:
+                if key in generation:
+                    return True
+
+            self.generations[-1].add(key)
+
+        return False
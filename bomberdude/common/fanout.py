@@ -0,0 +1,85 @@
+"""
+Build-once, patch-per-recipient payload fan-out.
+
+Sending the same data to every conn of a lobby used to build a new Payload and
+call to_bytes() per conn, re-packing the whole header and copying the body each time.
+A FanOut packs the shared header fields once and only patches the per-recipient
+fields (player uuid, seq_num and destination) before each scatter/gather send.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from socket import socket
+import struct
+
+from .payload import HDR_DESTINATION, HDR_PLAYER, OFFSET, pattern
+from .types import Address
+
+_player_seq = struct.Struct('!4sl')
+"""Player uuid and seq_num, contiguous in the header."""
+
+_destination = struct.Struct('!16s')
+"""The destination's address."""
+
+
+@dataclass
+class FanOut:
+    """
+    A payload whose body is serialized once and sent to many recipients.
+
+    Attributes:
+        type: The type of payload.
+        data: The payload's data, shared by all recipients.
+        lobby_uuid: The lobby uuid.
+        source: The source of the payload.
+        lobby_port: Port of the lobby.
+        ttl: The time to live of the packet.
+    """
+    type: int
+    """The type of payload (action)."""
+    data: bytes
+    """The data to be sent, shared by every recipient."""
+    lobby_uuid: str
+    """The lobby uuid."""
+    source: bytes
+    """The source of the payload."""
+    lobby_port: int
+    """Port of the lobby."""
+    ttl: int = field(default=3)
+    """The time to live of the packet."""
+    header: bytearray = field(init=False, repr=False)
+    """Preallocated header, patched in place for each recipient."""
+
+    def __post_init__(self):
+        self.header = bytearray(OFFSET)
+        struct.pack_into(pattern, self.header, 0, self.type, len(self.data),
+                         bytes(self.lobby_uuid, 'utf-8'), b'', 0, self.ttl,
+                         self.source, b'', self.lobby_port)
+
+    def patch(self, player_uuid: str, seq_num: int, destination: bytes) -> bytearray:
+        """
+        Patches the per-recipient fields of the header.
+
+        :param player_uuid: The recipient's player uuid.
+        :param seq_num: The sequence number of the packet.
+        :param destination: The recipient's address in bytes.
+        :return: The patched header.
+        """
+        _player_seq.pack_into(self.header, HDR_PLAYER,
+                              bytes(player_uuid, 'utf-8'), seq_num)
+        _destination.pack_into(self.header, HDR_DESTINATION, destination)
+        return self.header
+
+    def sendto(self, sock: socket, address: Address, player_uuid: str,
+               seq_num: int, destination: bytes) -> int:
+        """
+        Sends the payload to a single recipient using scatter/gather I/O.
+
+        :param sock: The socket used to send the payload.
+        :param address: The recipient's address.
+        :param player_uuid: The recipient's player uuid.
+        :param seq_num: The sequence number of the packet.
+        :param destination: The recipient's address in bytes.
+        :return: The number of bytes sent.
+        """
+        header = self.patch(player_uuid, seq_num, destination)
+        return sock.sendmsg([header, self.data], [], 0, address)
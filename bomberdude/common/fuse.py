@@ -0,0 +1,138 @@
+"""
+Bomb fuse scheduling.
+
+Bombs used to live in a dict that was scanned every tick, with ids taken from
+len(bombs), so ids collided as soon as a bomb went off. The scheduler hands out
+monotonically increasing ids and keeps the fuses in a min-heap keyed on their
+detonation tick, so a tick only touches the bombs that are due. Bombs set off
+early by a chain reaction are dropped from the live set and skipped lazily once
+they reach the top of the heap.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import heapq
+from typing import Dict, List, Optional, Tuple
+
+
+@dataclass
+class Fuse:
+    """
+    A lit bomb.
+
+    Attributes:
+        id: The bomb's id, unique for the lifetime of the scheduler.
+        owner: The id of the player who planted the bomb.
+        x: The x position of the bomb.
+        y: The y position of the bomb.
+        tick: The tick the bomb detonates on.
+    """
+    id: int
+    """The bomb's id, unique for the lifetime of the scheduler."""
+    owner: int
+    """The id of the player who planted the bomb."""
+    x: int
+    """The x position of the bomb."""
+    y: int
+    """The y position of the bomb."""
+    tick: int
+    """The tick the bomb detonates on."""
+
+
+@dataclass
+class FuseScheduler:
+    """
+    Min-heap of bomb fuses, keyed on detonation tick.
+
+    Attributes:
+        heap: (tick, id) of every scheduled bomb, including detonated ones not yet popped.
+        fuses: The live bombs, indexed by id.
+        cells: The live bombs, indexed by position.
+    """
+    heap: List[Tuple[int, int]] = field(default_factory=list)
+    """(tick, id) of every scheduled bomb, including detonated ones not yet popped."""
+    fuses: Dict[int, Fuse] = field(default_factory=dict)
+    """The live bombs, indexed by id."""
+    cells: Dict[Tuple[int, int], int] = field(default_factory=dict)
+    """The live bombs, indexed by position."""
+    next_id: int = field(default=0)
+    """The id of the next bomb."""
+
+    def __len__(self) -> int:
+        return len(self.fuses)
+
+    def schedule(self, owner: int, x: int, y: int, tick: int) -> Fuse:
+        """
+        Lights a new bomb.
+
+        :param owner: The id of the player who planted the bomb.
+        :param x: The x position of the bomb.
+        :param y: The y position of the bomb.
+        :param tick: The tick the bomb detonates on.
+        :return: The new bomb.
+        """
+        fuse = Fuse(self.next_id, owner, x, y, tick)
+        self.next_id += 1
+
+        self.fuses[fuse.id] = fuse
+        self.cells[(x, y)] = fuse.id
+        heapq.heappush(self.heap, (tick, fuse.id))
+
+        return fuse
+
+    def at(self, x: int, y: int) -> Optional[Fuse]:
+        """
+        Finds the live bomb at a given position, used to chain explosions.
+
+        :return: The bomb or None.
+        """
+        id = self.cells.get((x, y))
+        return None if id is None else self.fuses[id]
+
+    def detonate(self, id: int) -> Optional[Fuse]:
+        """
+        Removes a bomb from the live set. Its heap entry is dropped lazily.
+
+        :param id: The id of the bomb.
+        :return: The bomb, or None if it already went off.
+        """
+        fuse = self.fuses.pop(id, None)
+
+        if fuse is None:
+            return None
+
+        if self.cells.get((fuse.x, fuse.y)) == id:
+            del self.cells[(fuse.x, fuse.y)]
+
+        # rebuild once stale entries dominate, so chains don't grow the heap unbounded
+        if len(self.heap) > 2 * len(self.fuses) + 32:
+            self.heap = [(f.tick, f.id) for f in self.fuses.values()]
+            heapq.heapify(self.heap)
+
+        return fuse
+
+    def due(self, tick: int) -> List[Fuse]:
+        """
+        Pops the bombs whose fuse ran out, in detonation order.
+        Only the bombs that are due are touched, O(k log n).
+
+        :param tick: The current tick.
+        :return: The bombs that detonate on this tick.
+        """
+        out = []
+
+        while self.heap and self.heap[0][0] <= tick:
+            _, id = heapq.heappop(self.heap)
+            fuse = self.detonate(id)
+
+            if fuse is not None:
+                out.append(fuse)
+
+        return out
+
+    def clear(self):
+        """
+        Drops every bomb. Ids keep increasing.
+        """
+        self.heap = []
+        self.fuses = {}
+        self.cells = {}
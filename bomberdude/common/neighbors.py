@@ -0,0 +1,338 @@
+"""
+Neighbour table of the nodes of the DTN.
+
+Nodes used to be kept forever once heard, so departed neighbours stayed relay
+candidates and the maps grew with every node ever met. The table expires a
+neighbour once it misses a few beacons in a row, keeping a heap of expiry times
+so only the neighbours due are looked at, and keeps link metrics on each of
+them from their beacons: the inter-arrival time, the beacon loss rate and the
+number of hops the beacon came across.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import heapq
+from socket import IPPROTO_IPV6, IPV6_HOPLIMIT, IPV6_RECVHOPLIMIT, CMSG_SPACE, socket
+import struct
+from threading import Lock
+import time
+from typing import Collection, Dict, Iterator, List, Optional, Tuple
+
+from .core_utils import get_node_distance
+from .spatial import SpatialIndex
+from .beacon import Velocity
+from .types import MCAST_HOPS, Address, Hops, Position, Time
+
+RTT_PRIOR = 0.05
+"""The round trip time, in seconds, a link is assumed to have until it's measured."""
+
+
+def enable_hops(sock: socket):
+    """
+    Asks the kernel for the hop limit of the datagrams received on a socket,
+    the hops a beacon came across are what's left of the limit it was sent with.
+    """
+    sock.setsockopt(IPPROTO_IPV6, IPV6_RECVHOPLIMIT, 1)
+
+
+def recv_beacon(sock: socket, size: int = 1500) -> Tuple[bytes, Address, Hops]:
+    """
+    Receives a datagram along with the number of hops it came across.
+
+    :param sock: The socket, set up with enable_hops.
+    :param size: The max size of the datagram.
+    :return: The datagram, the address it came from and the hops it came across,
+        0 if the hop limit wasn't reported.
+    """
+    data, ancdata, _, addr = sock.recvmsg(size, CMSG_SPACE(4))
+    hops = 0
+
+    for level, kind, value in ancdata:
+        if level == IPPROTO_IPV6 and kind == IPV6_HOPLIMIT:
+            hops = max(MCAST_HOPS - struct.unpack('@i', value[:4])[0], 0)
+
+    return data, addr, hops
+
+
+@dataclass
+class Neighbor:
+    """
+    A node heard from, with the quality of the link to it.
+
+    Attributes:
+        address: The node's address.
+        position: The node's last known position.
+        hops: The number of hops its last beacon came across.
+        period: The period the node sends beacons at.
+        first_seen: The time of its first beacon.
+        last_seen: The time of its last beacon.
+    """
+    address: Address
+    """The node's address."""
+    position: Position
+    """The node's last known position."""
+    hops: Hops
+    """The number of hops its last beacon came across."""
+    period: float
+    """The period the node sends beacons at."""
+    first_seen: Time
+    """The time of its first beacon."""
+    last_seen: Time
+    """The time of its last beacon."""
+    interval: float = field(init=False)
+    """Moving average of the time between its beacons."""
+    loss: float = field(init=False, default=0.0)
+    """Moving average of the fraction of its beacons that were lost."""
+    beacons: int = field(init=False, default=1)
+    """The number of beacons received."""
+    expires: Time = field(init=False, default=0.0)
+    """The time the node is dropped at, unless it's heard from again."""
+    load: float = field(init=False, default=0.0)
+    """The load the node advertised in its last beacon, in payloads relayed per second."""
+    rtt: float = field(init=False, default=RTT_PRIOR)
+    """Moving average of the time the node takes to take custody of a bundle."""
+    velocity: Velocity = field(init=False, default=(0.0, 0.0))
+    """The node's speed, per second, in its last beacon."""
+    seq: Optional[int] = field(init=False, default=None)
+    """The number of its last beacon, None if its beacons aren't numbered."""
+
+    def __post_init__(self):
+        self.interval = self.period
+
+    @property
+    def etx(self) -> float:
+        """
+        The expected number of transmissions for a packet to get through the link.
+        """
+        return 1 / max(1 - self.loss, 0.05)
+
+    @property
+    def cost(self) -> float:
+        """
+        The cost of handing traffic to the node, from the link to it, the hops it's
+        away, its round trip time and its load.
+        """
+        return self.etx * (1 + self.hops) * self.rtt * (1 + self.load)
+
+    def predicted(self, now: Time) -> Position:
+        """
+        The node's position extrapolated from its last beacon.
+        """
+        elapsed = now - self.last_seen
+        return (self.position[0] + self.velocity[0] * elapsed,
+                self.position[1] + self.velocity[1] * elapsed)
+
+
+@dataclass
+class NeighborTable:
+    """
+    The neighbours of a node, dropped once they stop sending beacons.
+
+    Attributes:
+        period: The default period of the beacons.
+        misses: The number of beacons in a row a neighbour can miss before it's dropped.
+        alpha: The weight of the last beacon in the moving averages.
+        cell: The side of the buckets of the spatial index.
+    """
+    period: float = field(default=1.0)
+    """The default period of the beacons."""
+    misses: int = field(default=3)
+    """The number of beacons in a row a neighbour can miss before it's dropped."""
+    alpha: float = field(default=0.25)
+    """The weight of the last beacon in the moving averages."""
+    cell: float = field(default=100.0)
+    """The side of the buckets of the spatial index."""
+    neighbors: Dict[Address, Neighbor] = field(init=False, default_factory=dict)
+    """The neighbours, indexed by address."""
+    index: SpatialIndex = field(init=False)
+    """The positions of the neighbours."""
+    heap: List[Tuple[Time, Address]] = field(init=False, default_factory=list)
+    """The expiry times, entries outdated by a later beacon are skipped when popped."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the table, beacons and queries come from different threads."""
+
+    def __post_init__(self):
+        self.index = SpatialIndex(self.cell)
+
+    def __len__(self) -> int:
+        return len(self.neighbors)
+
+    def __contains__(self, addr: Address) -> bool:
+        return addr in self.neighbors
+
+    def __getitem__(self, addr: Address) -> Neighbor:
+        return self.neighbors[addr]
+
+    def __iter__(self) -> Iterator[Neighbor]:
+        return iter(list(self.neighbors.values()))
+
+    def get(self, addr: Address) -> Optional[Neighbor]:
+        return self.neighbors.get(addr)
+
+    def beacon(self, addr: Address, position: Position, hops: Hops,
+               period: Optional[float] = None, now: Optional[Time] = None,
+               load: float = 0.0, velocity: Velocity = (0.0, 0.0),
+               seq: Optional[int] = None) -> Neighbor:
+        """
+        Records a beacon from a neighbour.
+
+        :param addr: The neighbour's address.
+        :param position: The position in the beacon.
+        :param hops: The number of hops the beacon came across.
+        :param period: The period the neighbour sends beacons at, the table's default if None.
+        :param now: The time the beacon was received at, now if None.
+        :param load: The load in the beacon.
+        :param velocity: The velocity in the beacon.
+        :param seq: The number of the beacon, the losses are counted from the numbers
+            if given, from the time between beacons otherwise.
+        :return: The neighbour.
+        """
+        now = time.time() if now is None else now
+        period = self.period if period is None else period
+
+        with self.lock:
+            neighbor = self.neighbors.get(addr)
+
+            if neighbor is None:
+                neighbor = Neighbor(addr, position, hops, period, now, now)
+                self.neighbors[addr] = neighbor
+            elif seq is not None and seq == neighbor.seq:
+                # a copy of the last beacon, come another way
+                return neighbor
+            else:
+                gap = now - neighbor.last_seen
+                if seq is not None and neighbor.seq is not None and seq > neighbor.seq:
+                    missed = seq - neighbor.seq - 1
+                else:
+                    # beacons that should have arrived in the gap but didn't
+                    missed = max(round(gap / period) - 1, 0)
+
+                neighbor.interval += self.alpha * (gap - neighbor.interval)
+                neighbor.loss += self.alpha * (missed / (missed + 1) - neighbor.loss)
+                neighbor.position = position
+                neighbor.hops = hops
+                neighbor.period = period
+                neighbor.last_seen = now
+                neighbor.beacons += 1
+
+            neighbor.load = load
+            neighbor.velocity = velocity
+            neighbor.seq = seq
+            neighbor.expires = now + self.misses * period
+            heapq.heappush(self.heap, (neighbor.expires, addr))
+            self.index.update(addr, position)
+
+            # every beacon pushes an entry, drop the outdated ones before they pile up
+            if len(self.heap) > 4 * len(self.neighbors) + 64:
+                self.heap = [(n.expires, a) for a, n in self.neighbors.items()]
+                heapq.heapify(self.heap)
+
+        return neighbor
+
+    def sample_rtt(self, addr: Address, rtt: float):
+        """
+        Records the time a neighbour took to take custody of a bundle.
+        """
+        with self.lock:
+            neighbor = self.neighbors.get(addr)
+            if neighbor is not None:
+                neighbor.rtt += self.alpha * (rtt - neighbor.rtt)
+
+    def remove(self, addr: Address):
+        """
+        Drops a neighbour, if present. Its heap entries are skipped when popped.
+        """
+        with self.lock:
+            self._remove(addr)
+
+    def _remove(self, addr: Address):
+        if self.neighbors.pop(addr, None) is not None:
+            self.index.remove(addr)
+
+    def expire(self, now: Optional[Time] = None) -> List[Address]:
+        """
+        Drops the neighbours that missed too many beacons.
+
+        :param now: The current time, now if None.
+        :return: The addresses of the neighbours dropped.
+        """
+        now = time.time() if now is None else now
+        expired = []
+
+        with self.lock:
+            while self.heap and self.heap[0][0] <= now:
+                expires, addr = heapq.heappop(self.heap)
+                neighbor = self.neighbors.get(addr)
+
+                # heard from since, or already dropped
+                if neighbor is None or neighbor.expires != expires:
+                    continue
+
+                self._remove(addr)
+                expired.append(addr)
+
+        return expired
+
+    def nearest(self, pos: Position, k: int = 1, exclude: Collection[Address] = (),
+                now: Optional[Time] = None) -> List[Tuple[float, Neighbor]]:
+        """
+        Finds the k live neighbours closest to a position.
+
+        :param now: The current time, now if None.
+        :return: The (distance, neighbour) of the closest neighbours, closest first.
+        """
+        self.expire(now)
+
+        with self.lock:
+            return [(dist, self.neighbors[addr])
+                    for dist, addr in self.index.nearest(pos, k, exclude)]
+
+    def cheapest(self, k: int, now: Optional[Time] = None) -> List[Neighbor]:
+        """
+        Finds the k live neighbours it costs the least to hand traffic to.
+
+        :param now: The current time, now if None.
+        :return: The neighbours, cheapest first.
+        """
+        self.expire(now)
+
+        with self.lock:
+            return heapq.nsmallest(k, self.neighbors.values(), key=lambda n: n.cost)
+
+    def best(self, pos: Position, k: int = 4, exclude: Collection[Address] = (),
+             now: Optional[Time] = None) -> Optional[Tuple[float, Neighbor]]:
+        """
+        Picks the relay towards a position, among the k neighbours closest to it,
+        trading their distance off against the losses of the links to them and
+        the hops they're away.
+
+        :return: The (distance, neighbour) picked, or None if there are no neighbours.
+        """
+        candidates = self.nearest(pos, k, exclude, now)
+
+        if not candidates:
+            return None
+
+        return min(candidates, key=lambda c: c[0] * c[1].etx * (1 + c[1].hops))
+
+    def toward(self, origin: Position, destination: Address,
+               now: Optional[Time] = None) -> Optional[Tuple[float, Neighbor]]:
+        """
+        Picks the relay that gets a message closer to a neighbour than the origin is.
+
+        :param origin: The position the message would be relayed from.
+        :param destination: The destination of the message.
+        :param now: The current time, now if None.
+        :return: The (distance to the destination, neighbour) picked, or None if no
+            neighbour is closer to the destination than the origin or it's not a neighbour.
+        """
+        neighbor = self.neighbors.get(destination)
+        if neighbor is None:
+            return None
+
+        target = neighbor.position
+        best = self.best(target, exclude=(destination,), now=now)
+
+        if best is not None and best[0] < get_node_distance(origin, target):
+            return best
+
+        return None
@@ -18,9 +18,15 @@ ERROR = 0xA0
 KALIVE = 0xC0
 GKALIVE = 0xC1  # gateway keepalive
 ACK = 0xC2
+CUSTODY = 0xC3  # the bundles in the data were taken into custody by the next hop
+ROUTING = 0xC4  # control data exchanged by the DTN routers of mobile nodes
+BATCH = 0xC5  # datagrams to the same lobby packed together by a gateway
+ALIVE = 0xC6  # the players of a lobby a gateway heard KALIVEs from
 # Game types
 ACTIONS = 0xD0
 STATE = 0xD1
+SPECTATE = 0xD2  # read-only subscription to a lobby's stream
+SNAPSHOT = 0xD3  # a part of the game state, a range of rows of the board
 
 ptypes = {
     ACCEPT: 'ACCEPT',
@@ -33,8 +39,14 @@ ptypes = {
     KALIVE: 'KALIVE',
     GKALIVE: 'GKALIVE',
     ACK: 'ACK',
+    CUSTODY: 'CUSTODY',
+    ROUTING: 'ROUTING',
+    BATCH: 'BATCH',
+    ALIVE: 'ALIVE',
     ACTIONS: 'ACTIONS',
-    STATE: 'STATE'
+    STATE: 'STATE',
+    SPECTATE: 'SPECTATE',
+    SNAPSHOT: 'SNAPSHOT'
 }
 
 pattern: str = '!Bl4s4slB16s16sl'
@@ -59,6 +71,20 @@ pattern: str = '!Bl4s4slB16s16sl'
 OFFSET: int = 54  # 1 + 4 + 4 + 4 + 4 + 1 + 16 + 16 + 4 = 54
 """The header's offset in bytes."""
 
+# Byte offsets of each header field, used to read or patch a field in place.
+HDR_TYPE: int = 0
+HDR_LENGTH: int = 1
+HDR_LOBBY: int = 5
+HDR_PLAYER: int = 9
+HDR_SEQ: int = 13
+HDR_TTL: int = 17
+HDR_SOURCE: int = 18
+HDR_DESTINATION: int = 34
+HDR_PORT: int = 50
+
+_destination_port = struct.Struct('!16sl')
+"""The destination and lobby port, contiguous at the end of the header."""
+
 
 @dataclass
 class Payload:
@@ -189,6 +215,33 @@ class Payload:
         """
         return self.type == ACK
 
+    @cached_property
+    def is_custody(self) -> bool:
+        """
+        Checks if the payload is a custody signal.
+
+        :return: True if the payload has a custody type.
+        """
+        return self.type == CUSTODY
+
+    @cached_property
+    def is_routing(self) -> bool:
+        """
+        Checks if the payload is routing control data.
+
+        :return: True if the payload has a routing type.
+        """
+        return self.type == ROUTING
+
+    @cached_property
+    def is_alive(self) -> bool:
+        """
+        Checks if the payload is a summary of the players heard from by a gateway.
+
+        :return: True if the payload has an alive type.
+        """
+        return self.type == ALIVE
+
     @cached_property
     def is_actions(self) -> bool:
         """
@@ -207,6 +260,24 @@ class Payload:
         """
         return self.type == STATE
 
+    @cached_property
+    def is_spectate(self) -> bool:
+        """
+        Checks if the payload is a spectate.
+
+        :return: True if the payload has a spectate type.
+        """
+        return self.type == SPECTATE
+
+    @cached_property
+    def is_snapshot(self) -> bool:
+        """
+        Checks if the payload is a part of a snapshot.
+
+        :return: True if the payload has a snapshot type.
+        """
+        return self.type == SNAPSHOT
+
     @cached_property
     def short_destination(self) -> str:
         """
@@ -273,3 +344,102 @@ class Payload:
             self.destination,
             self.lobby_port
         ) + self.data
+
+
+def set_ttl(buffer: bytearray, ttl: int):
+    """
+    Patches the ttl of a serialized payload in place.
+
+    :param buffer: The serialized payload.
+    :param ttl: The new ttl.
+    """
+    buffer[HDR_TTL] = ttl
+
+
+@dataclass(eq=False)
+class Frame:
+    """
+    A serialized payload that is relayed as is.
+
+    Relays only need a payload's type, destination and port, so those are read
+    at their fixed offsets instead of decoding the whole payload, and the datagram
+    is sent on untouched. A Frame stands in for a Payload in caches and relays.
+    Frames are compared by identity, decoding them to compare is what they avoid.
+
+    Attributes:
+        buffer: The datagram, as received.
+        type: The type of payload.
+        destination: The destination of the payload.
+        lobby_port: The port of the lobby.
+    """
+    buffer: bytes | bytearray
+    """The datagram, as received."""
+    type: int = field(init=False)
+    """The type of payload."""
+    destination: bytes = field(init=False)
+    """The destination of the payload."""
+    lobby_port: int = field(init=False)
+    """The port of the lobby."""
+
+    def __post_init__(self):
+        if len(self.buffer) < OFFSET:
+            raise ValueError(f'Truncated header, {len(self.buffer)} bytes')
+
+        self.type = self.buffer[HDR_TYPE]
+        self.destination, self.lobby_port = _destination_port.unpack_from(
+            self.buffer, HDR_DESTINATION)
+
+    @property
+    def type_str(self) -> str:
+        """
+        Retrieves the payload type str representation.
+        """
+        return ptypes.get(self.type, 'UNKNOWN')
+
+    @property
+    def ttl(self) -> int:
+        """
+        The time to live of the packet.
+        """
+        return self.buffer[HDR_TTL]
+
+    @ttl.setter
+    def ttl(self, ttl: int):
+        if not isinstance(self.buffer, bytearray):
+            # copy on write, most frames are never patched
+            self.buffer = bytearray(self.buffer)
+        set_ttl(self.buffer, ttl)
+
+    @property
+    def is_ack(self) -> bool:
+        """
+        Checks if the payload is an ack.
+        """
+        return self.type == ACK
+
+    @property
+    def is_custody(self) -> bool:
+        """
+        Checks if the payload is a custody signal.
+        """
+        return self.type == CUSTODY
+
+    @property
+    def data(self) -> bytes:
+        """
+        The payload's data, copied out of the buffer.
+        """
+        return bytes(self.buffer[OFFSET:])
+
+    @cached_property
+    def short_destination(self) -> str:
+        """
+        Retrieves the short representation of the destination.
+        """
+        return ip_address(self.destination).compressed
+
+    def to_bytes(self) -> bytes | bytearray:
+        """
+        The datagram to send, the buffer itself.
+        """
+        return self.buffer
@@ -0,0 +1,233 @@
+"""
+Binary match replays.
+
+A replay file starts with a small header, followed by blocks. Each block is a
+length-prefixed, optionally compressed, run of records. A record is a tick,
+a kind and a length-prefixed body:
+
+    header: magic (4s) | format version (B)
+    block:  stored length (I) | codec (B) | data
+    record: tick (I) | kind (B) | length (I) | body
+
+The lobby records the map once the game starts, then every batch of changes it
+accepted along with the version and digest of its state after the batch. The
+replay engine maps the file in memory and re-executes the changes on a headless
+GameState, so state logic can be regression-tested, desyncs reproduced and the
+simulation benchmarked without the network stack.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import mmap
+import struct
+from threading import Lock
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+import zlib
+
+from .state import Change, GameState, bytes_from_changes, change_from_bytes, parse_stamp
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC: bytes = b'BDRP'
+FORMAT: int = 3
+
+# Block codecs
+RAW = 0x00
+ZLIB = 0x01
+ZSTD = 0x02
+
+codecs = {
+    'raw': RAW,
+    'zlib': ZLIB,
+    'zstd': ZSTD,
+}
+
+# Record kinds
+SNAPSHOT = 0x01
+"""A part of a snapshot of the game state, the whole state takes one record per part."""
+CHANGES = 0x02
+"""A batch of accepted changes, in their wire format."""
+STAMP = 0x03
+"""The version and digest of the state after the previous batch."""
+
+_header = struct.Struct('!4sB')
+_block = struct.Struct('!IB')
+_record = struct.Struct('!IBI')
+
+
+def _compress(codec: int, data: bytes) -> bytes:
+    if codec == ZLIB:
+        return zlib.compress(data)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor().compress(data)
+    return data
+
+
+def _decompress(codec: int, data: memoryview) -> memoryview:
+    if codec == ZLIB:
+        return memoryview(zlib.decompress(data))
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError('Replay uses zstd, which is not installed')
+        return memoryview(zstandard.ZstdDecompressor().decompress(data))
+    return data
+
+
+@dataclass
+class ReplayWriter:
+    """
+    Appends records to a replay file.
+
+    Attributes:
+        path: The path of the replay file.
+        codec: The codec used to compress blocks, zstd falls back to zlib if it's not installed.
+        block_size: The size of the uncompressed blocks, in bytes.
+    """
+    path: str
+    """The path of the replay file."""
+    codec: int = field(default=ZLIB)
+    """The codec used to compress blocks."""
+    block_size: int = field(default=1 << 16)
+    """The size of the uncompressed blocks, in bytes."""
+    file: BinaryIO = field(init=False)
+    """The replay file."""
+    buffer: bytearray = field(init=False, default_factory=bytearray)
+    """Records not yet written to the file."""
+
+    def __post_init__(self):
+        if self.codec == ZSTD and zstandard is None:
+            self.codec = ZLIB
+
+        self.file = open(self.path, 'wb')
+        self.file.write(_header.pack(MAGIC, FORMAT))
+
+    def _record(self, tick: int, kind: int, body: bytes):
+        self.buffer += _record.pack(tick, kind, len(body))
+        self.buffer += body
+
+        if len(self.buffer) >= self.block_size:
+            self.flush()
+
+    def snapshot(self, tick: int, state: GameState):
+        """
+        Records the whole game state.
+        """
+        for part in state.snapshot():
+            self._record(tick, SNAPSHOT, part)
+
+    def changes(self, tick: int, changes: List[Change], state: GameState):
+        """
+        Records a batch of changes, along with the state's version and digest once they're applied.
+
+        :param tick: The tick the changes were applied on.
+        :param changes: The changes.
+        :param state: The state the changes were applied to.
+        """
+        self._record(tick, CHANGES, bytes_from_changes(changes))
+        self._record(tick, STAMP, state.stamp())
+
+    def flush(self):
+        """
+        Writes the buffered records to the file as a block.
+        """
+        if not self.buffer:
+            return
+
+        data = _compress(self.codec, bytes(self.buffer))
+        self.file.write(_block.pack(len(data), self.codec))
+        self.file.write(data)
+        self.file.flush()
+        self.buffer = bytearray()
+
+    def close(self):
+        """
+        Flushes the remaining records and closes the file.
+        """
+        self.flush()
+        self.file.close()
+
+
+@dataclass
+class ReplayEngine:
+    """
+    Re-executes a replay file on a headless game state.
+
+    Attributes:
+        path: The path of the replay file.
+    """
+    path: str
+    """The path of the replay file."""
+    ticks: int = field(init=False, default=0)
+    """The number of ticks replayed by the last run."""
+    changes: int = field(init=False, default=0)
+    """The number of changes replayed by the last run."""
+    mismatches: List[Tuple[int, int]] = field(init=False, default_factory=list)
+    """The (tick, version) where the replayed digest differed from the recorded one."""
+
+    def records(self) -> Iterator[Tuple[int, int, bytes]]:
+        """
+        Iterates over the records of the file.
+        Uncompressed blocks are read in place from the mapped file.
+
+        :return: The tick, kind and body of each record.
+        """
+        with open(self.path, 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm, \
+                memoryview(mm) as view:
+            magic, version = _header.unpack_from(view)
+            if magic != MAGIC or version != FORMAT:
+                raise ValueError(f'Not a replay file: {self.path}')
+
+            offset = _header.size
+            while offset + _block.size <= len(view):
+                length, codec = _block.unpack_from(view, offset)
+                offset += _block.size
+
+                with view[offset:offset + length] as data, _decompress(codec, data) as block:
+                    pos = 0
+                    while pos < len(block):
+                        tick, kind, size = _record.unpack_from(block, pos)
+                        pos += _record.size
+                        yield tick, kind, bytes(block[pos:pos + size])
+                        pos += size
+
+                offset += length
+
+    def run(self, until: Optional[int] = None, verify: bool = True) -> GameState:
+        """
+        Replays the file.
+
+        :param until: The last tick to replay, the whole file if None.
+        :param verify: Whether to compare the replayed digests with the recorded ones.
+        :return: The game state at the end of the replay.
+        """
+        state = GameState(Lock(), {}, {})
+        self.ticks = 0
+        self.changes = 0
+        self.mismatches = []
+        last = -1
+
+        for tick, kind, body in self.records():
+            if until is not None and tick > until:
+                break
+
+            if tick != last:
+                self.ticks += 1
+                last = tick
+
+            if kind == SNAPSHOT:
+                state.load_snapshot(body)
+
+            elif kind == CHANGES:
+                for change in change_from_bytes(body):
+                    state._apply_change(change)
+                    self.changes += 1
+
+            elif kind == STAMP and verify:
+                version, digest = parse_stamp(body)
+                if state.version != version or state.digest != digest:
+                    self.mismatches.append((tick, version))
+
+        return state
@@ -0,0 +1,189 @@
+"""
+Rollback of the game state for late inputs.
+
+Actions used to be applied in arrival order, so an action delayed by a slow
+(e.g. DTN) path landed after its player's newer actions and undid them. The
+lobby now keeps, for the last few ticks, a compact copy of the game state taken
+at the start of each tick along with the inputs applied during it. An input that
+arrives after a newer input from the same player is slotted back where it
+belongs, and the ticks since are re-simulated on a scratch state.
+
+Players have already been sent the inputs in arrival order, so the live state
+isn't replaced by the re-simulated one. Instead, the players whose position
+differs get a correcting move, applied by the lobby and the players alike. This
+keeps the lobby and its players hashing the same sequence of changes.
+"""
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Deque, List, Optional, Tuple
+
+from .state import PLAYER_TILE, Change, GameState, Saved
+
+
+@dataclass
+class Input:
+    """
+    The changes sent by a player in a single payload.
+
+    Attributes:
+        player: The uuid of the player.
+        seq_num: The sequence number of the payload.
+        changes: The changes in the payload.
+    """
+    player: str
+    """The uuid of the player."""
+    seq_num: int
+    """The sequence number of the payload."""
+    changes: List[Change]
+    """The changes in the payload."""
+
+
+@dataclass
+class Frame:
+    """
+    A tick of the game.
+
+    Attributes:
+        tick: The tick number.
+        saved: The game state at the start of the tick.
+        inputs: The inputs of the tick, in the order they're simulated.
+    """
+    tick: int
+    """The tick number."""
+    saved: Saved
+    """The game state at the start of the tick."""
+    inputs: List[Input] = field(default_factory=list)
+    """The inputs of the tick, in the order they're simulated."""
+
+
+@dataclass
+class Rollback:
+    """
+    Ring buffer of the last ticks of a game, used to re-simulate late inputs.
+
+    Attributes:
+        window: The number of ticks an input can be late by and still be slotted back.
+    """
+    window: int = field(default=32)
+    """The number of ticks an input can be late by and still be slotted back."""
+    frames: Deque[Frame] = field(init=False)
+    """The last ticks, oldest first."""
+    tick: int = field(init=False, default=0)
+    """The current tick."""
+    rollbacks: int = field(init=False, default=0)
+    """The number of times the game was re-simulated."""
+
+    def __post_init__(self):
+        self.frames = deque(maxlen=self.window)
+
+    def clear(self):
+        """
+        Forgets every tick, called when a game ends.
+        """
+        self.frames.clear()
+        self.tick = 0
+
+    def begin(self, state: GameState):
+        """
+        Starts a new tick, saving the game state.
+        Ticks without inputs share the copy of the previous one.
+
+        :param state: The live game state.
+        """
+        self.tick += 1
+
+        if self.frames and not self.frames[-1].inputs:
+            saved = self.frames[-1].saved
+        else:
+            saved = state.save()
+
+        self.frames.append(Frame(self.tick, saved))
+
+    def _locate(self, input: Input) -> Optional[Tuple[int, int]]:
+        """
+        Finds where an input belongs: before the oldest input of the same player
+        with a higher sequence number.
+
+        :return: The (frame, input) indexes, None if the input isn't late.
+        """
+        for i, frame in enumerate(self.frames):
+            for j, other in enumerate(frame.inputs):
+                if other.player == input.player and other.seq_num > input.seq_num:
+                    return i, j
+
+        return None
+
+    def is_duplicate(self, input: Input) -> bool:
+        """
+        Checks whether the input was already applied, e.g. a retransmission.
+        """
+        return any(other.player == input.player and other.seq_num == input.seq_num
+                   for frame in self.frames for other in frame.inputs)
+
+    def submit(self, state: GameState, input: Input) -> Optional[List[Change]]:
+        """
+        Records an input in the current tick, re-simulating the game if it's late.
+        The caller still applies the input's changes to the live state, followed by the corrections.
+
+        :param state: The live game state, before the input is applied.
+        :param input: The input.
+        :return: The corrections to apply after the input, None if the input is a duplicate.
+        """
+        if not self.frames:
+            self.begin(state)
+
+        if self.is_duplicate(input):
+            return None
+
+        slot = self._locate(input)
+
+        if slot is None:
+            self.frames[-1].inputs.append(input)
+            return []
+
+        i, j = slot
+        self.frames[i].inputs.insert(j, input)
+        self.rollbacks += 1
+
+        right = self._resimulate(state, i)
+
+        # what the players will have: the live state with the input applied last
+        wrong = GameState(Lock(), {}, {}, size=state.size)
+        wrong.restore(state.save())
+        for change in input.changes:
+            wrong._apply_change(change)
+
+        corrections = []
+        for id, (x, y) in wrong.players.items():
+            if id in right.players and right.players[id] != (x, y):
+                nx, ny = right.players[id]
+                corrections.append(Change((x, y, id + PLAYER_TILE),
+                                          (nx, ny, id + PLAYER_TILE)))
+
+        return corrections
+
+    def _resimulate(self, state: GameState, start: int) -> GameState:
+        """
+        This method shouldn't be called directly from outside the class.
+
+        Re-simulates the ticks from a given frame on, updating the copies saved at
+        the start of the following ticks.
+
+        :param state: The live game state, only used for its size.
+        :param start: The index of the first frame to re-simulate.
+        :return: The scratch state at the end of the current tick.
+        """
+        scratch = GameState(Lock(), {}, {}, size=state.size)
+        scratch.restore(self.frames[start].saved)
+
+        for k in range(start, len(self.frames)):
+            if k > start:
+                self.frames[k].saved = scratch.save()
+
+            for input in self.frames[k].inputs:
+                for change in input.changes:
+                    scratch._apply_change(change)
+
+        return scratch
@@ -0,0 +1,464 @@
+"""
+DTN routing strategies of the mobile nodes.
+
+Every strategy works on the same neighbour table and bundle store, and only
+decides which nodes in contact a bundle is sent to, and whether a bundle can be
+dropped once a node takes custody of it. A node in contact is a neighbour whose
+beacons reach us directly. Bundles meant for the server are delivered by
+handing them to any gateway in contact, the gateways reach it over the wire.
+
+- geographic: a single copy, handed to the node that gets it closest to its destination.
+- direct: a single copy, only ever handed to its destination. Least traffic, most latency.
+- epidemic: a copy to every node in contact that doesn't hold one, which nodes exchange
+  summary vectors of the bundles they hold to find out. Most traffic, least latency.
+- spray: binary spray and wait, a bundle starts with L copies, half of them are handed to
+  each node met that doesn't hold one, and the last copy waits to meet the destination.
+- prophet: a copy to the nodes more likely to meet the destination than this node is,
+  from the delivery predictabilities the nodes exchange.
+
+Bundles for the server are spread over the few gateways it costs the least to
+hand them to, by weighted rendezvous hashing of their keys: each bundle sticks to
+a gateway while it's alive, and only the bundles of a gateway that goes quiet
+move to the others.
+
+Routers exchange control data with the nodes in contact in ROUTING payloads, the
+first byte of which is the id of the router, so nodes running another strategy
+ignore it.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from ipaddress import ip_address
+import math
+import struct
+from socket import AF_INET6, inet_pton
+import time
+from typing import ClassVar, Dict, List, Optional, Set, Tuple, Type
+import zlib
+
+from .bundle import SIGNAL_KEYS, Bundle, BundleKey, BundleStore, split_keys
+from .neighbors import Neighbor, NeighborTable
+from .types import Address, Position, Time
+
+_grant = struct.Struct('!25sB')
+"""The key of a bundle and the copies of it handed over."""
+
+_predictability = struct.Struct('!16sHf')
+"""A destination and the delivery predictability to it."""
+
+CONTROL_ENTRIES = 64
+"""The max number of entries in a ROUTING payload, so it fits a datagram."""
+
+
+@dataclass
+class Router:
+    """
+    Geographic routing: a single copy of each bundle, handed to the node that gets it
+    closest to its destination, or to the preferred node for the server.
+
+    Attributes:
+        address: The address of this node.
+        neighbors: The nodes in range, gateways included.
+        gateways: The gateways in range.
+        bundles: The bundles held by this node.
+        server: The address of the server, reached through any gateway.
+        period: The time, in seconds, between control exchanges with a node in contact.
+    """
+    id: ClassVar[int] = 0
+    """The id of the router, first byte of its control data."""
+    name: ClassVar[str] = 'geographic'
+    """The name the router is selected by."""
+    single: ClassVar[bool] = True
+    """Whether a bundle is dropped once any node takes custody of it, not only its destination."""
+
+    address: Address
+    """The address of this node."""
+    neighbors: NeighborTable
+    """The nodes in range, gateways included."""
+    gateways: NeighborTable
+    """The gateways in range."""
+    bundles: BundleStore
+    """The bundles held by this node."""
+    server: Address = field(default=('', 0))
+    """The address of the server, reached through any gateway."""
+    period: float = field(default=2.0)
+    """The time, in seconds, between control exchanges with a node in contact."""
+    spread: int = field(default=2)
+    """The number of gateways, the cheapest, the bundles for the server are spread over."""
+    position: Position = field(init=False, default=(0.0, 0.0))
+    """The last known position of this node."""
+    preferred: Optional[Address] = field(init=False, default=None)
+    """The preferred node towards the server."""
+    now: Time = field(init=False, default=0.0)
+    """The time of the last round."""
+    met: Set[Address] = field(init=False, default_factory=set)
+    """The nodes in contact at the last round."""
+    exchanged: Dict[Address, Time] = field(init=False, default_factory=dict)
+    """The time of the last control exchange with each node in contact."""
+    known: Dict[Address, Set[BundleKey]] = field(init=False, default_factory=dict)
+    """The bundles each node in contact is known to hold."""
+
+    def contacts(self, now: Optional[Time] = None) -> List[Neighbor]:
+        """
+        The nodes in contact, noting the nodes met and lost since the last round.
+        """
+        now = time.time() if now is None else now
+        self.now = now
+        self.neighbors.expire(now)
+
+        # the bundles a gone gateway never took are handed to the others straight away
+        if self.gateways.expire(now):
+            self.bundles.rewind(self.server)
+
+        contacts = [n for n in self.neighbors if n.hops == 0 and n.address != self.address]
+        current = {n.address for n in contacts}
+
+        for addr in self.met - current:
+            self.lost(addr)
+        for addr in current - self.met:
+            self.encounter(addr, now)
+
+        self.met = current
+        return contacts
+
+    def encounter(self, addr: Address, now: Time):
+        """
+        Called when a node comes in contact.
+        """
+
+    def lost(self, addr: Address):
+        """
+        Called when a node goes out of contact.
+        """
+        self.known.pop(addr, None)
+        self.exchanged.pop(addr, None)
+
+    def is_sink(self, addr: Address, destination: Address) -> bool:
+        """
+        Checks whether handing a bundle to a node delivers it.
+        """
+        return addr == destination or (destination == self.server and addr in self.gateways)
+
+    def uplink(self, key: BundleKey, gateways: List[Neighbor]) -> Optional[Address]:
+        """
+        The gateway a bundle for the server is handed to, among the cheapest few.
+        Each gateway draws a score from the key and its address, weighted by its cost,
+        and the lowest wins.
+
+        :return: The gateway, or None if there are none.
+        """
+        cheapest = sorted(gateways, key=lambda n: n.cost)[:self.spread]
+        if not cheapest:
+            return None
+
+        def score(n: Neighbor) -> float:
+            draw = (zlib.crc32(key + n.address[0].encode()) + 1) / (1 << 32)
+            return -math.log(draw) * n.cost
+
+        return min(cheapest, key=score).address
+
+    def sinks(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        """
+        The nodes in contact a bundle is delivered by, a single gateway for the server.
+        """
+        if bundle.destination == self.server:
+            gateways = [self.gateways.get(n.address) for n in contacts if n.address in self.gateways]
+            gateway = self.uplink(bundle.key, [g for g in gateways if g is not None])
+            return [] if gateway is None else [gateway]
+
+        return [n.address for n in contacts if n.address == bundle.destination]
+
+    def relays(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Neighbor]:
+        """
+        The mobile nodes in contact that could carry a bundle, those known to hold it excluded.
+        """
+        return [n for n in contacts if n.address not in self.gateways and
+                n.address != bundle.destination and bundle.key not in self.known.get(n.address, ())]
+
+    def targets(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        """
+        The nodes to send a bundle to, now.
+
+        :param bundle: A bundle due to be forwarded.
+        :param contacts: The nodes in contact.
+        :return: The nodes, none to keep holding the bundle.
+        """
+        sinks = self.sinks(bundle, contacts)
+        if sinks:
+            return sinks[:1]
+
+        if bundle.destination == self.server:
+            # a node closer to the gateway picked for the bundle, or the preferred node
+            gateway = self.uplink(bundle.key, list(self.gateways))
+            relay = None if gateway is None else self.neighbors.toward(self.position, gateway, self.now)
+            if relay is not None:
+                return [relay[1].address]
+
+            preferred = self.preferred
+            return [preferred] if preferred in self.neighbors and preferred != self.address else []
+
+        relay = self.neighbors.toward(self.position, bundle.destination, self.now)
+        if relay is not None:
+            return [relay[1].address]
+
+        return [bundle.destination] if bundle.destination in self.neighbors else []
+
+    def created(self, key: BundleKey):
+        """
+        Called when this node queues a bundle of its own.
+        """
+
+    def received(self, prev_hop: Address, key: BundleKey):
+        """
+        Called when a bundle is taken into custody from a node.
+        """
+        self.known.setdefault(prev_hop, set()).add(key)
+
+    def taken(self, hop: Address, key: BundleKey, now: Optional[Time] = None) -> bool:
+        """
+        Called when a node took custody of a bundle.
+
+        :param now: The time the custody signal was received at, now if None.
+        :return: Whether the bundle can be dropped.
+        """
+        now = time.time() if now is None else now
+        self.known.setdefault(hop, set()).add(key)
+        bundle = self.bundles.get(key)
+
+        if bundle is None:
+            return False
+
+        # only bundles forwarded once tell how long the gateway took
+        if hop in self.gateways and bundle.attempts == 1:
+            self.gateways.sample_rtt(hop, now - bundle.sent)
+
+        return self.single or self.is_sink(hop, bundle.destination)
+
+    def summary(self, addr: Address) -> List[bytes]:
+        """
+        The control data to send a node in contact, every period.
+        """
+        return []
+
+    def pending(self) -> List[Tuple[Address, bytes]]:
+        """
+        The control data to send as soon as possible.
+        """
+        return []
+
+    def control(self, contacts: List[Neighbor], now: Optional[Time] = None) -> List[Tuple[Address, bytes]]:
+        """
+        The control data to send to the nodes in contact.
+
+        :return: The (node, ROUTING data) to send.
+        """
+        now = time.time() if now is None else now
+        out = []
+
+        for n in contacts:
+            if n.address in self.gateways or now - self.exchanged.get(n.address, -self.period) < self.period:
+                continue
+
+            self.exchanged[n.address] = now
+            out += [(n.address, body) for body in self.summary(n.address)]
+
+        return [(addr, bytes([self.id]) + body) for addr, body in out + self.pending()]
+
+    def absorb(self, addr: Address, body: bytes):
+        """
+        Takes in the control data of a node.
+        """
+
+    def on_control(self, addr: Address, data: bytes):
+        """
+        Handles a ROUTING payload, ignored if it's from another strategy.
+        """
+        if data and data[0] == self.id:
+            self.absorb(addr, data[1:])
+
+
+@dataclass
+class Direct(Router):
+    """
+    Direct delivery: a single copy of each bundle, only ever handed to its destination.
+    """
+    id: ClassVar[int] = 1
+    name: ClassVar[str] = 'direct'
+
+    def targets(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        return self.sinks(bundle, contacts)[:1]
+
+
+@dataclass
+class Epidemic(Router):
+    """
+    Epidemic routing: a copy of each bundle to every node in contact that doesn't hold one.
+    Nodes in contact exchange summary vectors, the keys of the bundles they hold.
+    """
+    id: ClassVar[int] = 2
+    name: ClassVar[str] = 'epidemic'
+    single: ClassVar[bool] = False
+
+    heard: Set[Address] = field(init=False, default_factory=set)
+    """The nodes in contact whose summary vector arrived, bundles are only copied to those."""
+
+    def lost(self, addr: Address):
+        super().lost(addr)
+        self.heard.discard(addr)
+
+    def targets(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        sinks = self.sinks(bundle, contacts)
+        if sinks:
+            return sinks[:1]
+
+        return [n.address for n in self.relays(bundle, contacts) if n.address in self.heard]
+
+    def summary(self, addr: Address) -> List[bytes]:
+        keys = [key for key in list(self.bundles.keys) if key not in self.known.get(addr, ())]
+        # sent even when empty, so the node knows this one is listening
+        return [b''.join(keys[i:i + SIGNAL_KEYS]) for i in range(0, len(keys), SIGNAL_KEYS)] or [b'']
+
+    def absorb(self, addr: Address, body: bytes):
+        self.heard.add(addr)
+        self.known.setdefault(addr, set()).update(split_keys(body))
+
+
+@dataclass
+class SprayAndWait(Router):
+    """
+    Binary spray and wait: a bundle of this node starts with L copies, half of those left
+    are handed to each node met that doesn't hold one, and the last copy is only handed
+    to the destination.
+
+    Attributes:
+        copies: The copies of each bundle of this node, L.
+    """
+    id: ClassVar[int] = 3
+    name: ClassVar[str] = 'spray'
+    single: ClassVar[bool] = False
+
+    copies: int = field(default=8)
+    """The copies of each bundle of this node, L."""
+    tokens: Dict[BundleKey, int] = field(init=False, default_factory=dict)
+    """The copies left of each bundle held, those missing have one."""
+    grants: Dict[Address, List[Tuple[BundleKey, int]]] = field(init=False, default_factory=dict)
+    """The copies handed to each node, yet to be told to it."""
+
+    def created(self, key: BundleKey):
+        self.tokens[key] = self.copies
+
+    def targets(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        sinks = self.sinks(bundle, contacts)
+        if sinks:
+            return sinks[:1]
+
+        left = self.tokens.get(bundle.key, 1)
+        relays = self.relays(bundle, contacts)
+
+        if left <= 1 or not relays:
+            return []
+
+        # spray phase, the copies are taken back if the node never gets the bundle
+        relay = relays[0].address
+        self.tokens[bundle.key] = left - left // 2
+        self.known.setdefault(relay, set()).add(bundle.key)
+        self.grants.setdefault(relay, []).append((bundle.key, left // 2))
+
+        return [relay]
+
+    def pending(self) -> List[Tuple[Address, bytes]]:
+        grants, self.grants = self.grants, {}
+
+        # the copies of the bundles no longer held
+        if len(self.tokens) > 2 * len(self.bundles) + 64:
+            self.tokens = {k: n for k, n in self.tokens.items() if k in self.bundles}
+
+        return [(addr, b''.join(_grant.pack(key, min(n, 255)) for key, n in entries[i:i + CONTROL_ENTRIES]))
+                for addr, entries in grants.items() for i in range(0, len(entries), CONTROL_ENTRIES)]
+
+    def absorb(self, addr: Address, body: bytes):
+        for key, n in _grant.iter_unpack(body[:len(body) - len(body) % _grant.size]):
+            self.tokens[key] = max(self.tokens.get(key, 1), n)
+
+
+@dataclass
+class Prophet(Router):
+    """
+    PRoPHET: a copy of each bundle to the nodes in contact more likely to meet its
+    destination than this node is. Meeting a node raises the predictability of meeting it
+    again, predictabilities age as time goes by and are passed on, weakened, by the nodes met.
+    Meeting any gateway counts as meeting the server.
+
+    Attributes:
+        p_init: The predictability added by an encounter.
+        beta: The weight of the predictabilities passed on.
+        gamma: The aging of the predictabilities, per second.
+    """
+    id: ClassVar[int] = 4
+    name: ClassVar[str] = 'prophet'
+    single: ClassVar[bool] = False
+
+    p_init: float = field(default=0.75)
+    """The predictability added by an encounter."""
+    beta: float = field(default=0.25)
+    """The weight of the predictabilities passed on."""
+    gamma: float = field(default=0.98)
+    """The aging of the predictabilities, per second."""
+    predictability: Dict[Address, float] = field(init=False, default_factory=dict)
+    """The predictability of meeting each destination."""
+    theirs: Dict[Address, Dict[Address, float]] = field(init=False, default_factory=dict)
+    """The predictabilities of each node in contact."""
+    aged: Time = field(init=False, default=0.0)
+    """The time the predictabilities were last aged."""
+
+    def _age(self, now: Time):
+        factor = self.gamma ** max(now - self.aged, 0) if self.aged else 1.0
+        self.aged = now
+        self.predictability = {d: p * factor for d, p in self.predictability.items() if p * factor > 0.01}
+
+    def encounter(self, addr: Address, now: Time):
+        self._age(now)
+        destination = self.server if addr in self.gateways else addr
+        p = self.predictability.get(destination, 0.0)
+        self.predictability[destination] = p + (1 - p) * self.p_init
+
+    def lost(self, addr: Address):
+        super().lost(addr)
+        self.theirs.pop(addr, None)
+
+    def targets(self, bundle: Bundle, contacts: List[Neighbor]) -> List[Address]:
+        sinks = self.sinks(bundle, contacts)
+        if sinks:
+            return sinks[:1]
+
+        ours = self.predictability.get(bundle.destination, 0.0)
+        return [n.address for n in self.relays(bundle, contacts)
+                if self.theirs.get(n.address, {}).get(bundle.destination, 0.0) > ours]
+
+    def control(self, contacts: List[Neighbor], now: Optional[Time] = None) -> List[Tuple[Address, bytes]]:
+        now = time.time() if now is None else now
+        self._age(now)
+        return super().control(contacts, now)
+
+    def summary(self, addr: Address) -> List[bytes]:
+        entries = [_predictability.pack(inet_pton(AF_INET6, d[0]), d[1], p)
+                   for d, p in self.predictability.items()]
+        return [b''.join(entries[i:i + CONTROL_ENTRIES]) for i in range(0, len(entries), CONTROL_ENTRIES)]
+
+    def absorb(self, addr: Address, body: bytes):
+        vector = self.theirs.setdefault(addr, {})
+        via = self.predictability.get(addr, 0.0)
+
+        for raw, port, p in _predictability.iter_unpack(body[:len(body) - len(body) % _predictability.size]):
+            destination = (ip_address(raw).compressed, port)
+            vector[destination] = p
+
+            # transitivity, the destinations of the node are reached through it
+            if destination != self.address:
+                self.predictability[destination] = max(
+                    self.predictability.get(destination, 0.0), via * p * self.beta)
+
+
+routers: Dict[str, Type[Router]] = {
+    r.name: r for r in (Router, Direct, Epidemic, SprayAndWait, Prophet)
+}
+"""The routers, by name."""
@@ -0,0 +1,143 @@
+"""
+Spatial index of the nodes of the DTN.
+
+Relays were picked by computing the distance to every known node and taking
+the min, every second on each node and on every relayed message in the gateway.
+The index buckets the nodes in a uniform grid, updated as their KALIVEs arrive,
+and answers nearest neighbour queries by scanning rings of buckets outwards from
+the query point, stopping as soon as no unscanned bucket can hold a closer node.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import heapq
+import math
+from typing import Collection, Dict, List, Optional, Set, Tuple
+
+from .core_utils import get_node_distance
+from .types import Address, Position
+
+Bucket = Tuple[int, int]
+
+
+@dataclass
+class SpatialIndex:
+    """
+    Uniform grid over the positions of the nodes.
+
+    Attributes:
+        cell: The side of a bucket, in the scenario's units. Around the radio range works best.
+    """
+    cell: float = field(default=100.0)
+    """The side of a bucket, in the scenario's units."""
+    buckets: Dict[Bucket, Set[Address]] = field(init=False, default_factory=dict)
+    """The nodes in each bucket."""
+    positions: Dict[Address, Position] = field(init=False, default_factory=dict)
+    """The position of each node."""
+
+    def __len__(self) -> int:
+        return len(self.positions)
+
+    def __contains__(self, addr: Address) -> bool:
+        return addr in self.positions
+
+    def _bucket(self, pos: Position) -> Bucket:
+        return math.floor(pos[0] / self.cell), math.floor(pos[1] / self.cell)
+
+    def update(self, addr: Address, pos: Position):
+        """
+        Places a node, or moves it if it's already indexed.
+
+        :param addr: The node's address.
+        :param pos: The node's position.
+        """
+        old = self.positions.get(addr)
+
+        if old is not None:
+            bucket = self._bucket(old)
+            if bucket == self._bucket(pos):
+                self.positions[addr] = pos
+                return
+            self.remove(addr)
+
+        self.positions[addr] = pos
+        self.buckets.setdefault(self._bucket(pos), set()).add(addr)
+
+    def remove(self, addr: Address):
+        """
+        Removes a node from the index, if present.
+        """
+        pos = self.positions.pop(addr, None)
+        if pos is None:
+            return
+
+        bucket = self._bucket(pos)
+        self.buckets[bucket].discard(addr)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def _ring(self, center: Bucket, r: int) -> List[Bucket]:
+        """
+        The buckets at exactly r buckets from the center.
+        """
+        cx, cy = center
+
+        if r == 0:
+            return [center]
+
+        out = [(cx + dx, cy + dy) for dx in range(-r, r + 1) for dy in (-r, r)]
+        out += [(cx + dx, cy + dy) for dx in (-r, r) for dy in range(-r + 1, r)]
+        return out
+
+    def nearest(self, pos: Position, k: int = 1,
+                exclude: Collection[Address] = ()) -> List[Tuple[float, Address]]:
+        """
+        Finds the k nodes closest to a position.
+
+        :param pos: The position.
+        :param k: The number of nodes to find.
+        :param exclude: Nodes that can't be returned.
+        :return: The (distance, address) of the closest nodes, closest first.
+        """
+        center = self._bucket(pos)
+        candidates: List[Tuple[float, Address]] = []
+        left = len(self.positions) - sum(1 for a in exclude if a in self.positions)
+        r = 0
+
+        while left > 0:
+            # sparse nodes, scanning the rings would visit more empty buckets than there are buckets
+            if (2 * r + 1) ** 2 > 4 * len(self.buckets):
+                candidates = [(get_node_distance(pos, p), addr)
+                              for addr, p in self.positions.items() if addr not in exclude]
+                break
+
+            for bucket in self._ring(center, r):
+                for addr in self.buckets.get(bucket, ()):
+                    if addr in exclude:
+                        continue
+                    candidates.append(
+                        (get_node_distance(pos, self.positions[addr]), addr))
+                    left -= 1
+
+            # nodes beyond this ring are at least r cells away
+            if len(candidates) >= k and heapq.nsmallest(k, candidates)[-1][0] <= r * self.cell:
+                break
+            r += 1
+
+        return heapq.nsmallest(k, candidates)
+
+    def nearest_toward(self, origin: Position, destination: Address) -> Optional[Tuple[float, Address]]:
+        """
+        Finds the node that gets a message closest to its destination, if it makes any progress.
+
+        :param origin: The position the message would be relayed from.
+        :param destination: The destination of the message, which must be indexed.
+        :return: The (distance to the destination, address) of the node,
+            or None if no node is closer to the destination than the origin.
+        """
+        target = self.positions[destination]
+        best = self.nearest(target, 1, exclude=(destination,))
+
+        if best and best[0][0] < get_node_distance(origin, target):
+            return best[0]
+
+        return None
@@ -2,7 +2,7 @@
 The state of the game, it's methods and attributes are defined in this module.
 
     Attributes:
-        state (dict): The state of the game.
+        state (Grid): The state of the game.
         players (dict): The players of the game.
 
     Methods:
@@ -11,18 +11,22 @@ The state of the game, it's methods and attributes are defined in this module.
 """
 
 from __future__ import annotations
+from collections import deque
 from dataclasses import dataclass, field
 from functools import cached_property
 import struct
-from typing import Dict, List, Optional, Tuple
+from typing import Deque, Dict, Iterable, List, Optional, Sequence, Tuple
 from threading import Lock
-from .payload import ACTIONS, Payload
+from .fuse import Fuse, FuseScheduler
+from .payload import ACTIONS, OFFSET, Payload
+from .types import MAX_DATAGRAM
 import time
 import random
 
 FLOOR: int = 0
 WALL: int = 1
 BOMB: int = 2
+BOX: int = 2  # boxes share their tile with bombs on the wire
 EXPLOSION: int = 3
 # TODO: Add more tiles.
 # CRATE = 4
@@ -37,20 +41,279 @@ PLAYER_2_DEAD: int = 21
 PLAYER_3_DEAD: int = 22
 PLAYER_4_DEAD: int = 23
 
+PLAYER_TILE: int = 9
+"""Offset between a player's id and its tile on the wire."""
+DEAD_TILE: int = 109
+"""Offset between a player's id and the tile it leaves when it dies, on the wire."""
 
-state = [[1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1],
-         [1, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 1],
-         [1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1, 1]]
+TICK: float = 0.03
+"""The length of a tick, in seconds, the lobby advances the game on the clock."""
+
+FUSE_TICKS: int = 100
+"""The ticks it takes a bomb to explode, 3 seconds at TICK."""
+
+ZOBRIST_SEED: int = 0x9E3779B97F4A7C15
+"""Seed of the board hash, shared by the server and every client."""
+
+HISTORY: int = 4096
+"""The number of past digests kept to check the digests reported by clients."""
+
+_MASK64 = (1 << 64) - 1
+
+_stamp = struct.Struct('!lQ')
+"""A game state version and its digest, a stamp carries the full board's then the boxes'."""
+
+_change = struct.Struct('!6B')
+"""A change on the wire, (x, y, t) -> (x, y, t)."""
+
+_snapshot = struct.Struct('!llHHHHB')
+"""The header of a part of a snapshot: version, boxes version, board size, first row, rows and players."""
+
+_snapshot_player = struct.Struct('!BHH')
+"""A player in a snapshot, id and position."""
+
+_box_id = struct.Struct('!H')
+"""The id of the box on a BOX tile of a snapshot, 0 if the tile holds a bomb."""
+
+SNAPSHOT_SIZE: int = MAX_DATAGRAM - OFFSET
+"""The max size of a part of a snapshot, so each part fits a datagram."""
+
+Saved = Tuple[bytes, Dict[int, Tuple[int, int]], Dict[int, Tuple[int, int]], Dict[int, Tuple[float, int, int]]]
+"""A compact copy of a game state: board, players, boxes and bombs."""
+
+
+def zobrist(index: int, tile: int) -> int:
+    """
+    The 64 bit key of a tile on a cell, splitmix64 of the pair.
+    Floor has no key, so an empty board hashes to 0.
+
+    :param index: The index of the cell, y * width + x.
+    :param tile: The tile on the cell.
+    :return: The key.
+    """
+    if tile == FLOOR:
+        return 0
+
+    z = (ZOBRIST_SEED + ((index << 8) | tile) * 0x9E3779B97F4A7C15) & _MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & _MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & _MASK64
+    return z ^ (z >> 31)
+
+
+def parse_snapshot(data: bytes) -> Optional[Tuple[int, int, int]]:
+    """
+    Parses the header of a part of a snapshot.
+
+    :param data: The data of the payload.
+    :return: The version, first row and number of rows, or None if the data is truncated.
+    """
+    if len(data) < _snapshot.size:
+        return None
+
+    version, _, _, _, first, rows, _ = _snapshot.unpack_from(data)
+    return version, first, rows
+
+
+def parse_stamp(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Parses the (version, digest) reported by a client.
+
+    :param data: The data of the payload.
+    :return: The version and digest, or None if the payload carries none.
+    """
+    if len(data) < _stamp.size:
+        return None
+
+    return _stamp.unpack_from(data)
+
+
+def parse_box_stamp(data: bytes) -> Optional[Tuple[int, int]]:
+    """
+    Parses the (version, digest) of the boxes reported by a client, after its full stamp.
+
+    :param data: The data of the payload.
+    :return: The version and digest of the boxes, or None if the payload carries none.
+    """
+    if len(data) < 2 * _stamp.size:
+        return None
+
+    return _stamp.unpack_from(data, _stamp.size)
+
+
+def _digest_at(history: Deque[int], latest: int, version: int) -> Optional[int]:
+    """
+    Fetches the digest at a given version out of the digests of the last versions.
+
+    :param history: The digests of the last versions, the newest last.
+    :param latest: The version of the newest digest.
+    :param version: The version to fetch.
+    :return: The digest or None if the version is too old or in the future.
+    """
+    offset = latest - version
+
+    if 0 <= offset < len(history):
+        return history[-1 - offset]
+
+    return None
+
+
+@dataclass
+class Grid:
+    """
+    A compact board, one byte per tile, stored row by row.
+
+    Grids made from a template share its bytes and only copy them on the first write,
+    so every lobby can have its own board for the price of a memcpy.
+
+    Attributes:
+        width (int): The number of columns.
+        height (int): The number of rows.
+        cells (bytes | bytearray): The tiles, cell (x, y) is at index y * width + x.
+    """
+    width: int
+    height: int
+    cells: bytes | bytearray
+
+    @classmethod
+    def from_rows(cls, rows: Sequence[Sequence[int]]) -> Grid:
+        """
+        Creates a read-only grid out of a list of rows.
+
+        :param rows: The rows of the board, rows[y][x].
+        :return: The grid.
+        """
+        return cls(len(rows[0]), len(rows), bytes(t for row in rows for t in row))
+
+    def copy(self) -> Grid:
+        """
+        Copies the grid. The bytes are shared until either grid is written to.
+        """
+        if isinstance(self.cells, bytearray):
+            return Grid(self.width, self.height, bytearray(self.cells))
+        return Grid(self.width, self.height, self.cells)
+
+    def __getitem__(self, pos: Tuple[int, int]) -> int:
+        return self.cells[pos[1] * self.width + pos[0]]
+
+    def __setitem__(self, pos: Tuple[int, int], tile: int):
+        if not isinstance(self.cells, bytearray):
+            # copy on write
+            self.cells = bytearray(self.cells)
+        self.cells[pos[1] * self.width + pos[0]] = tile
+
+    def in_bounds(self, x: int, y: int) -> bool:
+        """
+        Checks whether a position is inside the board.
+        """
+        return 0 <= x < self.width and 0 <= y < self.height
+
+    def rows(self) -> List[List[int]]:
+        """
+        Returns the board as a list of rows, rows[y][x].
+        """
+        w = self.width
+        return [list(self.cells[y * w:(y + 1) * w]) for y in range(self.height)]
+
+    def columns(self) -> List[List[int]]:
+        """
+        Returns the board as a list of columns, columns[x][y], the layout used by the client.
+        """
+        w = self.width
+        return [list(self.cells[x::w]) for x in range(w)]
+
+    def count(self, tile: int) -> int:
+        """
+        Counts the tiles of a given type over the whole board.
+        """
+        return self.cells.count(tile)
+
+    def positions(self, tile: int) -> List[Tuple[int, int]]:
+        """
+        Finds every tile of a given type.
+
+        :return: The (x, y) position of each tile.
+        """
+        out = []
+        i = self.cells.find(tile)
+        while i != -1:
+            out.append((i % self.width, i // self.width))
+            i = self.cells.find(tile, i + 1)
+        return out
+
+    def replace(self, old: Iterable[int], new: int):
+        """
+        Replaces every tile of the given types over the whole board at once.
+
+        :param old: The tiles to replace.
+        :param new: The tile to replace them with.
+        """
+        table = bytearray(range(256))
+        for t in old:
+            table[t] = new
+        self.cells = bytearray(self.cells.translate(table))
+
+
+DEFAULT_SIZE: Tuple[int, int] = (13, 13)
+"""The default (width, height) of the board."""
+
+_templates: Dict[Tuple[int, int], Grid] = {}
+"""Cache of the empty boards, indexed by size."""
+
+_box_masks: Dict[Tuple[int, int], int] = {}
+"""Cache of the cells boxes can be placed on, as a big integer mask, indexed by size."""
+
+
+def template(width: int, height: int) -> Grid:
+    """
+    Fetches the immutable empty board of a given size: a wall border and pillars
+    on every cell with even coordinates. Boards are built once and cached.
+
+    :param width: The number of columns, must be odd.
+    :param height: The number of rows, must be odd.
+    :return: The empty board.
+    """
+    key = (width, height)
+
+    if key not in _templates:
+        if width < 5 or height < 5 or width % 2 == 0 or height % 2 == 0:
+            raise ValueError(f'Invalid board size {width}x{height}')
+
+        border = bytes([WALL]) * width
+        row = bytes([WALL]) + bytes([FLOOR]) * (width - 2) + bytes([WALL])
+        pillars = (bytes([WALL, FLOOR]) * (width // 2)) + bytes([WALL])
+
+        rows = [border] + [row if y % 2 else pillars
+                           for y in range(1, height - 1)] + [border]
+        _templates[key] = Grid(width, height, b''.join(rows))
+
+    return _templates[key]
+
+
+def _box_mask(width: int, height: int) -> int:
+    """
+    Builds the mask of the cells boxes can be placed on: every floor cell of the
+    template except the corners around the spawns.
+
+    :return: The mask, 0xFF per allowed cell, as a big endian integer.
+    """
+    key = (width, height)
+
+    if key not in _box_masks:
+        floor = bytes([0xFF if t == FLOOR else 0 for t in range(256)])
+        cells = bytearray(template(width, height).cells.translate(floor))
+
+        # clear the same 3x3 corner around each spawn
+        for y in (*range(3), *range(height - 3, height)):
+            cells[y * width:y * width + 3] = bytes(3)
+            cells[(y + 1) * width - 3:(y + 1) * width] = bytes(3)
+
+        _box_masks[key] = int.from_bytes(cells, 'big')
+
+    return _box_masks[key]
+
+
+TEMPLATE: Grid = template(*DEFAULT_SIZE)
+"""The immutable board every default sized game starts from."""
 
 
 def parse_payload(payload: Payload) -> List[Change] | None:
@@ -128,6 +391,14 @@ class Change:
         except struct.error:
             return None
 
+    @property
+    def is_move(self) -> bool:
+        """
+        Whether the change moves a player, the only change that isn't sent to everyone under interest filtering.
+        """
+        t, _t = self.curr[2], self.next[2]
+        return PLAYER_1 <= t <= PLAYER_4 and t == _t
+
     def unpack(self):
         """
         Unpacks the Change object to a tuple of the current and next position and type of tile.
@@ -148,53 +419,331 @@ class GameState:
     Game State
 
     Attributes:
-        state (list[list[int]]): The state of the game.
+        state (Grid): The state of the game, a copy of the template of its size.
         players (dict[int, tuple[int,int]]): The players of the game, {id: (x,y)}.
         boxes (dict[int, tuple[int,int]]): The boxes of the game, {id: (x,y)}.
-        bombs (dict[int, [float, int, int]]): The bombs of the game {id: (ts,x,y)}.
+        bombs (dict[int, [float, int, int]]): The last bomb of each player {id: (ts,x,y)}.
         mode (int): The mode that dictates how this class should behave.
+        size (tuple[int,int]): The (width, height) of the board.
+        tick (int): The current tick, advanced by every apply_state call.
+        fuses (FuseScheduler): The lit bombs, by detonation tick.
+        version (int): The number of changes applied since the map was set up.
+        digest (int): Zobrist hash of the board, updated with every write.
+        box_version (int): The number of changes other than moves applied since the map was set up.
+        box_digest (int): Zobrist hash of the boxes, unlike the board's it doesn't depend on the moves.
     """
     lock: Lock
     players: Dict[int, Tuple[int, int]]  # {id: (x, y)}
     boxes: Dict[int, Tuple[int, int]] # {id: (x, y)}
     mode: int = field(default=0)  # defaults to 0 for player, 1 for server
-    state: List[List[int]] = field(default_factory=lambda: state)
+    size: Tuple[int, int] = field(default=DEFAULT_SIZE)
+    state: Grid = field(init=False)
     bombs: Dict[int, Tuple[float, int, int]] = field(default_factory=dict)
     range: int = field(default=2)
     explosions: List[Explosion] = field(default_factory=list)
+    tick: int = field(default=0)
+    fuses: FuseScheduler = field(default_factory=FuseScheduler)
+    box_ids: Dict[Tuple[int, int], int] = field(init=False, default_factory=dict)  # {(x, y): id}
+    version: int = field(init=False, default=0)
+    digest: int = field(init=False, default=0)
+    history: Deque[int] = field(init=False, default_factory=lambda: deque(maxlen=HISTORY))  # digest of the last versions
+    box_version: int = field(init=False, default=0)
+    box_digest: int = field(init=False, default=0)
+    box_history: Deque[int] = field(init=False, default_factory=lambda: deque(maxlen=HISTORY))  # box digest of the last box versions
+    snapshot_version: Optional[int] = field(init=False, default=None)  # version of the last snapshot loaded
+
+    def __post_init__(self):
+        self.state = template(*self.size).copy()
+        self._rehash()
+
+    def _rehash(self):
+        """
+        Computes the digest of the whole board and restarts the version count.
+        Only used when a board is set up, every change after that is hashed incrementally.
+        """
+        digest = 0
+        for i, tile in enumerate(self.state.cells):
+            if tile != FLOOR:
+                digest ^= zobrist(i, tile)
+
+        self.digest = digest
+        self.version = 0
+        self.history.clear()
+        self.history.append(digest)
+        self.snapshot_version = None
+
+        self._rehash_boxes()
+        self.box_version = 0
+        self.box_history.clear()
+        self.box_history.append(self.box_digest)
+
+    def _rehash_boxes(self):
+        """
+        Computes the digest of the boxes.
+        Boxes only go away through changes sent to every player, so it holds even when players
+        are only sent the moves around them, and players walking over bombs and dead players
+        don't change it.
+        """
+        width = self.state.width
+        digest = 0
+        for x, y in self.box_ids:
+            digest ^= zobrist(y * width + x, BOX)
 
-    def reset(self):
+        self.box_digest = digest
+
+    def _set(self, x: int, y: int, tile: int):
         """
-        Resets the game state.
+        Writes a tile on the board, updating the digest in O(1).
+        """
+        i = y * self.state.width + x
+        old = self.state.cells[i]
+
+        if old != tile:
+            self.digest ^= zobrist(i, old) ^ zobrist(i, tile)
+            self.state[x, y] = tile
+
+    def digest_at(self, version: int) -> Optional[int]:
+        """
+        Fetches the digest the board had at a given version.
+
+        :return: The digest or None if the version is too old or in the future.
+        """
+        return _digest_at(self.history, self.version, version)
+
+    def box_digest_at(self, version: int) -> Optional[int]:
+        """
+        Fetches the digest the boxes had at a given box version.
+
+        :return: The digest or None if the version is too old or in the future.
+        """
+        return _digest_at(self.box_history, self.box_version, version)
+
+    def stamp(self) -> bytes:
+        """
+        The version and digest of the board, then those of the boxes, as reported to the server.
         """
-        self.players = {
+        return _stamp.pack(self.version, self.digest) + _stamp.pack(self.box_version, self.box_digest)
+
+    def snapshot(self, size: int = SNAPSHOT_SIZE) -> List[bytes]:
+        """
+        Dumps the game state, sent to desynced clients and spectators.
+        The board is split by rows into parts that fit a datagram, each part carries
+        the version, the players, the tiles of its rows and the id of the box on each
+        of their BOX tiles, so it can be loaded on its own.
+
+        :param size: The max size of a part, a part holds one row at least.
+        :return: The parts of the snapshot.
+        """
+        width, height = self.size
+        cells = self.state.cells
+        players = b''.join(_snapshot_player.pack(id, x, y)
+                           for id, (x, y) in self.players.items())
+        fixed = _snapshot.size + len(players)
+
+        parts = []
+        y = 0
+        while y < height:
+            first = y
+            tiles, ids = bytearray(), bytearray()
+
+            while y < height:
+                row = cells[y * width:(y + 1) * width]
+                row_ids = b''.join(_box_id.pack(self.box_ids.get((x, y), 0))
+                                   for x in range(width) if row[x] == BOX)
+
+                if tiles and fixed + len(tiles) + len(ids) + len(row) + len(row_ids) > size:
+                    break
+
+                tiles += row
+                ids += row_ids
+                y += 1
+
+            parts.append(_snapshot.pack(self.version, self.box_version, width, height, first, y - first,
+                                        len(self.players)) + players + bytes(tiles) + bytes(ids))
+
+        return parts
+
+    def load_snapshot(self, data: bytes) -> bool:
+        """
+        Loads a part of a snapshot sent by the server, replacing the rows it carries.
+        Once every part is loaded the board matches the server's, a part that's lost
+        leaves the digest off and another snapshot is sent.
+        The players are only replaced by the first part of a snapshot, every part carries
+        the same players and moves applied between parts must not be undone.
+
+        :param data: The part of the snapshot.
+        :return: True if the part is the first loaded of its snapshot.
+        """
+        version, box_version, width, height, first, rows, count = _snapshot.unpack_from(data)
+        offset = _snapshot.size
+
+        if (width, height) != self.size:
+            self.resize((width, height))
+
+        players = {}
+        for _ in range(count):
+            id, x, y = _snapshot_player.unpack_from(data, offset)
+            players[id] = (x, y)
+            offset += _snapshot_player.size
+
+        cells = data[offset:offset + rows * width]
+        offset += rows * width
+        if len(cells) != rows * width or first + rows > height:
+            raise ValueError(f'Truncated snapshot, {len(data)} bytes')
+
+        # the boxes of the rows are replaced by those of the snapshot
+        for pos in [pos for pos in self.box_ids if first <= pos[1] < first + rows]:
+            self.boxes.pop(self.box_ids.pop(pos), None)
+            self.box_digest ^= zobrist(pos[1] * width + pos[0], BOX)
+
+        for i, tile in enumerate(cells):
+            x, y = i % width, first + i // width
+            self._set(x, y, tile)
+
+            if tile == BOX:
+                id, = _box_id.unpack_from(data, offset)
+                offset += _box_id.size
+                if id:
+                    self.boxes[id] = (x, y)
+                    self.box_ids[(x, y)] = id
+                    self.box_digest ^= zobrist(y * width + x, BOX)
+
+        first_part = version != self.snapshot_version
+        if first_part:
+            self.players = players
+            self.snapshot_version = version
+
+        self.version = version
+        self.history.clear()
+        self.history.append(self.digest)
+        self.box_version = box_version
+        self.box_history.clear()
+        self.box_history.append(self.box_digest)
+
+        return first_part
+
+    @property
+    def spawns(self) -> Dict[int, Tuple[int, int]]:
+        """
+        The spawn of each player, one in each corner of the board.
+        """
+        width, height = self.size
+        return {
             1: (1, 1),
-            2: (11, 1),
-            3: (1, 11),
-            4: (11, 11),
+            2: (width - 2, 1),
+            3: (1, height - 2),
+            4: (width - 2, height - 2),
         }
+
+    def resize(self, size: Tuple[int, int]):
+        """
+        Changes the size of the board, clearing it.
+
+        :param size: The new (width, height) of the board.
+        """
+        self.size = (size[0], size[1])
+        self.reset()
+
+    def reset(self):
+        """
+        Resets the game state.
+        """
+        self.players = self.spawns
         self.bombs = {}
         self.explosions = []
-        
-    def generate_map(self):
-        n = 120
-        for i in range(1, len(state) - 1):
-            for j in range(1, len(state[i]) - 1):
-                if state[i][j] != 0:
-                    continue
-                elif (i < 3 or i > len(state) - 4) and (j < 3 or j > len(state[i]) - 4):
-                    continue
-                if random.randint(0, 9) < 7:
-                    state[i][j] = 2
-                    self.boxes[n] = (i,j)
-                    n +=1
-        return
-
-    def get_state(self) -> list[list[int]]:
+        self.tick = 0
+        self.fuses.clear()
+        self.state = template(*self.size).copy()
+        self._rehash()
+
+    def generate_map(self, seed: Optional[int] = None, density: float = 0.7):
+        """
+        Generates a new board out of the template, scattering boxes over it.
+        The whole board is drawn at once: random bytes are thresholded into boxes
+        and masked so that walls and the corners around the spawns stay clear.
+        The same size, seed and density always draw the same board, so the server
+        only sends players the seed of the map.
+
+        :param seed: The seed of the generator, random if None.
+        :param density: The chance of a free cell holding a box.
+        """
+        width, height = self.size
+        n = width * height
+        rng = random.Random(seed)
+
+        # each random byte becomes a box with probability density
+        threshold = round(density * 256)
+        table = bytes(BOX if b < threshold else FLOOR for b in range(256))
+        noise = int.from_bytes(rng.randbytes(n).translate(table), 'big')
+
+        cells = int.from_bytes(template(width, height).cells, 'big') \
+            | (noise & _box_mask(width, height))
+        self.state = Grid(width, height, bytearray(cells.to_bytes(n, 'big')))
+
+        self.boxes = {120 + i: pos
+                      for i, pos in enumerate(self.state.positions(BOX))}
+        self.box_ids = {pos: id for id, pos in self.boxes.items()}
+        self._rehash()
+
+    def set_boxes(self, boxes: Dict):
+        """
+        Places the boxes received from the server on the board.
+
+        :param boxes: The boxes, {id: (x,y)}, ids and positions may come straight from json.
+        """
+        self.boxes = {int(id): (pos[0], pos[1]) for id, pos in boxes.items()}
+        self.box_ids = {pos: id for id, pos in self.boxes.items()}
+
+        for x, y in self.boxes.values():
+            self._set(x, y, BOX)
+
+        self._rehash_boxes()
+
+    def save(self) -> Saved:
+        """
+        Takes a compact copy of the game state, used to rewind it.
+
+        :return: The copy, it must not be modified.
+        """
+        return (bytes(self.state.cells), dict(self.players),
+                dict(self.boxes), dict(self.bombs))
+
+    def restore(self, saved: Saved):
+        """
+        Rewinds the game state to a copy taken with save.
+        The board is shared with the copy until it's written to.
+        Meant for the scratch states used to re-simulate, the version count restarts.
+
+        :param saved: The copy to rewind to.
+        """
+        cells, players, boxes, bombs = saved
+        self.state = Grid(self.size[0], self.size[1], cells)
+        self.players = dict(players)
+        self.boxes = dict(boxes)
+        self.box_ids = {pos: id for id, pos in self.boxes.items()}
+        self.bombs = dict(bombs)
+        self._rehash()
+
+    def pop_box(self, x: int, y: int) -> Optional[int]:
+        """
+        Removes the box at the given position, if any.
+
+        :return: The id of the box or None.
+        """
+        id = self.box_ids.pop((x, y), None)
+
+        if id is not None:
+            self.boxes.pop(id, None)
+            self._set(x, y, FLOOR)
+            self.box_digest ^= zobrist(y * self.state.width + x, BOX)
+
+        return id
+
+    def get_state(self) -> Grid:
         """Returns the state of the game.
 
         Returns:
-            list[list[int]]: The state of the game.
+            Grid: The state of the game.
         """
         return self.state
 
@@ -217,13 +766,38 @@ class GameState:
     def _apply_change(self, change: Change):
         """
         Applies a change to the state of the game.
+        Every change bumps the version, the digest of each version is kept in the history.
+        Changes other than moves bump the box version too.
+
+        :param change: The change to apply.
+        """
+        self._apply_tiles(change)
+
+        self.version += 1
+        self.history.append(self.digest)
+
+        if not change.is_move:
+            self.box_version += 1
+            self.box_history.append(self.box_digest)
+
+    def _apply_tiles(self, change: Change):
+        """
+        This method shouldn't be called directly from outside the class.
+
+        Applies a change to the board and to the players, boxes and bombs.
 
         :param change: The change to apply.
         """
         x, y, t = change.curr
         _x, _y, _t = change.next
-        self.state[y][x] = t
-        self.state[_y][_x] = _t
+
+        # Box popped, (x, y, BOX) -> (x, y, FLOOR)
+        if t == BOX:
+            self.pop_box(x, y)
+            return
+
+        self._set(x, y, t)
+        self._set(_x, _y, _t)
         
         # Movement
         if 9 < t and t < 15 and _t < 15:
@@ -238,98 +812,127 @@ class GameState:
             print('popping player:',t-9)
             if (t-9) in self.players:  
                 self.players.pop(t-9)
-            
-        # Bomb exploded
-        if   120 < t :
-            if t in self.bombs:
-                self.bombs.pop(t)
 
-    def _is_player(self, val: int, x: int, y: int) -> Optional[int]:
+    def apply_changes(self, changes: Iterable[Change]):
+        """
+        Applies a batch of changes to the state of the game, in order.
+
+        :param changes: The changes to apply.
+        """
+        for change in changes:
+            self._apply_change(change)
+
+    def validate(self, data: bytes, owner: Optional[int] = None) -> Tuple[bytes, int]:
+        """
+        Checks a batch of changes, in their wire format, against the board and the players.
+        The whole batch is checked in a single pass over the raw bytes, each change
+        is checked against the state left by the changes accepted before it.
+
+        A change is accepted if both its cells are on the board and:
+            - it pops a box that is still on the board, (x, y, BOX) -> (x, y, FLOOR)
+            - it moves a live player at most one cell, from at most one cell away
+              from where the server has it, onto a cell without a wall, box or bomb
+            - it drops a bomb next to a live player, on a cell without one
+            - it kills a live player, on cells without walls
+
+        The one cell of slack lets the moves of a player arrive slightly out of order.
+
+        :param data: The changes, as received.
+        :param owner: The id of the player that sent the changes, who may only change their own tile.
+        :return: The accepted changes in their wire format and the number of rejected changes.
+        """
+        width, height = self.size
+        cells = self.state.cells
+        written: Dict[int, int] = {}
+        players = dict(self.players)
+        accepted = bytearray()
+        rejected = 0
+
+        for i, (x, y, t, nx, ny, nt) in enumerate(_change.iter_unpack(data[:len(data) - len(data) % 6])):
+            ok = False
+
+            if x < width and y < height and nx < width and ny < height:
+                a = y * width + x
+                b = ny * width + nx
+                ta = written.get(a, cells[a])
+                tb = written.get(b, cells[b])
+
+                if t == BOX:
+                    ok = nt == FLOOR and a == b and ta == BOX and (x, y) in self.box_ids
+
+                elif PLAYER_1 <= t <= PLAYER_4 and ta != WALL and tb != WALL:
+                    id = t - PLAYER_TILE
+                    pos = players.get(id)
+
+                    if pos is not None and (owner is None or owner == id):
+                        if nt == t:
+                            ok = tb != BOX and abs(x - pos[0]) + abs(y - pos[1]) <= 1 \
+                                and abs(nx - x) + abs(ny - y) <= 1
+                            if ok:
+                                players[id] = (nx, ny)
+                        elif nt == BOMB:
+                            ok = tb != BOMB and abs(nx - pos[0]) + abs(ny - pos[1]) <= 1
+                        elif nt == id + DEAD_TILE:
+                            ok = True
+                            del players[id]
+
+                if ok:
+                    # mirror what _apply_tiles writes, for the changes after this one
+                    written[a] = FLOOR if t == BOX else t
+                    if t != BOX:
+                        written[b] = nt
+
+            if ok:
+                accepted += data[i * 6:i * 6 + 6]
+            else:
+                rejected += 1
+
+        return bytes(accepted), rejected
+
+    def _is_player(self, x: int, y: int) -> List[int]:
         """
-        Checks if the value at the given position is a player.
+        Finds the players standing at the given position.
 
-        :param val: The value to check.
         :param x: The x coordinate of the tile.
         :param y: The y coordinate of the tile.
+        :return: The ids of the players.
         """
-        if val == PLAYER_1 and self.players[0] == (x, y):
-            # this will notify the players that they are dead
-            self.players[0] = (-1, -1)
-            return PLAYER_1_DEAD
-        if val == PLAYER_2 and self.players[1] == (x, y):
-            # this will notify the players that they are dead
-            self.players[1] = (-1, -1)
-            return PLAYER_2_DEAD
-        if val == PLAYER_3 and self.players[2] == (x, y):
-            # this will notify the players that they are dead
-            self.players[2] = (-1, -1)
-            return PLAYER_3_DEAD
-        if val == PLAYER_4 and self.players[3] == (x, y):
-            # this will notify the players that they are dead
-            self.players[3] = (-1, -1)
-            return PLAYER_4_DEAD
-
-        return None
+        return [id for id, pos in self.players.items() if pos == (x, y)]
 
-    def _explosion(self, id: int, x: int, y: int) -> Dict[Tuple[int, int], int]:
+    def _explosion(self, fuse: Fuse, effects: List[Change]) -> Dict[Tuple[int, int], int]:
         """
         This method shouldn't be called directly from outside this class.
 
-        Explodes a bomb and recursively calls itself if it finds a bomb.
-        An explosion is a cross of tiles with the bomb's range.
-
+        Explodes a bomb, along with every bomb caught in the blast.
+        An explosion is a cross of tiles with the bomb's range, stopped by walls
+        and by the first box in each direction.
 
-        :param id: The id of the bomb.
-        :param x: The x position of the bomb.
-        :param y: The y position of the bomb.
-        :return: A list of tiles affected by the explosion. {id: (x,y)}
+        :param fuse: The bomb that went off, already removed from the scheduler.
+        :param effects: Receives the boxes popped and the players killed by the blast, as changes.
+        :return: The tiles affected by the explosion. {(x,y): tile}
         """
-        # remove the bomb from the bombs dictionary to prevent explosion loops
-        self.bombs.pop(id)
+        # blast builds its tables out of this module's templates
+        from .blast import table
 
-        # get the tiles in the cross
-        up = [self.state[x][y + 1], self.state[x][y + 2]]
-        down = [self.state[x][y - 1], self.state[x][y - 2]]
-        left = [self.state[x - 1][y], self.state[x - 2][y]]
-        right = [self.state[x + 1][y], self.state[x + 2][y]]
+        def detonate(x: int, y: int) -> bool:
+            chained = self.fuses.at(x, y)
+            return chained is not None and self.fuses.detonate(chained.id) is not None
 
-        out: Dict[Tuple[int, int], int] = {}
+        def tile_at(x: int, y: int) -> int:
+            return self.state[x, y]
 
-        for i in range(0, self.range):
-            if up[i] == WALL:
-                break
-            elif up[i] == BOMB:
-                self._explosion(id, x, y + i)
-            else:
-                self._is_player(up[i], x, y + i)
-                out[(x, y + i)] = EXPLOSION
-
-        for i in range(0, self.range):
-            if down[i] == WALL:
-                break
-            elif down[i] == BOMB:
-                self._explosion(id, x, y - i)
-            else:
-                self._is_player(down[i], x, y - i)
-                out[(x, y - i)] = EXPLOSION
-
-        for i in range(0, self.range):
-            if right[i] == WALL:
-                break
-            elif right[i] == BOMB:
-                self._explosion(id, x + i, y)
-            else:
-                self._is_player(right[i], x + i, y)
-                out[(x + i, y)] = EXPLOSION
-
-        for i in range(0, self.range):
-            if left[i] == WALL:
-                break
-            elif left[i] == BOMB:
-                self._explosion(id, x - i, y)
-            else:
-                self._is_player(left[i], x - i, y)
-                out[(x - i, y)] = EXPLOSION
+        width, height = self.size
+        cells = table(width, height, self.range).chain(
+            [(fuse.x, fuse.y)], tile_at, detonate)
+
+        out: Dict[Tuple[int, int], int] = {}
+        for x, y in cells:
+            if (x, y) in self.box_ids:
+                effects.append(Change((x, y, BOX), (x, y, FLOOR)))
+            for id in self._is_player(x, y):
+                effects.append(Change((x, y, id + PLAYER_TILE),
+                                      (x, y, id + DEAD_TILE)))
+            out[(x, y)] = EXPLOSION
 
         return out
 
@@ -337,85 +940,83 @@ class GameState:
         """
         This method shouldn't be called directly from outside the class.
 
-        Updates the bombs state.
-        New bombs are added to the bombs dictionary.
-        Exploded bombs are calculated and removed from the bombs dictionary.
+        Detonates the bombs whose fuse ran out on the current tick.
+        Only the bombs that are due are touched.
 
-        :param change: The change to apply to the bombs.
+        :return: The tiles affected by the explosions.
         """
-        timestamp = time.time()
-
         out: Dict[Tuple[int, int], int] = {}
+        effects: List[Change] = []
 
-        # Remove exploded bombs from the bombs dictionary.
-        for bomb_id, explosion in self.bombs.items():
-            if explosion[0] + 3 < timestamp:
-                out.update(self._explosion(
-                    bomb_id, explosion[1], explosion[2]))
+        for fuse in self.fuses.due(self.tick):
+            out.update(self._explosion(fuse, effects))
 
-        return Explosion(out)
+        return Explosion(out, effects)
 
-    def apply_state(self, data: bytes) -> List[Change]:
-        """Applies the changes to the state of the game.
+    def light(self, changes: Iterable[Change]):
+        """
+        Lights the fuses of the bombs dropped by a batch of changes, already applied.
+        Each bomb detonates FUSE_TICKS ticks later.
+
+        :param changes: The changes, validated.
+        """
+        for change in changes:
+            t = change.curr[2]
+            _x, _y, _t = change.next
+            if t != BOX and _t == BOMB:
+                self.fuses.schedule(t - PLAYER_TILE, _x, _y,
+                                    self.tick + FUSE_TICKS)
+
+    def advance(self) -> List[Change]:
+        """
+        Moves the game on by a tick, detonating the bombs that are due.
+        The boxes and players caught in the explosions are removed.
+
+        :return: The effects of the explosions, to send to the players.
+        """
+        self.tick += 1
+
+        explosions = self._update_bombs()
+        if not explosions.tiles:
+            return []
+
+        self.explosions.append(explosions)
+
+        # players learn of the deaths and popped boxes through regular changes
+        self.apply_changes(explosions.effects)
+        return explosions.effects
+
+    def apply_state(self, data: bytes, owner: Optional[int] = None) -> List[Change]:
+        """Applies the changes to the state of the game, as a tick.
+
+        In server mode only the changes that pass validation are applied, the bombs
+        they drop are lit and the boxes and players caught in explosions are removed.
 
         :param data: The data to apply.
-        :return (changes, List[Explosion]): The list of changes that were applied.
+        :param owner: The id of the player the changes come from, any player if None.
+        :return: The changes to send to the players, the accepted changes (server mode) and the explosions' effects.
         """
-        changes: List[Change] = change_from_bytes(data)
         outgoing: List[Change] = []
 
         if self.mode == 0:
             # Player mode
             # Doesn't do any checks, just applies the changes.
-            for change in changes:
-                self._apply_change(change)
+            self.apply_changes(change_from_bytes(data))
         else:
-            for change in changes:
-                ctile, cur, ntile, nxt = change.unpack()
-
-                # check whether the current tile corresponds to what we expect
-                if ctile != self.state[cur[0]][cur[1]]:
-                    # if not, discard the change
-                    continue
-
-                elif ctile == FLOOR and ntile == BOMB and cur == nxt:
-                    # get the id of the bomb
-                    bomb_id = len(self.bombs)
-                    # add the bomb to the bombs dictionary
-                    self.bombs[bomb_id] = (time.time(), cur[0], cur[1])
-                    outgoing.append(change)
-
-                elif cur == self.players[ctile - PLAYER_OFFSET]:
-                    # player update
-                    if adjacent(cur, nxt) and ntile == FLOOR:
-                        # update the player position
-                        self.players[ctile - PLAYER_OFFSET] = nxt
-                        outgoing.append(change)
-                    else:
-                        # invalid move
-                        # send the player back to the previous position
-                        Change((cur[0], cur[1], ctile),
-                               (cur[0], cur[1], ctile))
-                else:
-                    continue
-
-        explosions = self._update_bombs()
-        self.explosions.append(explosions)
-        outgoing.extend(explosions.changes)
-
-        # dead players changes
-        # TODO: decide whether to send all players instead of just dead
-        for i in range(0, 4):
-            if self.players[i] == (-1, -1):
-                outgoing.append(Change((-1, -1, PLAYER_OFFSET + i),
-                                       (-1, -1, i)))
+            data, _ = self.validate(data, owner)
+            changes = change_from_bytes(data)
+            self.apply_changes(changes)
+            self.light(changes)
+            outgoing.extend(changes)
 
+        outgoing.extend(self.advance())
         return outgoing
 
 
 @dataclass
 class Explosion:
     tiles: Dict[Tuple[int, int], int]
+    effects: List[Change] = field(default_factory=list)  # boxes popped and players killed
     timestamp: float = field(default_factory=time.time)
 
     @property
@@ -437,7 +1038,7 @@ class Explosion:
 
         :return: A list of changes that should be applied to the state.
         """
-        return [Change((t, pos[0], pos[1]), (t, pos[0], pos[1])) for pos, t in self.tiles.items()]
+        return [Change((pos[0], pos[1], t), (pos[0], pos[1], t)) for pos, t in self.tiles.items()]
 
     def clear(self):
         """
@@ -45,10 +45,26 @@ MCAST_GROUP = 'ff15:1234:5678:9101:1121:3141:5161:0001'
 MCAST_PORT = 9998
 """Port used by the DTN nodes."""
 
+MCAST_HOPS = 3
+"""Hop limit of the multicast beacons, the hops they came across is what's left of it."""
+
+BEACON_INTERVAL = 0.5
+"""Time, in seconds, between the beacons of mobile nodes."""
+
+GATEWAY_BEACON_INTERVAL = 0.25
+"""Time, in seconds, between the beacons of gateways. A gateway missing 3 in a row is dropped,
+so mobile nodes fail over to another in under a second."""
+
 DEFAULT_PORT = 9999
 
 TIMEOUT = 10
 
+KALIVE_INTERVAL = 1
+"""Idle time, in seconds, after which an explicit KALIVE is sent."""
+
+MAX_DATAGRAM = 1452
+"""The largest datagram sent without fragmenting, a 1500 bytes MTU less the IPv6 and UDP headers."""
+
 ###############################################
 # NDN specific types                          #
 ###############################################
@@ -16,10 +16,16 @@ from socket import IPPROTO_IPV6, IPPROTO_UDP, IPV6_JOIN_GROUP, IPV6_MULTICAST_HO
 from threading import Thread, Lock
 from typing import Optional
 
-from common.payload import GKALIVE, Payload
-from common.types import DEFAULT_PORT, MCAST_GROUP, MCAST_PORT, TIMEOUT, Position, Address, MobileMap
+from common.batch import Batcher
+from common.beacon import Beacon
+from common.bundle import BundleStore, split_keys
+from common.bundlelog import BundleLog
+from common.dedupe import RecentSet
+from common.payload import CUSTODY, GKALIVE, Frame, Payload
+from common.types import BEACON_INTERVAL, DEFAULT_PORT, GATEWAY_BEACON_INTERVAL, KALIVE_INTERVAL, MCAST_GROUP, MCAST_HOPS, MCAST_PORT, TIMEOUT, Position, Address, Hops
 from common.cache import Cache
-from common.core_utils import get_node_distance, get_node_xy
+from common.core_utils import get_node_xy
+from common.neighbors import NeighborTable, enable_hops, recv_beacon
 
 
 @dataclass
@@ -42,23 +48,46 @@ class EdgeNode(Thread):
     level: int = field(default=logging.INFO)
     """The logging level."""
 
+    fast_path: bool = field(default=True)
+    """Whether relayed datagrams are forwarded as received, only peeking at their header."""
+
+    store_dir: Optional[str] = field(default=None)
+    """The directory the bundles are logged to so they survive a restart, None to keep them in memory."""
+
     running: bool = field(default=False, init=False)
     """Whether the node is running."""
 
-    mobile_nodes: MobileMap = field(init=False, default_factory=dict)
-    """A list of mobile nodes and some data about them."""
+    mobile_nodes: NeighborTable = field(
+        init=False, default_factory=lambda: NeighborTable(BEACON_INTERVAL))
+    """The mobile nodes in range, dropped once they stop sending KALIVEs."""
 
-    outgoing_mobile: Cache = field(init=False)
-    """Messages meant for mobile nodes."""
+    bundles: BundleStore = field(init=False)
+    """Messages meant for mobile nodes, held until a node in contact takes custody of them."""
 
     outgoing_server: Cache = field(init=False)
     """Messages meant for the server."""
 
-    preferred_mobile: Optional[Address] = field(init=False, default=None)
+    recent: RecentSet = field(init=False, default_factory=RecentSet)
+    """The payloads relayed recently, copies arriving over other paths are dropped."""
+
+    uplink: Batcher = field(init=False)
+    """Packs the payloads and KALIVEs bound to each lobby into as few datagrams as fit them."""
 
-    # TODO: Use ttl aswell as the coordinates as a metric to determine whether a node is stale.
+    last_summary: float = field(init=False, default=0.0)
+    """The time the KALIVEs heard were last summed up to the lobbies."""
 
-    #       Modify the way broadcasts are made in the mobile nodes (networking.py).
+    relayed: int = field(init=False, default=0)
+    """The payloads of the mobile nodes relayed to the server since the last beacon."""
+
+    load: float = field(init=False, default=0.0)
+    """Moving average of the payloads relayed to the server per second, advertised in the beacons."""
+
+    beacon_seq: int = field(init=False, default=0)
+    """The number of the next beacon."""
+
+    preferred_mobile: Optional[Address] = field(init=False, default=None)
+
+    # TODO: Modify the way broadcasts are made in the mobile nodes (networking.py).
     #       Include the  coordinates in the KALIVE message.
     #       Edge will remove coordinates from KALIVE messages before sending to server.
 
@@ -71,8 +100,12 @@ class EdgeNode(Thread):
             level=self.level, format='%(levelname)s: %(message)s')
 
         # Create the outgoing cache
-        self.outgoing_mobile = Cache(self.cache_timeout, level=self.level)
+        log = BundleLog(self.store_dir) if self.store_dir else None
+        self.bundles = BundleStore(self.cache_timeout, log=log)
+        if log is not None:
+            logging.info('Recovered %d bundles from %s', len(self.bundles), self.store_dir)
         self.outgoing_server = Cache(self.cache_timeout, level=self.level)
+        self.uplink = Batcher(self.gateway_dtn_address)
 
         logging.info('gateway node initialized on {}'.format(self.position))
 
@@ -85,12 +118,12 @@ class EdgeNode(Thread):
         """
         return get_node_xy(self.node_path)
 
-    @cached_property
-    def kalive(self) -> bytes:
+    def kalive(self, load: float = 0.0) -> bytes:
         """
         The data to be sent on KALIVE messages.
-        Cached since gateway nodes won't ever change their position.
 
+        :param load: The payloads relayed to the server per second, mobile nodes spread
+            their traffic over the least loaded gateways.
         :return: The data to be send in the KALIVE messages.
         """
 
@@ -102,8 +135,8 @@ class EdgeNode(Thread):
         # ip = ip_address(MCAST_GROUP).exploded.encode('utf-8')
         # ip_dest = struct.pack('!16s', ip)
 
-        data = bytes(str(self.position[0]) +
-                     ',' + str(self.position[1]), 'utf-8')
+        data = Beacon(self.position, seq=self.beacon_seq, load=load).to_bytes()
+        self.beacon_seq += 1
 
         lobby_uuid = ""  # we won't have a lobby_id, this is for DTN purposes
         player_uuid = ""  # we won't have a player_id, this is for DTN purposes
@@ -118,7 +151,7 @@ class EdgeNode(Thread):
         """
         The socket through which the gateway node sends messages to the DTN.
         """
-        ttl = struct.pack('@I', 3)
+        ttl = struct.pack('@I', MCAST_HOPS)
         sock = socket(AF_INET6, SOCK_DGRAM)
         sock.setsockopt(IPPROTO_IPV6, IPV6_MULTICAST_HOPS, ttl)
         return sock
@@ -155,6 +188,7 @@ class EdgeNode(Thread):
         sock.bind(('', MCAST_PORT))
         group = inet_pton(AF_INET6, MCAST_GROUP) + struct.pack('@I', 0)
         sock.setsockopt(IPPROTO_IPV6, IPV6_JOIN_GROUP, group)
+        enable_hops(sock)
         return sock
 
     @cached_property
@@ -169,32 +203,33 @@ class EdgeNode(Thread):
         KALIVE message broadcast.
 
         This message is used to inform mobile nodes that the gateway node is still alive.
-        TODO: Mobile nodes will use this message to determine the amount of jumps that have been made.
+        Mobile nodes count the hops it came across from the hop limit it's received with.
         """
 
         while self.running:
             #logging.info('Broadcasting KALIVE')
             # TODO: Requires all mobiles nodes to use the same port? Check this.
-            self.msender.sendto(self.kalive, self.mcast_addr)
-            time.sleep(1)
+            relayed, self.relayed = self.relayed, 0
+            self.load += 0.25 * (relayed / GATEWAY_BEACON_INTERVAL - self.load)
+
+            self.msender.sendto(self.kalive(self.load), self.mcast_addr)
+            time.sleep(GATEWAY_BEACON_INTERVAL)
 
-    def handle_kalive(self, addr: Address, payload: Payload) -> Payload:
+    def handle_kalive(self, addr: Address, payload: Payload, hops: Hops = 0) -> Payload:
         """
         Handles KALIVE messages from mobile nodes.
+
+        :param addr: The address of the mobile node.
+        :param payload: The KALIVE.
+        :param hops: The number of hops the KALIVE came across.
         """
         try:
             # only mobile nodes send data in the KALIVE messages
             if payload.data is not None:
-                timestamp = time.time()
-                hops = 3 - payload.ttl
-                # payload's data to str
-                _x, _y = payload.data.decode('utf-8').split(',')
-                position = (float(_x), float(_y))
-                # get distance between the node and the gateway node
-                distance = get_node_distance(position, self.position)
+                beacon = Beacon.from_bytes(payload.data)
                 # update the node's data
-                self.mobile_nodes[addr] = (
-                    distance, position, timestamp, hops)
+                self.mobile_nodes.beacon(addr, beacon.position, hops, velocity=beacon.velocity,
+                                         seq=beacon.seq)
                 logging.debug('Received KALIVE from {}'.format(addr))
         except Exception as e:
             logging.error('Failed to handle KALIVE message: {}'.format(e))
@@ -204,40 +239,22 @@ class EdgeNode(Thread):
 
         return payload
 
-    def _get_preferred_node(self, destination: Optional[Address] = None) -> Address:
+    def _get_preferred_node(self, destination: Optional[Address] = None) -> Optional[Address]:
         """
         Returns a node.
 
-        :return: The node with the lowest distance to the gateway node aswell as a low number of hops.
+        :return: The node with the lowest distance to the gateway node aswell as a lossless link,
+            or None if no mobile node is in range.
         """
 
-        if destination is None:
+        if destination is None or destination not in self.mobile_nodes:
             # return the closest node to us
-            return min(self.mobile_nodes, key=lambda x: self.mobile_nodes[x][0])
+            best = self.mobile_nodes.best(self.position)
+            return None if best is None else best[1].address
         else:
-            # get the destination node's position
-            destination_position = self.mobile_nodes[destination][1]
-            # get the distance between the gateway node and the destination node
-            destination_distance = get_node_distance(
-                destination_position, self.position)
-
-            # create a dict of all addresses and their distances to the destination node
-            # do not include the destination node
-            distances = {
-                addr: get_node_distance(
-                    self.mobile_nodes[addr][1], destination_position)
-                for addr in self.mobile_nodes
-                if addr != destination
-            }
-
-            # find the address with the lowest distance to the destination node
-            closest = min(distances, key=lambda x: distances[x])
-
-            # if the closest node is closer than the destination node, return it
-            if distances[closest] < destination_distance:
-                return closest
-            else:
-                return destination
+            # the node closest to the destination, if it's closer to it than we are
+            closest = self.mobile_nodes.toward(self.position, destination)
+            return destination if closest is None else closest[1].address
 
     def _handle_metric_updates(self):
         """
@@ -253,26 +270,46 @@ class EdgeNode(Thread):
             if time.time() - self.last_update > TIMEOUT:
                 self.last_update = time.time()
 
-                self.preferred_mobile = self._get_preferred_node()
+                # keep the last node if every node went quiet, one might come back
+                self.preferred_mobile = self._get_preferred_node() or self.preferred_mobile
                 # print(self.preferred_mobile)
                 # logging.info('Preferred mobile node is {}'.format(
                 #    self.preferred_mobile[0]))
 
             time.sleep(1)
 
+    def _hop(self, payload) -> bool:
+        """
+        Counts the gateway as a hop of a relayed payload, decrementing its ttl.
+
+        :param payload: The payload or frame being relayed.
+        :return: False if the payload ran out of hops and should be dropped.
+        """
+        if payload.ttl <= 1:
+            logging.debug('Dropped %s, out of hops', payload.type)
+            return False
+
+        payload.ttl -= 1
+        return True
+
     def _handle_incoming_dtn(self):
         """
         Handles incoming IPv6 messages.
         """
         while self.running:
             try:
-                data, addr = self.dtn_sock.recvfrom(1500)
+                data, addr, hops = recv_beacon(self.dtn_sock)
 
-                address = (addr[0], addr[1])
+                # nodes are reached on the default port, whatever port they beacon from
+                address = (addr[0], DEFAULT_PORT)
 
                 if address[0] == inet_ntop(AF_INET6, self.gateway_dtn_address):
                     continue
 
+                # the first copy of a beacon came the shortest way, the others would skew its hops
+                if self.recent.seen(data):
+                    continue
+
                 logging.debug('Received from {}'.format(addr))
 
                 payload = Payload.from_bytes(data)
@@ -284,14 +321,12 @@ class EdgeNode(Thread):
 
                 if payload.is_kalive:
 
-                    payload = self.handle_kalive(address, payload)
-
-                    if payload.lobby_port != MCAST_PORT:
-                        payload.destination = inet_pton(
-                            AF_INET6, ip_address(self.server_address[0]).exploded)
+                    payload = self.handle_kalive(address, payload, hops)
 
-                        self.outgoing_server.add_entry(
-                            address, payload)
+                    # the lobby is told which players were heard from once per interval
+                    if payload.lobby_port != MCAST_PORT and self._hop(payload):
+                        self.uplink.kalive(
+                            (self.server_address[0], payload.lobby_port), data)
 
             except timeout:
                 continue
@@ -304,11 +339,13 @@ class EdgeNode(Thread):
         """
         Handles the incoming messages.
 
-        If messages are received from mobile nodes they are inserted into the outgoing_server cache.
+        If messages are received from mobile nodes the gateway takes custody of them
+        and inserts them into the outgoing_server cache.
 
-        If messages are received from the server they are stored in mobile_cache and sent to the mobile nodes.
-            - If the message is an Ack, remove this message from the mobile_cache.
-            - If a message hasn't been Ack'd in N seconds, discard it as it's destinatary likely been disconnected.
+        If messages are received from the server they are stored as bundles until a mobile node
+        in contact takes custody of them.
+            - If the message is a CUSTODY, drop the bundles it lists.
+            - If a bundle isn't taken into custody in N seconds, discard it as it's destinatary likely been disconnected.
         """
         while self.running:
             try:
@@ -316,38 +353,45 @@ class EdgeNode(Thread):
 
                 address = (addr[0], addr[1])
 
+                # copies from the mobile nodes are signalled again through custody instead
+                if address[0] == self.server_address[0] and self.recent.seen(data):
+                    continue
+
                 if self.preferred_mobile is None:
                     self.preferred_mobile = address
 
-                payload = Payload.from_bytes(data)
-                logging.info(
-                    'Received payload: {} {}'.format(payload.type, addr[0]))
+                # relayed datagrams aren't decoded, to_bytes() sends the buffer as received
+                payload = Frame(data) if self.fast_path else Payload.from_bytes(data)
+                logging.debug('Received payload: %s %s', payload.type, addr[0])
+
+                if not self._hop(payload):
+                    continue
 
                 # Figure whether the message is from the server or from a mobile node
                 #print("addresses ",address[0],self.server_address[0])
                 if address[0] == self.server_address[0]:
-                    logging.info('Received message from server.')
+                    logging.debug('Received message from server.')
+                    destination = (payload.short_destination, DEFAULT_PORT)
+
                     # if the message is an ack, remove the data from the outgoing_server cache
                     if payload.is_ack:
                         # the message's destination is the address of the sender of the original message
-                        destination = (payload.short_destination, DEFAULT_PORT)
-
                         self.outgoing_server.purge_entry(
                             destination, payload)
 
-                    self.outgoing_mobile.add_entry(address, payload)
-
-                else:
-                    # handle ACK messages
-                    if payload.is_ack:
-                        destination = (payload.short_destination, DEFAULT_PORT)
+                    if self.bundles.add(destination, payload.to_bytes()) is None:
+                        logging.warning('Bundle store full, dropped %s', payload.type)
 
-                        self.outgoing_mobile.purge_entry(
-                            destination, payload)
+                elif payload.is_custody:
+                    self.bundles.release(split_keys(payload.data))
 
-                    self.outgoing_server.add_entry(
-                        address, payload)
-                    logging.info(
+                else:
+                    # copies sent again missed our custody signal, they're only signalled again
+                    if self.bundles.custody((address[0], DEFAULT_PORT), payload.to_bytes()):
+                        self.outgoing_server.add_entry(
+                            address, payload)
+                        self.relayed += 1
+                    logging.debug(
                         'Received message from mobile node meant for server.')
 
             except timeout:
@@ -357,14 +401,38 @@ class EdgeNode(Thread):
                 logging.error(e)
                 continue
 
+    def _next_hop(self, destination: Address) -> Optional[Address]:
+        """
+        The node to forward a destination's bundles to: the destination itself if it's
+        in range, or a node closer to it.
+
+        :return: The node, or None while the destination is out of contact.
+        """
+        neighbor = self.mobile_nodes.get(destination)
+
+        if neighbor is None:
+            return None
+
+        if neighbor.hops == 0:
+            return destination
+
+        relay = self.mobile_nodes.toward(self.position, destination)
+        return destination if relay is None else relay[1].address
+
+    def _signal_custody(self):
+        """
+        Tells the mobile nodes which of their bundles the gateway took custody of.
+        """
+        for hop, keys in self.bundles.drain_signals():
+            payload = Payload(CUSTODY, keys, '', '', 0, self.gateway_dtn_address,
+                              inet_pton(AF_INET6, hop[0]), DEFAULT_PORT)
+            self.out_socket.sendto(payload.to_bytes(), hop)
+
     def _handle_outgoing(self):
         """
         Handles the outgoing messages.
         """
 
-        while self.preferred_mobile is None:
-            time.sleep(0.01)
-
         while self.running:
             # Send messages to the server
 
@@ -374,23 +442,33 @@ class EdgeNode(Thread):
 
             for (addr, payload) in outgoing:
                 #logging.info('Sending payload to {} {} {}'.format(payload.short_destination,payload.lobby_port,payload.type))
-                self.out_socket.sendto(
-                    payload.to_bytes(), (payload.short_destination, payload.lobby_port))
+                lobby = (payload.short_destination, payload.lobby_port)
 
-            # Send messages to the mobile nodes
-            outgoing = self.outgoing_mobile.get_entries_not_sent()
+                # the server's own port doesn't take batches, only lobbies do
+                if lobby[1] == DEFAULT_PORT:
+                    self.out_socket.sendto(payload.to_bytes(), lobby)
+                else:
+                    self.uplink.add(lobby, payload.to_bytes())
 
-            # get the preferred mobile node
-            out_addr = (self.preferred_mobile[0], DEFAULT_PORT)
+            if time.time() - self.last_summary >= KALIVE_INTERVAL:
+                self.last_summary = time.time()
+                for lobby, data in self.uplink.summaries():
+                    self.out_socket.sendto(data, lobby)
 
-            for (addr, payload) in outgoing:
-                logging.info('Sending payload to {} {}.'.format(
-                    out_addr, payload.type))
-                self.out_socket.sendto(payload.to_bytes(), out_addr)
+            for lobby, data in self.uplink.flush():
+                self.out_socket.sendto(data, lobby)
+
+            # Send the bundles of the mobile nodes in contact, the others wait for one
+            for destination in self.bundles.destinations():
+                hop = self._next_hop(destination)
+                if hop is None:
+                    continue
 
-            # TODO: Requires two changes that I can think of right now.
-            #      1. The mobile nodes will need a local cache of nearby nodes, this way they can send messages to their neighbors.
-            #      2. The same ACK system as on gateway.py#192 should be implemented on mobile nodes.
+                for bundle in self.bundles.due(destination):
+                    logging.debug('Sending bundle to %s through %s.', destination, hop)
+                    self.out_socket.sendto(bundle.data, (hop[0], DEFAULT_PORT))
+
+            self._signal_custody()
 
             time.sleep(0.033)
 
@@ -401,7 +479,7 @@ class EdgeNode(Thread):
         If a message has timed out, it is removed from the cache.
         """
         while self.running:
-            self.outgoing_mobile.purge_timeout()
+            self.bundles.expire()
             time.sleep(self.cache_timeout)
 
     def run(self):
@@ -435,20 +513,21 @@ class EdgeNode(Thread):
         outgoing_server = self.outgoing_server.get_entries_not_sent() + \
             self.outgoing_server.get_entries_sent()
 
-        outgoing_mobile = self.outgoing_mobile.get_entries_not_sent() + \
-            self.outgoing_mobile.get_entries_sent()
-
         for (_, payload) in outgoing_server:
             logging.debug('Sending {} to {}'.format(
                 payload, self.server_address))
             self.out_socket.sendto(payload.to_bytes(), self.server_address)
 
-        out_addr = self._get_preferred_node()
+        out_addr = self._get_preferred_node() or self.preferred_mobile
+
+        if out_addr is None:
+            return
 
-        for (addr, payload) in outgoing_mobile:
-            logging.debug('Sending {} to {} through {}.'.format(
-                payload, addr, out_addr))
-            self.out_socket.sendto(payload.to_bytes(), out_addr)
+        for bundle in self.bundles.bundles():
+            hop = self._next_hop(bundle.destination) or out_addr
+            logging.debug('Sending bundle to {} through {}.'.format(
+                bundle.destination, hop))
+            self.out_socket.sendto(bundle.data, (hop[0], DEFAULT_PORT))
 
         pass
 
@@ -14,6 +14,10 @@ if __name__ == '__main__':
     parser.add_argument('-a', '--address', type=str, required=True)
     parser.add_argument('-i', '--id', type=str, required=True)
     parser.add_argument('-l', '--level', type=str, default='info',)
+    parser.add_argument('--decode', action='store_true',
+                        help='Decode every relayed payload instead of forwarding it as received.')
+    parser.add_argument('-s', '--store', type=str, default=None,
+                        help='Directory to log the bundles in transit to, so they survive a restart.')
 
     args = parser.parse_args()
 
@@ -41,6 +45,7 @@ if __name__ == '__main__':
 
     print("node_ipv6", node_ipv6)
     gateway = EdgeNode((args.address, DEFAULT_PORT),
-                       node_path, node_ipv6, level=log_lvl)
+                       node_path, node_ipv6, level=log_lvl, fast_path=not args.decode,
+                       store_dir=args.store)
 
     gateway.start()
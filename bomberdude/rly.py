@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+
+import argparse
+from common.types import DEFAULT_PORT
+from server.relay import Relay
+from common.core_utils import get_node_ipv6
+from logging import INFO, DEBUG, ERROR, WARNING
+
+if __name__ == '__main__':
+    """
+    Start a bomberdude spectator relay.
+    """
+    parser = argparse.ArgumentParser(description='Bomberdude spectator relay.')
+    parser.add_argument('-a', '--address', type=str, required=True,
+                        help='Address of the server.')
+    parser.add_argument('-i', '--id', type=str, required=True)
+    parser.add_argument('--lobby', type=str, required=True,
+                        help='Uuid of the lobby to watch.')
+    parser.add_argument('-c', '--capacity', type=int, default=1024,
+                        help='Max number of viewers.')
+    parser.add_argument('-l', '--level', type=str, default='info',)
+
+    args = parser.parse_args()
+
+    # parse level
+    if args.level == 'debug':
+        log_lvl = DEBUG
+    elif args.level == 'error' or args.level == 'err':
+        log_lvl = ERROR
+    elif args.level == 'warning' or args.level == 'warn':
+        log_lvl = WARNING
+    else:
+        log_lvl = INFO
+
+    node_ipv6 = get_node_ipv6(args.id)
+    if node_ipv6 is None:
+        print("Node's ipv6 not found")
+        exit(1)
+
+    relay = Relay(args.lobby, (args.address, DEFAULT_PORT), node_ipv6,
+                  level=log_lvl, capacity=args.capacity)
+    relay.start()
@@ -0,0 +1,225 @@
+"""
+Admission control for the server and its lobbies.
+
+Every JOIN/REJOIN used to create a new Conn, and possibly a whole new Lobby,
+so a burst of reconnects after a network blip would explode the thread count.
+This module provides per-source token buckets, a JOIN dedupe table that lets
+retransmitted JOINs be answered with the cached ACCEPT, and a global budget for
+lobby creation.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Dict, Hashable, Optional, Tuple
+import time
+
+from common.types import TIMEOUT
+from .connection import Conn
+
+if TYPE_CHECKING:
+    from .lobby import Lobby
+
+
+@dataclass
+class TokenBucket:
+    """
+    A token bucket, refilled at a constant rate up to its burst size.
+
+    Attributes:
+        rate: Tokens added per second.
+        burst: Maximum number of tokens the bucket can hold.
+    """
+    rate: float
+    """Tokens added per second."""
+    burst: float
+    """Maximum number of tokens the bucket can hold."""
+    tokens: float = field(init=False)
+    """Tokens currently available."""
+    stamp: float = field(init=False)
+    """The time of the last refill."""
+
+    def __post_init__(self):
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def consume(self, amount: float = 1.0) -> bool:
+        """
+        Takes tokens from the bucket, if there are enough.
+
+        :param amount: The number of tokens to take.
+        :return: True if the tokens were taken, False otherwise.
+        """
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.stamp) * self.rate)
+        self.stamp = now
+
+        if self.tokens < amount:
+            return False
+
+        self.tokens -= amount
+        return True
+
+    @property
+    def is_full(self) -> bool:
+        """
+        Whether the bucket would be full if it was refilled now.
+        Full buckets carry no state and can be dropped.
+        """
+        return self.tokens + (time.time() - self.stamp) * self.rate >= self.burst
+
+
+@dataclass
+class RateLimiter:
+    """
+    A set of token buckets, one per source.
+    """
+    rate: float
+    """Tokens added per second to each bucket."""
+    burst: float
+    """Maximum number of tokens each bucket can hold."""
+    buckets: Dict[Hashable, TokenBucket] = field(
+        init=False, default_factory=dict)
+    """The buckets, indexed by source."""
+
+    def allow(self, source: Hashable) -> bool:
+        """
+        Checks whether the source is allowed to send one more packet.
+
+        :param source: The source of the packet.
+        :return: True if the packet should be handled, False if it should be dropped.
+        """
+        bucket = self.buckets.get(source)
+
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[source] = bucket
+
+        return bucket.consume()
+
+    def purge(self):
+        """
+        Drops the buckets of sources that have been quiet long enough to refill.
+        """
+        for source, bucket in list(self.buckets.items()):
+            if bucket.is_full:
+                del self.buckets[source]
+
+
+JoinEntry = Tuple[bytes, Conn, 'Lobby', float]
+"""The cached ACCEPT, the conn it was sent to, its lobby and when it was sent."""
+
+
+@dataclass
+class Admission:
+    """
+    Admission control for incoming JOIN/REJOIN payloads.
+
+    Attributes:
+        rate: JOINs allowed per second, per source.
+        burst: JOINs a source can send in a burst.
+        dedupe_timeout: Seconds during which a retransmitted JOIN gets the cached ACCEPT.
+        lobby_rate: Lobbies that can be created per second.
+        lobby_burst: Lobbies that can be created in a burst.
+        max_lobbies: Maximum number of lobbies the server will run.
+    """
+    rate: float = field(default=1.0)
+    """JOINs allowed per second, per source."""
+    burst: float = field(default=4)
+    """JOINs a source can send in a burst."""
+    dedupe_timeout: int = field(default=TIMEOUT)
+    """Seconds during which a retransmitted JOIN gets the cached ACCEPT."""
+    lobby_rate: float = field(default=1.0)
+    """Lobbies that can be created per second."""
+    lobby_burst: float = field(default=4)
+    """Lobbies that can be created in a burst."""
+    max_lobbies: int = field(default=64)
+    """Maximum number of lobbies the server will run."""
+
+    limiter: RateLimiter = field(init=False)
+    """Per-source rate limiting."""
+    joins: Dict[bytes, JoinEntry] = field(init=False, default_factory=dict)
+    """The JOIN dedupe table, indexed by the source's address."""
+    lobby_budget: TokenBucket = field(init=False)
+    """Global lobby creation budget."""
+    _last_purge: float = field(init=False, default_factory=time.time)
+
+    def __post_init__(self):
+        self.limiter = RateLimiter(self.rate, self.burst)
+        self.lobby_budget = TokenBucket(self.lobby_rate, self.lobby_burst)
+
+    def allow(self, source: Hashable) -> bool:
+        """
+        Checks whether a JOIN from the given source should be handled.
+
+        :param source: The address of the player that sent the JOIN, in bytes.
+        :return: True if the JOIN should be handled, False if it should be dropped.
+        """
+        if time.time() - self._last_purge > self.dedupe_timeout:
+            self.purge()
+
+        return self.limiter.allow(source)
+
+    def cached_accept(self, source: bytes) -> Optional[bytes]:
+        """
+        Fetches the ACCEPT previously sent to a source, if it's still valid.
+        An ACCEPT is valid while its conn is still part of the lobby.
+
+        :param source: The source's address in bytes.
+        :return: The cached ACCEPT or None.
+        """
+        entry = self.joins.get(source)
+
+        if entry is None:
+            return None
+
+        response, conn, lobby, timestamp = entry
+
+        if time.time() - timestamp > self.dedupe_timeout \
+                or not lobby.running or conn not in lobby.conns:
+            del self.joins[source]
+            return None
+
+        return response
+
+    def remember(self, source: bytes, response: bytes, conn: Conn, lobby: Lobby):
+        """
+        Caches the ACCEPT sent to a source.
+
+        :param source: The source's address in bytes.
+        :param response: The ACCEPT sent to the source.
+        :param conn: The conn created for the source.
+        :param lobby: The lobby the conn was added to.
+        """
+        self.joins[source] = (response, conn, lobby, time.time())
+
+    def can_create_lobby(self, lobbies: int) -> bool:
+        """
+        Checks whether the server can run one more lobby.
+        This doesn't take from the budget, taking a warm lobby from the pool is free.
+
+        :param lobbies: The number of lobbies currently running.
+        :return: True if a lobby can be created, False otherwise.
+        """
+        return lobbies < self.max_lobbies
+
+    def can_spawn_lobby(self, lobbies: int) -> bool:
+        """
+        Checks whether the global budget allows for spawning one more lobby, with its sockets and threads.
+
+        :param lobbies: The number of lobbies currently running or pooled.
+        :return: True if a lobby can be spawned, False otherwise.
+        """
+        if not self.can_create_lobby(lobbies):
+            return False
+
+        return self.lobby_budget.consume()
+
+    def purge(self):
+        """
+        Drops stale rate limiting and dedupe entries.
+        """
+        self._last_purge = time.time()
+        self.limiter.purge()
+
+        for source in list(self.joins):
+            self.cached_accept(source)
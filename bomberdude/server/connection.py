@@ -1,10 +1,12 @@
 from ipaddress import ip_address
-from common.types import DEFAULT_PORT, TIMEOUT
+from common.fanout import FanOut
+from common.types import DEFAULT_PORT, KALIVE_INTERVAL, TIMEOUT
 from common.uuid import uuid
 from dataclasses import dataclass, field
 from logging import Logger
 from socket import AF_INET6, inet_ntop, inet_pton, socket
-from typing import Tuple
+from threading import Lock
+from typing import Optional, Tuple
 import time
 # import struct
 
@@ -39,12 +41,27 @@ class Conn:
     seq_num: int = field(default=0, init=False)
     """The sequence number of the connection."""
 
+    out_seq: int = field(default=0, init=False)
+    """The sequence number of the last payload sent to the client."""
+
     uuid: str = field(init=False)
     """The unique id of the connection."""
 
     lobby_uuid: str = field(init=False, default='')
     """The lobby uuid."""
 
+    last_sent: float = field(init=False, default=0.0)
+    """The time of the last packet sent to the client."""
+
+    last_snapshot: float = field(init=False, default=0.0)
+    """The time of the last state snapshot sent to the client."""
+
+    player_id: int = field(init=False, default=0)
+    """The id of the client's player in the running game, 0 if none."""
+
+    lock: Lock = field(init=False, default_factory=Lock, repr=False, compare=False)
+    """Protects the sequence number, payloads are sent to the client from several threads."""
+
     def __hash__(self) -> int:
         """
         A connection's hash is calculated using it's uuid
@@ -60,6 +77,16 @@ class Conn:
         """
         return int(time.time()) - self.last_kalive > TIMEOUT
 
+    @property
+    def idle(self) -> bool:
+        """
+        Checks whether nothing was sent to the client for a KALIVE interval.
+        Any packet sent to the client doubles as a KALIVE.
+
+        :return: True if an explicit KALIVE should be sent, False otherwise.
+        """
+        return time.time() - self.last_sent > KALIVE_INTERVAL
+
     def __post_init__(self):
         # use inet_ntop to convert the byte address to a string
         self.address = (inet_ntop(AF_INET6, self.byte_address), DEFAULT_PORT)
@@ -77,11 +104,37 @@ class Conn:
         Sends packet to client.
         """
         self.logger.debug('Sending packet, {data}, to client {self.uuid}')
+        self.last_sent = time.time()
         return sock.sendto(data, self.address)
 
+    def next_seq(self) -> int:
+        """
+        Numbers a new payload sent to the client.
+        Relays tell payloads apart by their sequence number, so no two payloads may share one.
+
+        :return: The sequence number of the payload.
+        """
+        with self.lock:
+            self.out_seq = (self.out_seq + 1) & 0x7fffffff
+            return self.out_seq
+
+    def send_fanout(self, fanout: FanOut, sock: socket, seq_num: Optional[int] = None) -> int:
+        """
+        Sends a shared payload to the client, patching in this connection's fields.
+
+        :param fanout: The payload shared by all recipients.
+        :param sock: The socket used to send the payload.
+        :param seq_num: The sequence number of the packet, a new one if None.
+        """
+        if seq_num is None:
+            seq_num = self.next_seq()
+        self.last_sent = time.time()
+        return fanout.sendto(sock, self.address, self.uuid, seq_num, self.byte_address)
+
     def kalive(self):
         """
         Updates the last kalive time.
+        Called for every packet received from the client, not just KALIVEs.
         """
         self.last_kalive = int(time.time())
         self.logger.debug('Updated last kalive time to {self.last_kalive}')
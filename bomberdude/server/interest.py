@@ -0,0 +1,139 @@
+"""
+Area-of-interest filtering of outbound changes.
+
+Every change used to be sent to every conn of a lobby, so the traffic of each
+player grew with the number of players and the size of the board. Moves make up
+most of the traffic and only matter to the players that can see them, so a move
+is only sent to the players within a radius of either of its cells. Bombs,
+deaths and popped boxes are rare and change the board for good, so they're
+always sent to everyone.
+
+Players are kept in a grid of buckets as wide as the radius, so finding the
+players around a cell only looks at the 3x3 buckets around it, whatever the size
+of the board and the number of players.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Set, Tuple
+
+from common.state import DEAD_TILE, PLAYER_1, PLAYER_4, PLAYER_TILE, Change
+
+Cell = Tuple[int, int]
+
+
+@dataclass
+class Interest:
+    """
+    The position of each player, bucketed to find the players around a cell.
+
+    Attributes:
+        radius: The distance, in cells, up to which a player is sent the moves of others.
+    """
+    radius: int
+    """The distance, in cells, up to which a player is sent the moves of others."""
+    buckets: Dict[Cell, Set[int]] = field(init=False, default_factory=dict)
+    """The ids of the players in each bucket."""
+    positions: Dict[int, Cell] = field(init=False, default_factory=dict)
+    """The position of each tracked player."""
+
+    def __post_init__(self):
+        if self.radius < 1:
+            raise ValueError(f'Invalid interest radius {self.radius}')
+
+    def _bucket(self, x: int, y: int) -> Cell:
+        return x // self.radius, y // self.radius
+
+    def track(self, id: int, x: int, y: int):
+        """
+        Places a player, or moves it if it's already tracked.
+        """
+        old = self.positions.get(id)
+        if old is not None:
+            if old == (x, y):
+                return
+            self.forget(id)
+
+        self.positions[id] = (x, y)
+        self.buckets.setdefault(self._bucket(x, y), set()).add(id)
+
+    def forget(self, id: int):
+        """
+        Stops tracking a player, e.g. once it's dead.
+        """
+        pos = self.positions.pop(id, None)
+        if pos is None:
+            return
+
+        bucket = self._bucket(*pos)
+        self.buckets[bucket].discard(id)
+        if not self.buckets[bucket]:
+            del self.buckets[bucket]
+
+    def sync(self, players: Dict[int, Cell]):
+        """
+        Tracks exactly the given players, at the given positions.
+
+        :param players: The players of the game, {id: (x,y)}.
+        """
+        for id in list(self.positions):
+            if id not in players:
+                self.forget(id)
+
+        for id, (x, y) in players.items():
+            self.track(id, x, y)
+
+    def near(self, x: int, y: int) -> Set[int]:
+        """
+        Finds the players within the radius of a cell.
+
+        :return: The ids of the players.
+        """
+        bx, by = self._bucket(x, y)
+        out = set()
+
+        for cx in (bx - 1, bx, bx + 1):
+            for cy in (by - 1, by, by + 1):
+                for id in self.buckets.get((cx, cy), ()):
+                    px, py = self.positions[id]
+                    if abs(px - x) <= self.radius and abs(py - y) <= self.radius:
+                        out.add(id)
+
+        return out
+
+    def route(self, changes: Iterable[Change], ids: Iterable[int]) -> Dict[int, List[Change]]:
+        """
+        Splits a batch of outbound changes between the players interested in them.
+        Players are moved as their moves go by, so every change is routed
+        against the positions the players had when it was applied.
+
+        :param changes: The changes, in the order they were applied.
+        :param ids: The ids of the recipients, those not tracked (e.g. dead) are sent everything.
+        :return: The changes to send to each recipient, in order.
+        """
+        out: Dict[int, List[Change]] = {id: [] for id in ids}
+        untracked = {id for id in out if id not in self.positions}
+
+        for change in changes:
+            x, y, t = change.curr
+            _x, _y, _t = change.next
+
+            if PLAYER_1 <= t <= PLAYER_4 and t == _t:
+                recipients = self.near(x, y) | self.near(_x, _y) | untracked
+                self.track(t - PLAYER_TILE, _x, _y)
+
+                for id in recipients:
+                    if id in out:
+                        out[id].append(change)
+                continue
+
+            # everything but moves is global, dead players are sent everything from then on
+            if PLAYER_1 <= t <= PLAYER_4 and _t == t - PLAYER_TILE + DEAD_TILE:
+                id = t - PLAYER_TILE
+                self.forget(id)
+                if id in out:
+                    untracked.add(id)
+
+            for lst in out.values():
+                lst.append(change)
+
+        return out
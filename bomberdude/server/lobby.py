@@ -1,18 +1,28 @@
 from __future__ import annotations
 from ipaddress import ip_address
 
-from common.types import DEFAULT_PORT, TIMEOUT, Address
+from common.types import DEFAULT_PORT, KALIVE_INTERVAL, TIMEOUT, Address
+from .admission import RateLimiter
 from .connection import Conn
-from common.state import GameState
-from common.payload import ACK, ACTIONS, KALIVE, STATE, Payload
-from common.state import Change, bytes_from_changes, change_from_bytes
+from .interest import Interest
+from .spectate import Spectator, Spectators
+from common.state import DEFAULT_SIZE, TICK, GameState
+from common.payload import ACK, ACTIONS, BATCH, HDR_PLAYER, HDR_TYPE, KALIVE, SNAPSHOT, STATE, Payload
+from common.batch import split_players, unbatch
+from common.state import DEAD_TILE, PLAYER_TILE, Change, bytes_from_changes, change_from_bytes, parse_box_stamp, parse_stamp
 from common.cache import Cache
+from common.dedupe import RecentSet
+from common.fanout import FanOut
+from common.rollback import Input, Rollback
+from common.replay import ReplayWriter
 from dataclasses import dataclass, field
 import logging
+import os
+import random
 from socket import AF_INET6, inet_pton, socket, timeout
-from threading import Thread, Lock
+from threading import Event, Thread, Lock
 import time
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Tuple
 import json
 
 
@@ -35,8 +45,16 @@ class Lobby(Thread):
     level: int = field(default=logging.DEBUG)
     # max number of players allowed in the lobby
     capacity: int = field(default=4)
+    # (width, height) of the board, both must be odd
+    size: Tuple[int, int] = field(default=DEFAULT_SIZE)
+    # seed of the map generator, a new map is drawn for every game if None
+    seed: Optional[int] = field(default=None)
+    # chance of each free cell holding a box
+    density: float = field(default=0.7)
     # list of players currently present in the lobby
     conns: List[Conn] = field(init=False, default_factory=list)
+    # set while the lobby is full, the game starts once it is
+    full: Event = field(init=False, default_factory=Event)
     # list of actions that are yet to be handled
     action_queue_inbound: List[Payload] = field(
         init=False, default_factory=list)
@@ -44,6 +62,39 @@ class Lobby(Thread):
     action_queue_outbound: List[Change] = field(
         init=False, default_factory=list)
 
+    # max number of packets per second accepted from each player
+    rate_limit: float = field(default=100)
+    # per-player rate limiting, checked before payloads are decoded
+    limiter: RateLimiter = field(init=False)
+    # payloads received recently, copies relayed by several gateways are dropped before decoding
+    recent: RecentSet = field(init=False, default_factory=RecentSet)
+
+    # whether actions are validated against the game state before being applied,
+    # and bombs detonated by the lobby rather than by the players
+    authoritative: bool = field(default=False)
+    # players are only sent the moves within this many cells of them, everything is sent if None
+    interest_radius: Optional[int] = field(default=None)
+    # positions of the players, used to filter outbound moves
+    interest: Optional[Interest] = field(init=False, default=None)
+
+    # max number of spectators watching the lobby
+    spectator_capacity: int = field(default=256)
+    # seconds between two snapshots sent to every spectator
+    spectator_refresh: float = field(default=5.0)
+    # read-only subscribers, sent an unacknowledged stream
+    spectators: Spectators = field(init=False)
+
+    # min seconds between two snapshots sent to the same desynced player
+    snapshot_interval: float = field(default=1.0)
+    # number of ticks a late action can be slotted back into, 0 disables rollback
+    rollback_window: int = field(default=32)
+    # recent ticks, used to re-simulate late actions
+    rollback: Rollback = field(init=False)
+    # directory the games are recorded to, recording is off if None
+    record: Optional[str] = field(default=None)
+    # replay file of the running game
+    recorder: Optional[ReplayWriter] = field(init=False, default=None)
+
     # Cache related class properties
     cache_timeout: int = field(default=30)
     """Default amount of time to wait for a message to be ACKed."""
@@ -59,6 +110,10 @@ class Lobby(Thread):
     in_game: bool = field(init=False, default=False)
     # flag to indicate whether the lobby is running
     running: bool = field(init=False, default=False)
+    # flag to indicate whether the lobby has had players since it was last reset
+    in_use: bool = field(init=False, default=False)
+    # called once the lobby has been reset, if unset the lobby terminates instead
+    on_recycle: Optional[Callable[[Lobby], None]] = field(default=None)
 
     def __hash__(self) -> int:
         return super().__hash__()
@@ -71,8 +126,12 @@ class Lobby(Thread):
         """
         super(Lobby, self).__init__()
         self.game_state_lock = Lock()
-        self.game_state = GameState(self.game_state_lock, {}, {})
+        self.game_state = GameState(
+            self.game_state_lock, {}, {}, size=self.size)
         self.outbound = Cache(self.cache_timeout, level=self.level)
+        self.limiter = RateLimiter(self.rate_limit, 2 * self.rate_limit)
+        self.rollback = Rollback(self.rollback_window)
+        self.spectators = Spectators(self.spectator_capacity)
 
         logging.basicConfig(
             level=self.level, format='%(levelname)s: %(message)s')
@@ -98,9 +157,36 @@ class Lobby(Thread):
                 return False
 
         self.conns.append(conn)
+        self.in_use = True
+        if self.is_full:
+            self.full.set()
         logging.info('Added conn to lobby, %s', conn.__str__())
         return True
 
+    def add_players(self, conns: List[Conn]) -> bool:
+        """
+        Adds a group of conns to the lobby at once, or none of them.
+
+        :param conns: The conns to be added.
+        """
+        with self.game_state_lock:
+            if len(self.conns) + len(conns) > self.capacity:
+                logging.info('Lobby can\'t fit %d conns', len(conns))
+                return False
+
+            addresses = [c.address for c in self.conns]
+            if any(c.address in addresses for c in conns):
+                logging.info('Connection already exists in lobby')
+                return False
+
+            self.conns.extend(conns)
+            self.in_use = True
+            if self.is_full:
+                self.full.set()
+
+        logging.info('Added %d conns to lobby', len(conns))
+        return True
+
     def get_player(self, addr: Tuple[str, int]) -> Optional[Conn]:
         """
         Gets a conn from the lobby.
@@ -135,6 +221,7 @@ class Lobby(Thread):
             return False
 
         self.conns.remove(conn)
+        self.full.clear()
         logging.info('Removed conn from lobby, %s', conn.__str__())
         return True
 
@@ -215,76 +302,19 @@ class Lobby(Thread):
         This method should not be called directly.
 
         Method that will run in a separate thread to handle incoming data.
+        Gateways pack the payloads of their mobile nodes into BATCHes, those are handled one by one.
         """
         while self.running:
 
             try:
                 data, addr = self.in_sock.recvfrom(1500)
 
-                # parse the data
-                payload = Payload.from_bytes(data)
-                logging.debug('Received payload, %s %s', payload.type_str, payload.short_source)
-                # get the conn that sent the data
-                conn = self.get_player_by_uuid(payload.player_uuid)
-
-                if conn is None:
-                    # TODO: Change this later for NDN redirect support
-                    logging.info('Connection not found.',)
-                    continue
-                
-                addr_aux = (addr[0],DEFAULT_PORT)
-                
-                if conn.address != addr_aux:
-                    print("addresses ",addr_aux, conn.address,payload.short_source)
-                    conn.address = addr_aux
-                    
-                #    conn.byte_address = inet_pton(AF_INET6, ip_address(addr_aux[0]).exploded )
-                
-                # handle ACKs as these might have an invalid seq_num
-                if payload.is_ack:
-                    self.outbound.purge_entry(
-                        (payload.short_source, DEFAULT_PORT), payload)
-                    continue
-
-                    # If the payload's sequence number is equal or older than the current one, discard
-                    # TODO: This is a hack fix, will require some work later on.
-                if payload.seq_num <= conn.seq_num:
-                    #print('Sequence number is older, %s', conn.__str__())
-                    logging.debug('Sequence number is older, %s',
-                                  conn.__str__())
-                 #   continue
-                conn.seq_num += 1
-
-                # If it's an action, append it to the action queue
-                if payload.is_actions:
-                    with self.game_state_lock:
-                        self.action_queue_inbound.append(payload)
-                        ack_payload = Payload(
-                            ACK, b'', self.uuid, conn.uuid, payload.seq_num, self.byte_address, payload.source, DEFAULT_PORT)
-                        self.outbound.add_entry(
-                            (payload.short_source, DEFAULT_PORT), ack_payload)
-
-                elif payload.is_leave:
-                    try:
-                        self.remove_player(conn)
-                        # acknowledge the leave
-                        ack_payload = Payload(
-                            ACK, b'', self.uuid, conn.uuid, payload.seq_num, self.byte_address, payload.source, DEFAULT_PORT)
-                        self.outbound.add_entry(
-                            (payload.short_source, DEFAULT_PORT), ack_payload)
-
-                    except ValueError:
-                        logging.error(
-                            'Attempt to remove unexistent connection, %s', conn.__str__())
-
-                elif payload.is_kalive:
-                    logging.debug('Received KALIVE, %s', conn.__str__())
-                    conn.kalive()
-
+                if data[HDR_TYPE] == BATCH:
+                    if not self.recent.seen(data):
+                        for datagram in unbatch(data):
+                            self._handle_payload(datagram, addr)
                 else:
-                    # Unhandled payload type
-                    logging.error(
-                        'Unhandled payload type, %d', payload.type)
+                    self._handle_payload(data, addr)
 
             except timeout:
                 logging.debug('Socket timeout on _handle_incoming_data')
@@ -294,6 +324,113 @@ class Lobby(Thread):
                     'Error in _handle_incoming_data, %s', e.__str__())
             time.sleep(0.01)
 
+    def _handle_payload(self, data: bytes | memoryview, addr: Address):
+        """
+        This method should not be called directly.
+
+        Handles a payload received from a player, directly or through a gateway.
+
+        :param data: The serialized payload.
+        :param addr: The address it was received from.
+        """
+        try:
+            # the same payload relayed over several paths is only handled once
+            if self.recent.seen(data):
+                logging.debug('Duplicate packet from %s', addr[0])
+                return
+
+            # drop floods before decoding, mobiles share their gateway's address
+            if not self.limiter.allow(bytes(data[HDR_PLAYER:HDR_PLAYER + 4])):
+                logging.debug('Rate limited packet from %s', addr[0])
+                return
+
+            # parse the data
+            payload = Payload.from_bytes(bytes(data))
+            logging.debug('Received payload, %s %s', payload.type_str, payload.short_source)
+
+            # the players a gateway heard KALIVEs from
+            if payload.is_alive:
+                for uuid in split_players(payload.data):
+                    conn = self.get_player_by_uuid(uuid)
+                    if conn is None:
+                        self.spectators.renew(uuid)
+                        continue
+                    conn.kalive()
+                    conn.address = (addr[0], DEFAULT_PORT)
+                return
+
+            # get the conn that sent the data
+            conn = self.get_player_by_uuid(payload.player_uuid)
+
+            if conn is None:
+                # spectators only send KALIVEs, to stay subscribed
+                if self.spectators.renew(payload.player_uuid):
+                    return
+                # TODO: Change this later for NDN redirect support
+                logging.info('Connection not found.',)
+                return
+            
+            # any payload is proof of life
+            conn.kalive()
+
+            addr_aux = (addr[0],DEFAULT_PORT)
+            
+            if conn.address != addr_aux:
+                print("addresses ",addr_aux, conn.address,payload.short_source)
+                conn.address = addr_aux
+                
+            #    conn.byte_address = inet_pton(AF_INET6, ip_address(addr_aux[0]).exploded )
+            
+            # handle ACKs as these might have an invalid seq_num
+            if payload.is_ack:
+                self.outbound.purge_entry(
+                    (payload.short_source, DEFAULT_PORT), payload)
+                self._check_sync(conn, payload)
+                return
+
+                # If the payload's sequence number is equal or older than the current one, discard
+                # TODO: This is a hack fix, will require some work later on.
+            if payload.seq_num <= conn.seq_num:
+                #print('Sequence number is older, %s', conn.__str__())
+                logging.debug('Sequence number is older, %s',
+                              conn.__str__())
+             #   return
+            conn.seq_num += 1
+
+            # If it's an action, append it to the action queue
+            if payload.is_actions:
+                with self.game_state_lock:
+                    self.action_queue_inbound.append(payload)
+                    ack_payload = Payload(
+                        ACK, b'', self.uuid, conn.uuid, payload.seq_num, self.byte_address, payload.source, DEFAULT_PORT)
+                    self.outbound.add_entry(
+                        (payload.short_source, DEFAULT_PORT), ack_payload)
+
+            elif payload.is_leave:
+                try:
+                    self.remove_player(conn)
+                    # acknowledge the leave
+                    ack_payload = Payload(
+                        ACK, b'', self.uuid, conn.uuid, payload.seq_num, self.byte_address, payload.source, DEFAULT_PORT)
+                    self.outbound.add_entry(
+                        (payload.short_source, DEFAULT_PORT), ack_payload)
+
+                except ValueError:
+                    logging.error(
+                        'Attempt to remove unexistent connection, %s', conn.__str__())
+
+            elif payload.is_kalive:
+                logging.debug('Received KALIVE, %s', conn.__str__())
+
+            else:
+                # Unhandled payload type
+                logging.error(
+                    'Unhandled payload type, %d', payload.type)
+
+        except Exception as e:
+            logging.error(
+                'Error in _handle_payload, %s', e.__str__())
+
     def _handle_game_state_changes(self):
         """
         This method should not be called directly.
@@ -301,9 +438,9 @@ class Lobby(Thread):
         Method that will run in a separate thread to handle game state changes.
         """
         while self.running:
-            while not self.is_full:
-                # wait until the lobby is full to start the game
-                time.sleep(0.03)
+            # wait until the lobby is full to start the game
+            if not self.full.wait(1):
+                continue
 
             self.in_game = True
             _out = {}
@@ -311,29 +448,51 @@ class Lobby(Thread):
             #                      str | Dict[int, Tuple[int, int]]]] = {}
             start_time = time.time()
 
-            self.game_state.generate_map()
-
-            print('sending boxes: ', self.game_state.boxes)
+            # players draw the same map from the seed, the boxes of a large board don't fit a datagram
+            seed = self.seed if self.seed is not None else random.getrandbits(32)
+            self.game_state.generate_map(seed, self.density)
 
             for i, c in enumerate(self.conns):
+                c.player_id = i + 1
                 _out[c] = {
                     'id': i+1,
-                    'time': start_time,
                     'uuid': c.uuid,
-                    'boxes': self.game_state.boxes
                 }
 
+            if self.interest_radius is not None:
+                self.interest = Interest(self.interest_radius)
+                self.interest.sync(self.game_state.players)
+
+            # every player receives the same body, their id is looked up by uuid
+            data = json.dumps({
+                'time': start_time,
+                'players': {c.uuid: v['id'] for c, v in _out.items()},
+                'size': self.game_state.size,
+                'seed': seed,
+                'density': self.density,
+            }).encode()
+            fanout = FanOut(STATE, data, self.uuid,
+                            self.byte_address, DEFAULT_PORT)
+            # the same payload sent repeatedly, relays drop the copies
+            seqs = {c: c.next_seq() for c in _out}
+
             while start_time + 2 > time.time():
-                for k, v in _out.items():
-                    data = json.dumps(v).encode()
-                    payload = Payload(STATE, data, self.uuid,
-                                      k.uuid, 0, self.byte_address, k.byte_address, DEFAULT_PORT)
-                    k.send(payload.to_bytes(), self.out_sock)
+                for k in _out:
+                    k.send_fanout(fanout, self.out_sock, seqs[k])
                 time.sleep(0.05)
 
             logging.info('Game started on lobby %s', self.uuid)
 
+            if self.record is not None:
+                self._start_recording(start_time)
+            tick = 0
+            started = time.time()
+
+            # player ids by uuid, so players may only change their own tile
+            ids = {v['uuid']: v['id'] for v in _out.values()}
+
             while self.in_game:
+                tick += 1
                 _incoming_changes = []
 
                 with self.game_state_lock:
@@ -345,27 +504,139 @@ class Lobby(Thread):
                         self.remove_player(c)
                         id = _out[c]['id']
                         lobby_uuid = _out[c]['uuid']
-                        data = Change((0, 0, id+9), (0, 0, id + 109))
+                        if id not in self.game_state.players:
+                            continue
+                        # killed where they stand, so the change is a valid one
+                        x, y = self.game_state.players[id]
+                        data = Change((x, y, id + PLAYER_TILE), (x, y, id + DEAD_TILE))
                         print('killed player', id)
                         payload = Payload(ACTIONS, data.to_bytes(
                         ), lobby_uuid, id, 0, self.byte_address, c.byte_address, DEFAULT_PORT)
                         _incoming_changes.append(payload)
 
-                # Unpack all incoming changes
-                for payload in _incoming_changes:
-                    changes = change_from_bytes(payload.data)
-                    # changes = payload.data
-                    for change in changes:
-                        self.game_state._apply_change(change)
-                    #print(changes)
-                    # append updates to the outgoing queue
-                    self.action_queue_outbound.extend(changes)
+                # Unpack all incoming changes, the changes are applied and queued
+                # under the lock so the players receive them in the order they were hashed
+                with self.game_state_lock:
+                    accepted = []
+                    if self.rollback_window:
+                        self.rollback.begin(self.game_state)
+
+                    for payload in _incoming_changes:
+                        data = payload.data
+
+                        if self.authoritative:
+                            data, rejected = self.game_state.validate(
+                                data, ids.get(payload.player_uuid))
+                            if rejected:
+                                logging.debug('Rejected %d invalid changes', rejected)
+
+                        changes = change_from_bytes(data)
+                        # changes = payload.data
+
+                        if self.rollback_window:
+                            # late actions are slotted back in order and the game re-simulated
+                            corrections = self.rollback.submit(self.game_state, Input(
+                                payload.player_uuid, payload.seq_num, changes))
+
+                            if corrections is None:
+                                logging.debug('Dropped duplicate actions')
+                                continue
+
+                            changes = changes + corrections
+
+                        self.game_state.apply_changes(changes)
+                        if self.authoritative:
+                            self.game_state.light(changes)
+                        #print(changes)
+                        # append updates to the outgoing queue
+                        self.action_queue_outbound.extend(changes)
+                        accepted.extend(changes)
+
+                    if self.authoritative:
+                        # the game is advanced on the clock, so fuses last the same whatever the loop's pace
+                        while self.game_state.tick < (time.time() - started) / TICK:
+                            effects = self.game_state.advance()
+                            self.action_queue_outbound.extend(effects)
+                            accepted.extend(effects)
+
+                    if self.recorder is not None and accepted:
+                        self.recorder.changes(tick, accepted, self.game_state)
 
                 time.sleep(0.03)
 
             # Game over
             logging.info('Game over on lobby %s', self.uuid)
+            if self.recorder is not None:
+                self.recorder.close()
+                self.recorder = None
+            self.interest = None
             self.game_state.reset()
+            self.rollback.clear()
+
+    def _start_recording(self, start_time: float):
+        """
+        This method should not be called directly.
+
+        Opens the replay file of a new game and records its initial state.
+
+        :param start_time: The time the game started at, used to name the file.
+        """
+        try:
+            os.makedirs(self.record, exist_ok=True)
+            path = os.path.join(self.record, '%s-%d.bdr' % (self.uuid, start_time))
+            self.recorder = ReplayWriter(path)
+        except OSError as e:
+            logging.error('Could not record game on lobby %s, %s', self.uuid, e.__str__())
+            return
+
+        with self.game_state_lock:
+            self.recorder.snapshot(0, self.game_state)
+
+        logging.info('Recording game to %s', path)
+
+    def _check_sync(self, conn: Conn, payload: Payload):
+        """
+        This method should not be called directly.
+
+        Compares the digest a player reported in an ACK with the lobby's digest at the same version.
+        With interest filtering players aren't sent every move, so the digest of the boxes is compared instead.
+        Desynced players are sent a snapshot of the game state.
+
+        :param conn: The player that sent the ACK.
+        :param payload: The ACK.
+        """
+        if not self.in_game:
+            return
+
+        if self.interest is None:
+            stamp = parse_stamp(payload.data)
+            digest_at = self.game_state.digest_at
+        else:
+            stamp = parse_box_stamp(payload.data)
+            digest_at = self.game_state.box_digest_at
+
+        if stamp is None:
+            return
+
+        version, digest = stamp
+
+        with self.game_state_lock:
+            if digest_at(version) == digest:
+                return
+
+            if time.time() - conn.last_snapshot < self.snapshot_interval:
+                return
+
+            parts = self.game_state.snapshot()
+
+        logging.info('Player desynced at version %d, sending snapshot in %d parts, %s',
+                     version, len(parts), conn.__str__())
+
+        conn.last_snapshot = time.time()
+        for data in parts:
+            snapshot = Payload(SNAPSHOT, data, self.uuid, conn.uuid, conn.next_seq(),
+                               self.byte_address, conn.byte_address, DEFAULT_PORT)
+            conn.send(snapshot.to_bytes(), self.out_sock)
 
     def _handle_outgoing(self):
         """
@@ -384,17 +655,29 @@ class Lobby(Thread):
                     actions = self.action_queue_outbound
                     self.action_queue_outbound = []
 
-                # convert actions to bytes
-                data = bytes_from_changes(actions)
+                groups = self._route(actions)
 
-                for c in self.conns:
-                    # TODO: add this to cache's sent payloads
-                    payload = Payload(ACTIONS, data, self.uuid,
-                                      c.uuid, c.seq_num, self.byte_address, c.byte_address, DEFAULT_PORT)
+                for data, conns in groups:
+                    # convert actions to bytes, once for every group of conns
+                    fanout = FanOut(ACTIONS, data, self.uuid,
+                                    self.byte_address, DEFAULT_PORT)
 
-                    # cache the payload
-                    self.outbound.add_sent_entry(c.address, payload)
-                    c.send(payload.to_bytes(), self.out_sock)
+                    for c in conns:
+                        # every batch is numbered on its own, the player acks it by its number
+                        seq_num = c.next_seq()
+                        # the cached payload shares the serialized body
+                        payload = Payload(ACTIONS, data, self.uuid,
+                                          c.uuid, seq_num, self.byte_address, c.byte_address, DEFAULT_PORT)
+
+                        # cache the payload
+                        self.outbound.add_sent_entry(c.address, payload)
+                        c.send_fanout(fanout, self.out_sock, seq_num)
+
+                if len(self.spectators):
+                    # spectators watch the whole board, serialized once for all of them
+                    data = groups[0][0] if self.interest is None else bytes_from_changes(actions)
+                    self.spectators.broadcast(FanOut(ACTIONS, data, self.uuid,
+                                                     self.byte_address, DEFAULT_PORT), self.out_sock)
 
                 # get payloads from the outbound cache
                 payloads = self.outbound.get_entries_not_sent()
@@ -415,29 +698,106 @@ class Lobby(Thread):
                         for payload in payloads_by_conn[c.address]:
                             c.send(payload.to_bytes(), self.out_sock)
 
-                time.sleep(0.03)
+            time.sleep(0.03)
+
+    def _route(self, actions: List[Change]) -> List[Tuple[bytes, List[Conn]]]:
+        """
+        This method should not be called directly.
+
+        Splits outbound actions between the conns interested in them.
+        Conns that are sent the same actions are grouped, so they're only serialized once.
+
+        :param actions: The actions, in the order they were applied.
+        :return: The serialized actions and the conns to send them to.
+        """
+        interest = self.interest
+        conns = list(self.conns)
+
+        if interest is None:
+            return [(bytes_from_changes(actions), conns)]
+
+        routed = interest.route(actions, [c.player_id for c in conns])
+        groups: Dict[bytes, List[Conn]] = {}
+
+        for c in conns:
+            changes = routed[c.player_id]
+            if changes:
+                groups.setdefault(bytes_from_changes(changes), []).append(c)
+
+        return list(groups.items())
+
+    def _snapshot(self) -> List[FanOut]:
+        """
+        This method should not be called directly.
+
+        Serializes a snapshot of the game state, shared by every spectator it's sent to.
+        """
+        with self.game_state_lock:
+            parts = self.game_state.snapshot()
+
+        return [FanOut(SNAPSHOT, data, self.uuid, self.byte_address, DEFAULT_PORT)
+                for data in parts]
+
+    def subscribe(self, byte_address: bytes) -> Optional[Spectator]:
+        """
+        Subscribes a spectator to the lobby and sends it a snapshot of the game.
+
+        :param byte_address: The bytes representation of the spectator's address.
+        :return: The spectator or None if the lobby can't take more spectators.
+        """
+        spectator = self.spectators.subscribe(byte_address)
+
+        if spectator is None:
+            logging.info('Lobby %s has no room for spectators', self.uuid)
+            return None
+
+        for part in self._snapshot():
+            self.spectators.send(part, self.out_sock, spectator)
+        logging.info('Spectator %s subscribed to lobby %s', spectator.uuid, self.uuid)
+        return spectator
 
     def _kalive(self):
         """
         This method should not be called directly from outside the lobby.
 
-        Method running in a separate thread to broadcast kalives to all conns and handle timeouts.
+        Method running in a separate thread to send kalives to idle conns and handle timeouts.
+        Conns that received any packet during the last interval are skipped.
         """
-        # every 1 second send a kalive to all conns
+        _last_refresh = time.time()
+
+        # every interval send a kalive to the conns that didn't receive anything
         while self.running:
-            time.sleep(1)
+            time.sleep(KALIVE_INTERVAL)
 
-            # if no one is connected, stop the lobby
-            if len(self.conns) == 0:
-                self.terminate()
+            # a failed send mustn't stop the timeouts and recycling handled here
+            try:
+                if self.spectators.purge():
+                    logging.debug('Dropped expired spectators')
+
+                # catch spectators up on the changes they lost
+                if len(self.spectators) and time.time() - _last_refresh > self.spectator_refresh:
+                    _last_refresh = time.time()
+                    for part in self._snapshot():
+                        self.spectators.broadcast(part, self.out_sock)
 
-            sent = 0
+                # once everyone has left, reset the lobby so it can be reused
+                if self.is_empty and self.in_use:
+                    self.recycle()
 
-            for c in self.conns:
-                sent += c.send(Payload(KALIVE, b'', self.uuid,
-                                       c.uuid, 0, self.byte_address, c.byte_address, DEFAULT_PORT).to_bytes(), self.out_sock)
+                self.limiter.purge()
 
-            logging.debug('Sent %d bytes', sent)
+                sent = 0
+                fanout = FanOut(KALIVE, b'', self.uuid,
+                                self.byte_address, DEFAULT_PORT)
+
+                for c in self.conns:
+                    if c.idle:
+                        sent += c.send_fanout(fanout, self.out_sock)
+
+                logging.debug('Sent %d bytes', sent)
+
+            except Exception as e:
+                logging.error('Error in _kalive, %s', e.__str__())
 
     def run(self):
         """
@@ -463,6 +823,44 @@ class Lobby(Thread):
         while self.running:
             time.sleep(0.1)
 
+    def reset(self) -> bool:
+        """
+        Resets the lobby after its players left, keeping its sockets and threads.
+
+        :return: False if players joined since, the lobby is left as is.
+        """
+        with self.game_state_lock:
+            if not self.is_empty or not self.in_use:
+                return False
+
+            self.in_game = False
+            self.in_use = False
+            self.conns = []
+            self.full.clear()
+            self.action_queue_inbound = []
+            self.action_queue_outbound = []
+            self.outbound = Cache(self.cache_timeout, level=self.level)
+            self.limiter = RateLimiter(self.rate_limit, 2 * self.rate_limit)
+            self.game_state.reset()
+            self.game_state.set_boxes({})
+            self.rollback.clear()
+            self.spectators.clear()
+
+        return True
+
+    def recycle(self):
+        """
+        Recycles the lobby after its players left.
+        The lobby is handed to on_recycle, which resets it once no players can be added
+        to it anymore, or reset and terminated if there's no one to take it.
+        """
+        logging.info('Recycling lobby %s', self.uuid)
+
+        if self.on_recycle is not None:
+            self.on_recycle(self)
+        elif self.reset():
+            self.terminate()
+
     def terminate(self):
         """
         Terminates the lobby.
@@ -0,0 +1,199 @@
+"""
+Matchmaking for incoming players.
+
+JOINs used to be dropped into the first lobby that wasn't full, so games only
+started when a lobby happened to reach its capacity. The matchmaker queues
+players per locality bucket (e.g. wired vs behind a given gateway), forms full
+groups that are then assigned to a lobby at once, and keeps track of how long
+players waited to be matched. Players that can't fill a group in their bucket
+within max_wait are grouped with those left over in the other buckets, so wired
+and mobile players still end up in the same games.
+"""
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from typing import Deque, Dict, Hashable, List, Tuple
+import time
+
+from .connection import Conn
+
+WIRED = 'wired'
+"""Bucket of the players whose JOIN was received directly from them."""
+
+MIXED = 'mixed'
+"""Bucket of the groups merged out of the players left over in several buckets."""
+
+
+@dataclass
+class Ticket:
+    """
+    A player waiting to be matched.
+
+    Attributes:
+        conn: The player's connection.
+        source: The player's address in bytes.
+        bucket: The locality bucket the player was queued in.
+        enqueued: The time the player was queued.
+    """
+    conn: Conn
+    """The player's connection."""
+    source: bytes
+    """The player's address in bytes."""
+    bucket: Hashable
+    """The locality bucket the player was queued in."""
+    enqueued: float = field(default_factory=time.time)
+    """The time the player was queued."""
+
+
+Group = Tuple[Hashable, List[Ticket]]
+"""A locality bucket and the players matched together."""
+
+
+@dataclass
+class Matchmaker:
+    """
+    Queues players by locality and forms groups to fill lobbies with.
+
+    Attributes:
+        group_size: The number of players in a full group.
+        max_wait: Seconds after which a partial group is released anyway.
+        history: The number of wait times kept for the percentiles.
+    """
+    group_size: int = field(default=4)
+    """The number of players in a full group."""
+    max_wait: float = field(default=1.0)
+    """Seconds after which a partial group is released anyway."""
+    history: int = field(default=1024)
+    """The number of wait times kept for the percentiles."""
+
+    queues: Dict[Hashable, Deque[Ticket]] = field(
+        init=False, default_factory=dict)
+    """The queue of each locality bucket."""
+    waiting: Dict[bytes, Ticket] = field(init=False, default_factory=dict)
+    """The queued players, indexed by address, used to drop retransmitted JOINs."""
+    waits: Deque[float] = field(init=False)
+    """The time the most recently matched players waited, in seconds."""
+    ready: Event = field(init=False, default_factory=Event)
+    """Set whenever a bucket holds a full group."""
+    lock: Lock = field(init=False, default_factory=Lock)
+
+    def __post_init__(self):
+        self.waits = deque(maxlen=self.history)
+
+    def __len__(self) -> int:
+        return len(self.waiting)
+
+    def enqueue(self, conn: Conn, source: bytes, bucket: Hashable = WIRED) -> bool:
+        """
+        Queues a player.
+
+        :param conn: The player's connection.
+        :param source: The player's address in bytes.
+        :param bucket: The locality bucket to queue the player in.
+        :return: False if the player was already queued, True otherwise.
+        """
+        with self.lock:
+            if source in self.waiting:
+                return False
+
+            ticket = Ticket(conn, source, bucket)
+            self.waiting[source] = ticket
+
+            queue = self.queues.setdefault(bucket, deque())
+            queue.append(ticket)
+
+            if len(queue) >= self.group_size:
+                self.ready.set()
+
+        return True
+
+    def requeue(self, group: Group):
+        """
+        Puts the players of a group back at the head of their buckets, e.g. when no lobby was available.
+
+        :param group: The group to requeue.
+        """
+        _, tickets = group
+
+        with self.lock:
+            for t in reversed(tickets):
+                self.queues.setdefault(t.bucket, deque()).appendleft(t)
+
+    def form_groups(self) -> List[Group]:
+        """
+        Takes every full group out of the queues.
+        Players that waited longer than max_wait are merged with those left over in
+        the other buckets, and released in a partial group if there's not enough of them.
+        Players stay marked as waiting until they're either matched or dropped.
+
+        :return: The groups that were formed.
+        """
+        groups: List[Group] = []
+        left: List[Ticket] = []
+        now = time.time()
+
+        with self.lock:
+            self.ready.clear()
+
+            for bucket, queue in self.queues.items():
+                while len(queue) >= self.group_size:
+                    groups.append(
+                        (bucket, [queue.popleft() for _ in range(self.group_size)]))
+
+                if queue and queue[0].enqueued + self.max_wait < now:
+                    left.extend(queue)
+                    queue.clear()
+
+            # longest waiting first, a group keeps its bucket if all its players share one
+            left.sort(key=lambda t: t.enqueued)
+            for i in range(0, len(left), self.group_size):
+                tickets = left[i:i + self.group_size]
+                buckets = {t.bucket for t in tickets}
+                groups.append((buckets.pop() if len(buckets) == 1 else MIXED, tickets))
+
+            # drop empty buckets so stale localities don't pile up
+            self.queues = {b: q for b, q in self.queues.items() if q}
+
+        return groups
+
+    def matched(self, tickets: List[Ticket]):
+        """
+        Records how long the players of a group that was assigned a lobby waited.
+
+        :param tickets: The players that were matched.
+        """
+        now = time.time()
+        self.waits.extend(now - t.enqueued for t in tickets)
+        self.drop(tickets)
+
+    def drop(self, tickets: List[Ticket]):
+        """
+        Forgets about players that were taken out of the queues.
+
+        :param tickets: The players to forget about.
+        """
+        with self.lock:
+            for t in tickets:
+                self.waiting.pop(t.source, None)
+
+    def wait(self):
+        """
+        Blocks until a full group is ready, or a partial group might have waited long enough.
+        """
+        self.ready.wait(self.max_wait / 4)
+
+    def percentiles(self, *ps: float) -> Dict[float, float]:
+        """
+        Time-to-match percentiles over the most recently matched players.
+
+        :param ps: The percentiles to compute, defaults to 50, 90 and 99.
+        :return: The time to match, in seconds, for each percentile.
+        """
+        waits = sorted(self.waits)
+
+        if not waits:
+            return {}
+
+        return {p: waits[min(len(waits) - 1, int(len(waits) * p / 100))]
+                for p in (ps or (50, 90, 99))}
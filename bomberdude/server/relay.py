@@ -0,0 +1,224 @@
+"""
+Spectator relay.
+
+A relay subscribes to a lobby once, as a single spectator, and re-fans the
+stream out to its own spectators, so the lobby's cost doesn't grow with the
+number of viewers behind the relay. Bodies are forwarded as received, only the
+header is patched for each viewer.
+
+Viewers subscribe to the relay like they would to the server, with a SPECTATE.
+They're sent the last snapshot along with the changes received since.
+"""
+from __future__ import annotations
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+import socket
+from threading import Lock, Thread
+import time
+from typing import Deque, List
+
+from common.fanout import FanOut
+from common.payload import ACCEPT, KALIVE, SPECTATE, Payload
+from common.state import parse_snapshot
+from common.types import DEFAULT_PORT, KALIVE_INTERVAL, TIMEOUT, Address
+
+from .spectate import Spectators
+
+
+@dataclass
+class Relay(Thread):
+    """
+    Subscribes to a lobby's spectator stream and re-fans it out.
+
+    Attributes:
+        lobby_uuid: The uuid of the lobby to watch.
+        server: The server's address.
+        byte_address: The bytes representation of the relay's address.
+        level: The logging level.
+        capacity: The max number of viewers.
+        backlog: The max number of payloads kept since the last snapshot, for new viewers.
+    """
+    lobby_uuid: str
+    """The uuid of the lobby to watch."""
+    server: Address
+    """The server's address."""
+    byte_address: bytes
+    """The bytes representation of the relay's address."""
+    level: int = field(default=logging.INFO)
+    """The logging level."""
+    capacity: int = field(default=1024)
+    """The max number of viewers."""
+    backlog: int = field(default=1024)
+    """The max number of payloads kept since the last snapshot, for new viewers."""
+    sock: socket.socket = field(init=False)
+    """The socket used to talk to the lobby and the viewers."""
+    viewers: Spectators = field(init=False)
+    """The spectators of the relay."""
+    uuid: str = field(init=False, default='')
+    """The relay's spectator uuid upstream, empty until subscribed."""
+    lobby_port: int = field(init=False, default=0)
+    """The port of the lobby, where KALIVEs are sent."""
+    last_received: float = field(init=False, default=0.0)
+    """The time of the last payload received from the lobby."""
+    snapshot: List[Payload] = field(init=False, default_factory=list)
+    """The parts of the last snapshot of the game."""
+    since: Deque[Payload] = field(init=False)
+    """The changes received since the last snapshot."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the snapshot and the changes since."""
+    running: bool = field(init=False, default=False)
+    """Whether the relay is running."""
+
+    def __hash__(self) -> int:
+        return super().__hash__()
+
+    def __post_init__(self):
+        super(Relay, self).__init__()
+        self.viewers = Spectators(self.capacity)
+        self.since = deque(maxlen=self.backlog)
+
+        self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('', DEFAULT_PORT))
+        self.sock.settimeout(2)
+
+        logging.basicConfig(
+            level=self.level, format='%(levelname)s: %(message)s')
+
+    def _subscribe(self):
+        """
+        This method should not be called directly.
+
+        Asks the server to subscribe the relay to the lobby.
+        """
+        server = socket.inet_pton(socket.AF_INET6, self.server[0])
+        payload = Payload(SPECTATE, b'', self.lobby_uuid, '', 0,
+                          self.byte_address, server, DEFAULT_PORT)
+        self.sock.sendto(payload.to_bytes(), self.server)
+        logging.debug('Subscribing to lobby %s', self.lobby_uuid)
+
+    def _welcome(self, inc: Payload, addr: Address):
+        """
+        This method should not be called directly.
+
+        Subscribes a viewer, sending it the last snapshot and the changes since.
+        """
+        viewer = self.viewers.subscribe(inc.source)
+        if viewer is None:
+            logging.info('No room for viewer %s', addr[0])
+            return
+
+        response = Payload(ACCEPT, DEFAULT_PORT.to_bytes(2, 'big'), self.lobby_uuid, viewer.uuid,
+                           0, self.byte_address, inc.source, DEFAULT_PORT).to_bytes()
+        self.sock.sendto(response, viewer.address)
+
+        with self.lock:
+            catchup = self.snapshot + list(self.since)
+
+        for payload in catchup:
+            fanout = FanOut(payload.type, payload.data, self.lobby_uuid,
+                            self.byte_address, DEFAULT_PORT)
+            fanout.sendto(self.sock, viewer.address, viewer.uuid,
+                          payload.seq_num, viewer.byte_address)
+
+        logging.info('Viewer %s subscribed', viewer.uuid)
+
+    def _forward(self, inc: Payload):
+        """
+        This method should not be called directly.
+
+        Re-fans a payload of the lobby's stream out to every viewer.
+        """
+        with self.lock:
+            if inc.is_snapshot:
+                # a snapshot is split by rows, its first part starts a new one
+                stamp = parse_snapshot(inc.data)
+                if stamp is not None and stamp[1] == 0:
+                    self.snapshot = []
+                    self.since.clear()
+                self.snapshot.append(inc)
+            else:
+                self.since.append(inc)
+
+        fanout = FanOut(inc.type, inc.data, self.lobby_uuid,
+                        self.byte_address, DEFAULT_PORT)
+        self.viewers.broadcast(fanout, self.sock)
+
+    def _handle_incoming_data(self):
+        """
+        This method should not be called directly.
+
+        Method that will run in a separate thread to handle the lobby's stream and the viewers.
+        """
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(65535)
+                inc = Payload.from_bytes(data)
+
+                if inc.is_spectate:
+                    self._welcome(inc, addr)
+
+                elif inc.is_kalive:
+                    self.viewers.renew(inc.player_uuid)
+
+                elif inc.lobby_uuid == self.lobby_uuid and inc.is_accept:
+                    self.uuid = inc.player_uuid
+                    self.lobby_port = int.from_bytes(inc.data[:2], 'big')
+                    self.last_received = time.time()
+                    logging.info('Subscribed to lobby %s', self.lobby_uuid)
+
+                elif inc.lobby_uuid == self.lobby_uuid and (inc.is_snapshot or inc.is_actions):
+                    self.last_received = time.time()
+                    self._forward(inc)
+
+            except socket.timeout:
+                logging.debug('Socket timeout on _handle_incoming_data')
+
+            except Exception as e:
+                logging.error(
+                    'Error in _handle_incoming_data, %s', e.__str__())
+
+    def _kalive(self):
+        """
+        This method should not be called directly.
+
+        Method running in a separate thread to keep the subscription alive, resubscribing
+        once the lobby goes quiet, and to drop the viewers that left.
+        """
+        while self.running:
+            if not self.uuid or time.time() - self.last_received > TIMEOUT:
+                self.uuid = ''
+                self._subscribe()
+            else:
+                server = socket.inet_pton(socket.AF_INET6, self.server[0])
+                kalive = Payload(KALIVE, b'', self.lobby_uuid, self.uuid, 0,
+                                 self.byte_address, server, self.lobby_port)
+                self.sock.sendto(kalive.to_bytes(), (self.server[0], self.lobby_port))
+
+            if self.viewers.purge():
+                logging.debug('Dropped expired viewers')
+
+            time.sleep(KALIVE_INTERVAL)
+
+    def run(self):
+        """
+        Relay main loop.
+        """
+        self.running = True
+        logging.info('Relay started for lobby %s', self.lobby_uuid)
+
+        Thread(target=self._handle_incoming_data).start()
+        Thread(target=self._kalive).start()
+
+        while self.running:
+            time.sleep(0.1)
+
+        self.sock.close()
+
+    def terminate(self):
+        """
+        Terminates the relay.
+        """
+        logging.info('Terminating relay')
+        self.running = False
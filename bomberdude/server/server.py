@@ -1,13 +1,17 @@
-from common.types import DEFAULT_PORT
-from common.payload import REJOIN, Payload, ACCEPT, REJECT, JOIN
+from common.types import DEFAULT_PORT, TIMEOUT, Address
+from common.state import DEFAULT_SIZE
+from common.payload import HDR_SOURCE, REJOIN, SPECTATE, Payload, ACCEPT, REJECT, JOIN
 from common.uuid import uuid
 from common.core_utils import get_node_ipv6
 import logging
+from server.admission import Admission
 from server.connection import Conn
 from server.lobby import Lobby
+from server.matchmaking import WIRED, Group, Matchmaker, Ticket
 import socket
-from threading import Thread
+from threading import Lock, Thread
 import time
+from typing import Dict, Hashable, List, Optional, Tuple
 
 
 class Server(Thread):
@@ -23,13 +27,56 @@ class Server(Thread):
     byte_address: bytes
     """The bytes representation of the server's address"""
 
-    def __init__(self, id: str, level: int):
+    admission: Admission
+    """Rate limiting, JOIN dedupe and lobby creation budget."""
+
+    pool: Dict[str, Lobby]
+    """Warm lobbies, started and waiting for players, indexed by uuid."""
+
+    pool_size: int
+    """The number of warm lobbies the server tries to keep around."""
+
+    lobby_lock: Lock
+    """Protects the lobbies list and the pool from concurrent access."""
+
+    matchmaker: Matchmaker
+    """Queues players by locality and forms the groups that fill lobbies."""
+
+    open: Dict[Hashable, Lobby]
+    """Partially filled lobbies, indexed by the locality of their players."""
+
+    map_size: Tuple[int, int]
+    """The (width, height) of the boards of new lobbies."""
+
+    record_dir: Optional[str]
+    """The directory games are recorded to, None to not record them."""
+
+    authoritative: bool
+    """Whether lobbies validate the actions of their players and detonate their bombs."""
+
+    interest_radius: Optional[int]
+    """Players are only sent the moves within this many cells of them, None to send everything."""
+
+    def __init__(self, id: str, level: int, pool_size: int = 2,
+                 map_size: Tuple[int, int] = DEFAULT_SIZE,
+                 record_dir: Optional[str] = None, authoritative: bool = False,
+                 interest_radius: Optional[int] = None):
         """
         Initialize the socket server.
         """
         Thread.__init__(self)
         self.running = True
         self.lobbies = []
+        self.pool = {}
+        self.pool_size = pool_size
+        self.map_size = map_size
+        self.record_dir = record_dir
+        self.authoritative = authoritative
+        self.interest_radius = interest_radius
+        self.lobby_lock = Lock()
+        self.admission = Admission()
+        self.matchmaker = Matchmaker()
+        self.open = {}
         self.sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
         self.sock.bind(('', DEFAULT_PORT))
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -51,17 +98,48 @@ class Server(Thread):
 
         logging.info("Starting server on address \"%s\" \"%d\"", addr, _port)
 
-    def new_lobby(self) -> Lobby:
+    def new_lobby(self) -> Optional[Lobby]:
         """
-        Create a new lobby.
+        Activates a new lobby, if the lobby creation budget allows it.
+        Warm lobbies are taken from the pool, a lobby is only spawned if the pool is empty.
 
-        :return: The new lobby.
+        :return: The new lobby or None if the budget is exhausted.
         """
-        # generate a new lobby id
-        lobby_id = uuid()
+        with self.lobby_lock:
+            if not self.admission.can_create_lobby(len(self.lobbies)):
+                logging.warning("Lobby limit reached.")
+                return None
+
+            if self.pool:
+                _, lobby = self.pool.popitem()
+                logging.info("Took lobby %s from the pool", lobby.uuid)
+            else:
+                lobby = self._spawn_lobby()
+
+            if lobby is None:
+                logging.warning("Lobby creation budget exhausted.")
+                return None
+
+            # add the lobby to the list of lobbies
+            self.lobbies.append(lobby)
+
+        return lobby
+
+    def _spawn_lobby(self) -> Optional[Lobby]:
+        """
+        Creates and starts a new lobby, allocating its sockets and threads.
+        Spawning is charged to the lobby creation budget, should be called with the lobby lock held.
 
+        :return: The new lobby or None if the budget is exhausted.
+        """
         # get list of lobbies
-        lobbies = [lobby.uuid for lobby in self.lobbies]
+        lobbies = [lobby.uuid for lobby in self.lobbies] + list(self.pool)
+
+        if not self.admission.can_spawn_lobby(len(lobbies)):
+            return None
+
+        # generate a new lobby id
+        lobby_id = uuid()
 
         # check whether the lobby id is unique,
         # if not, generate a new one and try again
@@ -80,46 +158,156 @@ class Server(Thread):
         out_sock.settimeout(2)
 
         # create a new lobby
-        lobby = Lobby(lobby_id, in_sock, out_sock, self.byte_address)
+        lobby = Lobby(lobby_id, in_sock, out_sock, self.byte_address,
+                      size=self.map_size, record=self.record_dir,
+                      authoritative=self.authoritative,
+                      interest_radius=self.interest_radius, on_recycle=self._recycle_lobby)
         lobby.start()
 
-        # add the lobby to the list of lobbies
-        self.lobbies.append(lobby)
-
         logging.info("Created new lobby: %s on port %d",
                      lobby_id, in_sock.getsockname()[1])
 
         return lobby
 
-    def get_free_lobby(self) -> Lobby:
+    def _recycle_lobby(self, lobby: Lobby):
         """
-        Finds the first lobby that is not full.
-        If no free lobby is found, a new lobby is created
+        Called by a lobby once its players left.
+        The lobby is taken out of the running lobbies before it's reset, so no players
+        are added to it meanwhile, then goes back to the pool, or is terminated if the pool is full.
+        Players that joined before it was taken out keep it running.
 
-        :return: The first lobby that is not full.
+        :param lobby: The lobby whose players left.
         """
-        for lobby in self.lobbies:
-            if not lobby.is_full:
-                logging.debug("Found free lobby: %s", lobby.uuid)
-                return lobby
+        with self.lobby_lock:
+            if lobby in self.lobbies:
+                self.lobbies.remove(lobby)
 
-        logging.debug("No free lobby found. Creating new lobby.")
-        return self.new_lobby()
+            if not lobby.reset():
+                self.lobbies.append(lobby)
+                return
+
+            if self.running and len(self.pool) < self.pool_size:
+                self.pool[lobby.uuid] = lobby
+                logging.info("Lobby %s returned to the pool", lobby.uuid)
+                return
+
+        lobby.terminate()
+
+    def _handle_pool(self):
+        """
+        This method should not be called directly.
 
-    def get_lobby(self, lobby_id: str) -> Lobby:
+        Keeps the pool of warm lobbies filled, so JOINs don't wait for thread startup.
         """
-        Finds the lobby with the given lobby id. If no lobby is found, a new lobby is created.
+        while self.running:
+            with self.lobby_lock:
+                lobby = self._spawn_lobby() if len(self.pool) < self.pool_size else None
+                if lobby is not None:
+                    self.pool[lobby.uuid] = lobby
+                    continue
+
+            time.sleep(0.1)
+
+    def get_lobby(self, lobby_id: str) -> Optional[Lobby]:
+        """
+        Finds the lobby with the given lobby id, as long as it isn't full.
         :param lobby_id: The id of the lobby to find.
-        :return: A lobby with the given id or a new lobby if no lobby with the given id was found.
+        :return: A lobby with the given id or None if no such lobby was found.
         """
-        for lobby in self.lobbies:
+        for lobby in list(self.lobbies):
             if lobby.uuid == lobby_id and not lobby.is_full:
                 logging.debug("Found lobby: %s", lobby.uuid)
                 return lobby
 
-        logging.debug(
-            "No lobby found or lobby was full. Creating new lobby.")
-        return self.get_free_lobby()
+        return None
+
+    def _fill(self, lobby: Lobby, bucket: Hashable, tickets: List[Ticket]) -> bool:
+        """
+        Adds matched players to a lobby, all at once, and accepts them.
+
+        :param lobby: The lobby to add the players to.
+        :param bucket: The locality bucket the players were queued in.
+        :param tickets: The matched players.
+        :return: True if the players were added, False otherwise.
+        """
+        if not lobby.add_players([t.conn for t in tickets]):
+            return False
+
+        # keep partially filled lobbies open for the same locality
+        if not lobby.is_full:
+            self.open[bucket] = lobby
+
+        for t in tickets:
+            response = self._accept(t.conn, lobby)
+            self.admission.remember(t.source, response, t.conn, lobby)
+
+        self.matchmaker.matched(tickets)
+        logging.info("Matched %d players from %s into lobby %s",
+                     len(tickets), bucket, lobby.uuid)
+        return True
+
+    def _assign(self, group: Group) -> List[Ticket]:
+        """
+        Assigns a group of matched players to lobbies.
+        Full groups get a lobby of their own. Partial groups, released once their players
+        waited long enough, top up the open lobby of their locality first, then any open lobby.
+
+        :param group: The locality bucket and the matched players.
+        :return: The players that couldn't be assigned as no lobby was available.
+        """
+        bucket, tickets = group
+
+        if len(tickets) < self.matchmaker.group_size:
+            # under the lock, so an open lobby isn't recycled while it's topped up
+            with self.lobby_lock:
+                for b in [bucket] + [b for b in self.open if b != bucket]:
+                    if not tickets:
+                        return []
+
+                    lobby = self.open.pop(b, None)
+                    if lobby is None or lobby.in_game or lobby not in self.lobbies:
+                        continue
+
+                    room = lobby.capacity - len(lobby.conns)
+                    if room <= 0:
+                        continue
+
+                    if self._fill(lobby, b, tickets[:room]):
+                        tickets = tickets[room:]
+                    else:
+                        self.open[b] = lobby
+
+        if not tickets:
+            return []
+
+        lobby = self.new_lobby()
+        if lobby is None or not self._fill(lobby, bucket, tickets):
+            return tickets
+
+        return []
+
+    def _handle_matchmaking(self):
+        """
+        This method should not be called directly.
+
+        Forms groups out of the queued players and assigns them to lobbies.
+        Players that couldn't get a lobby are requeued, or denied once they've waited too long.
+        """
+        while self.running:
+            self.matchmaker.wait()
+
+            for group in self.matchmaker.form_groups():
+                tickets = self._assign(group)
+
+                if not tickets:
+                    continue
+
+                if time.time() - tickets[0].enqueued > TIMEOUT:
+                    for t in tickets:
+                        self._deny(t.conn, 'Server busy')
+                    self.matchmaker.drop(tickets)
+                else:
+                    self.matchmaker.requeue((group[0], tickets))
 
     def _deny(self, conn: Conn, reason: str):
         """
@@ -133,28 +321,59 @@ class Server(Thread):
 
         self.sock.sendto(response.to_bytes(), conn.address)
 
-    def _accept(self, conn: Conn, lobby: Lobby):
+    def _accept(self, conn: Conn, lobby: Lobby) -> bytes:
         """
         Creates a response with the given reason and sends it to the client.
 
         :param conn: The connection to send the response to.
         :param lobby: The lobby the player joined.
+        :return: The response that was sent.
         """
         data = lobby.port.to_bytes(2, 'big')
 
         response = Payload(ACCEPT, data, lobby.uuid, conn.uuid,
-                           0, self.byte_address, conn.byte_address, DEFAULT_PORT)
+                           0, self.byte_address, conn.byte_address, DEFAULT_PORT).to_bytes()
 
         print("address", conn.address)
-        self.sock.sendto(response.to_bytes(), conn.address)
+        self.sock.sendto(response, conn.address)
+        return response
 
-    def handle_data(self, data: bytes):
+    def _spectate(self, inc: Payload):
+        """
+        Subscribes a spectator to the lobby it asked for, running or not.
+        The spectator is answered with an ACCEPT carrying the lobby's port and its uuid,
+        used for the KALIVEs that keep it subscribed.
+
+        :param inc: The SPECTATE payload.
+        """
+        with self.lobby_lock:
+            lobby = next((l for l in self.lobbies if l.uuid == inc.lobby_uuid), None)
+
+        if lobby is None:
+            logging.info("Spectated lobby %s not found", inc.lobby_uuid)
+            return
+
+        spectator = lobby.subscribe(inc.source)
+        if spectator is None:
+            return
+
+        response = Payload(ACCEPT, lobby.port.to_bytes(2, 'big'), lobby.uuid, spectator.uuid,
+                           0, self.byte_address, inc.source, DEFAULT_PORT).to_bytes()
+        self.sock.sendto(response, spectator.address)
+
+    def handle_data(self, data: bytes, addr: Address):
         """
         Handle data received from the socket.
 
         :param data: The data received from the socket.
         :param addr: The address of the client.
         """
+        # drop floods before doing any work, keyed on the header's source
+        # as mobiles share the address of the gateway relaying their JOINs
+        if not self.admission.allow(bytes(data[HDR_SOURCE:HDR_SOURCE + 16])):
+            logging.debug("Rate limited JOIN from %s", addr[0])
+            return
+
         # check whether the payload is valid
         try:
             inc = Payload.from_bytes(data)
@@ -163,19 +382,20 @@ class Server(Thread):
                 logging.error("Invalid payload received.")
                 return
 
+            if inc.type == SPECTATE:
+                self._spectate(inc)
+                return
+
             if inc.type != REJOIN and inc.type != JOIN:
                 logging.info("Received invalid payload: %s", inc)
                 return
 
-            # if there's a lobby uuid, get the lobby
-            if inc.lobby_uuid != '':
-                lobby = self.get_lobby(inc.lobby_uuid)
-
-                if lobby.is_full:
-                    logging.info("Lobby is full: %s", lobby.uuid)
-                    lobby = self.get_free_lobby()
-            else:
-                lobby = self.get_free_lobby()
+            # retransmitted JOINs get the ACCEPT that was already sent
+            response = self.admission.cached_accept(inc.source)
+            if response is not None:
+                logging.debug("Resending cached ACCEPT to %s", addr[0])
+                self.sock.sendto(response, (inc.short_source, DEFAULT_PORT))
+                return
 
             # get a name from the payload's data or 'anonymous' if no name was given
             # TODO: This should be better handled. No sanitization is done here!
@@ -184,10 +404,24 @@ class Server(Thread):
             #print("Source address bytes: ", str(inc.source))
             # create a new connection for the client
             conn = Conn(inc.source, name, time.time())
-            # add the connection to the lobby
-            lobby.add_player(conn)
-            # send the response to the client
-            self._accept(conn, lobby)
+
+            # if there's a lobby uuid, try to join that lobby directly
+            with self.lobby_lock:
+                lobby = self.get_lobby(
+                    inc.lobby_uuid) if inc.lobby_uuid != '' else None
+                joined = lobby is not None and lobby.add_player(conn)
+
+            if joined:
+                # send the response to the client
+                response = self._accept(conn, lobby)
+                self.admission.remember(inc.source, response, conn, lobby)
+                return
+
+            # otherwise queue the player, bucketed by the gateway it joined through
+            bucket = WIRED if addr[0] == inc.short_source else addr[0]
+
+            if not self.matchmaker.enqueue(conn, inc.source, bucket):
+                logging.debug("Player %s is already queued", addr[0])
 
         except Exception as e:
             logging.error("parsing payload: ", e)
@@ -196,12 +430,15 @@ class Server(Thread):
         """
         Main loop of the server.
         """
+        Thread(target=self._handle_pool).start()
+        Thread(target=self._handle_matchmaking).start()
+
         while self.running:
             try:
                 data, addr = self.sock.recvfrom(1500)
 
                 logging.debug("Received data from %s: %s", addr, data)
-                self.handle_data(data)
+                self.handle_data(data, addr)
 
             except socket.timeout:
                 logging.debug("Socket read timeout, trying again.")
@@ -220,12 +457,16 @@ class Server(Thread):
         logging.info("Closing socket.")
         self.sock.close()
 
+        with self.lobby_lock:
+            lobbies = self.lobbies + list(self.pool.values())
+            self.pool = {}
+
         logging.info("Terminating lobbies.")
-        for lobby in self.lobbies:
+        for lobby in lobbies:
             lobby.terminate()
 
         logging.info("Joining threads(lobbies).")
-        for lobby in self.lobbies:
+        for lobby in lobbies:
             lobby.join()
 
         logging.info("Terminated. Have a nice day!")
@@ -1,6 +1,7 @@
 from logging import Logger
-from typing import Optional
+from typing import Optional, Tuple
 from server.server import Server
+from common.state import DEFAULT_SIZE
 
 
 class ServerCLI:
@@ -11,11 +12,15 @@ class ServerCLI:
     run: bool
     logger: Logger
 
-    def __init__(self, level: int, id: str):
+    def __init__(self, level: int, id: str, pool_size: int = 2,
+                 map_size: Tuple[int, int] = DEFAULT_SIZE,
+                 record_dir: Optional[str] = None, authoritative: bool = False,
+                 interest_radius: Optional[int] = None):
         """
         Initialize the socket server.
         """
-        self.srv = Server(id, level)
+        self.srv = Server(id, level, pool_size, map_size, record_dir,
+                          authoritative, interest_radius)
         self.run = False
         self.logger = Logger("Server CLI", level=level)
         self.logger.info("Starting CLI.")
@@ -64,10 +69,20 @@ class ServerCLI:
     def _status(self, lobby: Optional[str] = None):
         """
         Prints the status of the server.
-        This includes the number of players currently connected and the number of lobbies.
+        This includes the number of players currently connected, the number of lobbies,
+        the number of warm lobbies waiting in the pool and matchmaking statistics.
         """
         # get number of lobbies
         print("Number of lobbies: %d" % len(self.srv.lobbies))
+        print("Pooled lobbies: %d/%d" %
+              (len(self.srv.pool), self.srv.pool_size))
+        print("Map size: %dx%d" % self.srv.map_size)
+        print("Authoritative: %s" % self.srv.authoritative)
+        print("Interest radius: %s" % self.srv.interest_radius)
+        print("Queued players: %d" % len(self.srv.matchmaker))
+
+        for p, wait in self.srv.matchmaker.percentiles().items():
+            print("Time to match p%d: %.3fs" % (p, wait))
 
         for lob in self.srv.lobbies:
             print("Lobby: %s" % lob.uuid)
@@ -0,0 +1,164 @@
+"""
+Read-only spectator subscriptions.
+
+Players are capped at the lobby's capacity and each of them gets its own
+acknowledged stream, cached until it's ACKed. Spectators only watch, so they get
+a cheaper tier instead: a snapshot of the game when they subscribe, then every
+batch of changes, unacknowledged. Lost changes are caught up by the snapshots
+sent to all spectators every few seconds. Every payload is serialized once and
+shared by all spectators, only the header is patched for each of them.
+
+Spectators stay subscribed by sending KALIVEs, like players do.
+"""
+from __future__ import annotations
+from dataclasses import dataclass, field
+import logging
+from socket import AF_INET6, inet_ntop, socket
+from threading import Lock
+import time
+from typing import Dict, Optional
+
+from common.fanout import FanOut
+from common.types import DEFAULT_PORT, TIMEOUT, Address
+from common.uuid import uuid
+
+
+@dataclass
+class Spectator:
+    """
+    A subscriber to a lobby's stream.
+
+    Attributes:
+        uuid: The id of the spectator, used in place of a player uuid.
+        byte_address: The bytes representation of the spectator's address.
+        last_kalive: The time of the last packet received from the spectator.
+    """
+    uuid: str
+    """The id of the spectator, used in place of a player uuid."""
+    byte_address: bytes
+    """The bytes representation of the spectator's address."""
+    last_kalive: float
+    """The time of the last packet received from the spectator."""
+    address: Address = field(init=False)
+    """The address of the spectator."""
+
+    def __post_init__(self):
+        self.address = (inet_ntop(AF_INET6, self.byte_address), DEFAULT_PORT)
+
+    @property
+    def expired(self) -> bool:
+        """
+        Checks whether the spectator stopped sending KALIVEs.
+        """
+        return time.time() - self.last_kalive > TIMEOUT
+
+
+@dataclass
+class Spectators:
+    """
+    The spectators of a lobby, sharing a single stream.
+
+    Attributes:
+        capacity: The max number of spectators.
+    """
+    capacity: int = field(default=256)
+    """The max number of spectators."""
+    subs: Dict[str, Spectator] = field(init=False, default_factory=dict)
+    """The spectators, indexed by uuid."""
+    sources: Dict[bytes, str] = field(init=False, default_factory=dict)
+    """The uuid of each spectator, indexed by address, so resubscribing keeps it."""
+    seq_num: int = field(init=False, default=0)
+    """The sequence number of the last payload of the stream, so spectators can spot gaps."""
+    lock: Lock = field(init=False, default_factory=Lock)
+    """Protects the spectators, they subscribe from the server's thread."""
+
+    def __len__(self) -> int:
+        return len(self.subs)
+
+    def subscribe(self, byte_address: bytes) -> Optional[Spectator]:
+        """
+        Subscribes a spectator, or renews its subscription.
+
+        :param byte_address: The bytes representation of the spectator's address.
+        :return: The spectator or None if there's no room left.
+        """
+        with self.lock:
+            id = self.sources.get(byte_address)
+            if id is not None:
+                self.subs[id].last_kalive = time.time()
+                return self.subs[id]
+
+            if len(self.subs) >= self.capacity:
+                return None
+
+            spectator = Spectator(uuid(), byte_address, time.time())
+            self.subs[spectator.uuid] = spectator
+            self.sources[byte_address] = spectator.uuid
+            return spectator
+
+    def renew(self, uuid: str) -> bool:
+        """
+        Renews a subscription, called for every packet received from a spectator.
+
+        :return: True if the uuid belongs to a spectator.
+        """
+        spectator = self.subs.get(uuid)
+
+        if spectator is None:
+            return False
+
+        spectator.last_kalive = time.time()
+        return True
+
+    def purge(self) -> int:
+        """
+        Drops the spectators that stopped sending KALIVEs.
+
+        :return: The number of spectators dropped.
+        """
+        with self.lock:
+            expired = [s for s in self.subs.values() if s.expired]
+
+            for s in expired:
+                del self.subs[s.uuid]
+                del self.sources[s.byte_address]
+
+        return len(expired)
+
+    def clear(self):
+        """
+        Drops every spectator.
+        """
+        with self.lock:
+            self.subs = {}
+            self.sources = {}
+
+    def send(self, fanout: FanOut, sock: socket, spectator: Spectator) -> int:
+        """
+        Sends a shared payload to a single spectator, e.g. the snapshot of a new one.
+        Spectators are unacknowledged, a payload that can't be sent is dropped.
+
+        :return: The number of bytes sent.
+        """
+        try:
+            return fanout.sendto(sock, spectator.address, spectator.uuid,
+                                 self.seq_num, spectator.byte_address)
+        except OSError as e:
+            logging.debug('Could not send to spectator %s, %s', spectator.uuid, e.__str__())
+            return 0
+
+    def broadcast(self, fanout: FanOut, sock: socket) -> int:
+        """
+        Sends a shared payload to every spectator, as the next payload of the stream.
+
+        :param fanout: The payload, serialized once for all spectators.
+        :param sock: The socket used to send the payload.
+        :return: The number of bytes sent.
+        """
+        self.seq_num += 1
+        sent = 0
+
+        for spectator in list(self.subs.values()):
+            sent += self.send(fanout, sock, spectator)
+
+        return sent
@@ -11,6 +11,17 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Bomberdude server.')
     parser.add_argument('--id', type=str, required=True,)
     parser.add_argument('-l', '--level', type=str, default='info',)
+    parser.add_argument('-p', '--pool', type=int, default=2,
+                        help='Number of warm lobbies to keep around.')
+    parser.add_argument('-s', '--size', type=int, nargs=2, default=[13, 13],
+                        metavar=('WIDTH', 'HEIGHT'),
+                        help='Size of the boards, both must be odd.')
+    parser.add_argument('-r', '--record', type=str, default=None, metavar='DIR',
+                        help='Record every game to a replay file in this directory.')
+    parser.add_argument('-a', '--authoritative', action='store_true',
+                        help='Validate the actions of the players before applying them, and detonate bombs in the lobby.')
+    parser.add_argument('-i', '--interest', type=int, default=None, metavar='RADIUS',
+                        help='Only send players the moves within this many cells of them.')
     args = parser.parse_args()
 
     # parse level
@@ -23,5 +34,6 @@ if __name__ == '__main__':
     else:
         log_lvl = INFO
 
-    srv = ServerCLI(log_lvl, args.id)
+    srv = ServerCLI(log_lvl, args.id, args.pool, tuple(args.size), args.record,
+                    args.authoritative, args.interest)
     srv.start()